@@ -0,0 +1,124 @@
+"""
+Bandwidth shaping with token buckets.
+Transfers charge every chunk to a global bucket and to their user's bucket,
+per direction (download / upload), and sleep off whatever they overdraw.
+The first bytes of each transfer are charged without waiting, so short jobs
+stay fast while bulk transfers pay the debt and share what is left.
+"""
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    """rate bytes per second with up to burst bytes banked; may go into debt."""
+
+    def __init__(self, rate: float, burst: float = 0):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, nbytes: int) -> float:
+        """Charge nbytes and return how long the caller should wait to pay off any debt."""
+        self._refill()
+        self.tokens -= nbytes
+        return max(0.0, -self.tokens / self.rate)
+
+    def idle(self, seconds: float) -> bool:
+        """True if nothing was charged for seconds and the bucket has refilled completely,
+        so dropping it and starting a new one later changes nothing."""
+        elapsed = time.monotonic() - self.updated
+        return elapsed > seconds and self.tokens + elapsed * self.rate >= self.burst
+
+
+class BandwidthShaper:
+    """Global and per-user token buckets for each direction; a limit of 0 means unlimited."""
+
+    # Per-user buckets unused for this long are dropped
+    IDLE_SECONDS = 60
+
+    def __init__(self, limits: dict, free_bytes: int = 0):
+        # limits: {"download": (global_rate, per_user_rate), "upload": (...)}
+        self.limits = dict(limits)
+        self.free_bytes = free_bytes
+        self._global = {
+            direction: TokenBucket(rates[0]) for direction, rates in self.limits.items() if rates[0] > 0
+        }
+        self._per_user = {}
+        self._pruned = time.monotonic()
+
+    def _buckets(self, direction: str, user_id) -> list:
+        buckets = []
+        if direction in self._global:
+            buckets.append(self._global[direction])
+        per_user = self.limits.get(direction, (0, 0))[1]
+        if per_user > 0 and user_id is not None:
+            key = (direction, user_id)
+            if key not in self._per_user:
+                self._prune()
+                self._per_user[key] = TokenBucket(per_user)
+            buckets.append(self._per_user[key])
+        return buckets
+
+    def _prune(self):
+        now = time.monotonic()
+        if now - self._pruned < self.IDLE_SECONDS:
+            return
+        self._pruned = now
+        for key, bucket in list(self._per_user.items()):
+            if bucket.idle(self.IDLE_SECONDS):
+                del self._per_user[key]
+
+    def background(self, rate: float, user_id=None) -> "BackgroundThrottle":
+        """Download throttle for low-priority work: rate bytes per second until promoted.
+        Its bytes count against the global and per-user download limits either way."""
+        return BackgroundThrottle(rate, self.throttle("download", user_id), self._buckets("download", user_id))
+
+    def throttle(self, direction: str, user_id=None):
+        """Return an async callback(nbytes) for one transfer, or None when nothing is limited."""
+        buckets = self._buckets(direction, user_id)
+        if not buckets:
+            return None
+        state = {"free": self.free_bytes}
+
+        async def throttle(nbytes: int):
+            delay = max(bucket.take(nbytes) for bucket in buckets)
+            if state["free"] > 0:
+                # Still inside the transfer's free head: the debt is paid by later chunks
+                state["free"] -= nbytes
+                return
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        return throttle
+
+
+class BackgroundThrottle:
+    """Throttle for speculative transfers: held to its own low rate until promote() hands
+    it the normal (foreground) limits, e.g. once the user actually asks for the file.
+    Before that, bytes are also charged to the foreground buckets (global and per-user), so
+    speculative transfers never add traffic on top of the normal limits."""
+
+    def __init__(self, rate: float, foreground=None, buckets=()):
+        self.bucket = TokenBucket(rate) if rate > 0 else None
+        self.foreground = foreground
+        self.buckets = list(buckets)
+        self.promoted = False
+
+    def promote(self):
+        self.promoted = True
+
+    async def __call__(self, nbytes: int):
+        if self.promoted or self.bucket is None:
+            if self.foreground:
+                await self.foreground(nbytes)
+            return
+        delay = max(bucket.take(nbytes) for bucket in [self.bucket, *self.buckets])
+        if delay > 0:
+            await asyncio.sleep(delay)
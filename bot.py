@@ -7,11 +7,15 @@ import tempfile
 import time
 import base64
 import json
+import hashlib
+import shlex
+import shutil
 from urllib.parse import urlparse
 from pathlib import Path
 from uuid import uuid4
-from telegram import Update, InputFile, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+from datetime import datetime, timezone
+from telegram import Update, Message, Chat, User, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, CallbackContext, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 from telegram.request import HTTPXRequest
 from telegram.error import Conflict, BadRequest, Forbidden
 from config import (
@@ -26,7 +30,92 @@ from config import (
     YT_COOKIES_B64,
     INVIDIOUS_INSTANCES,
     PIPED_INSTANCES,
+    HTTP_POOL_LIMIT,
+    HTTP_POOL_LIMIT_PER_HOST,
+    HTTP_DNS_CACHE_TTL,
+    HTTP_KEEPALIVE_TIMEOUT,
+    SEGMENTED_DOWNLOADS,
+    SEGMENT_MIN_SIZE,
+    SEGMENT_PIECE_SIZE,
+    SEGMENT_MIN_WORKERS,
+    SEGMENT_MAX_WORKERS,
+    STORAGE_DIR,
+    STORAGE_QUOTA_BYTES,
+    STORAGE_MIN_FREE_BYTES,
+    STORAGE_SWEEP_INTERVAL,
+    STORAGE_MAX_JOB_AGE,
+    STORAGE_UNKNOWN_SIZE_BYTES,
+    PARTIAL_DIR,
+    PARTIAL_MAX_AGE,
+    DOWNLOAD_RETRIES,
+    DOWNLOAD_RETRY_BACKOFF,
+    DOWNLOAD_CACHE_DIR,
+    DOWNLOAD_CACHE_MAX_BYTES,
+    FILE_ID_DB,
+    FILE_ID_URL_TTL,
+    STREAM_UPLOADS,
+    STREAM_BUFFER_CHUNKS,
+    MAX_CONCURRENT_JOBS,
+    MAX_JOBS_PER_USER,
+    MAX_JOBS_PER_HOST,
+    MAX_QUEUED_JOBS,
+    MAX_QUEUED_JOBS_PER_USER,
+    PROGRESS_INTERVAL,
+    PROGRESS_GROUP_INTERVAL,
+    PROGRESS_GLOBAL_RATE,
+    DOWNLOAD_RATE_LIMIT,
+    DOWNLOAD_RATE_LIMIT_PER_USER,
+    UPLOAD_RATE_LIMIT,
+    UPLOAD_RATE_LIMIT_PER_USER,
+    RATE_LIMIT_FREE_BYTES,
+    DISK_WRITE_BUFFER_SIZE,
+    DISK_WRITE_BUFFERS,
+    MIRROR_LOOKUP_GRACE,
+    HEDGE_MAX_MIRRORS,
+    HEDGE_SAMPLE_BYTES,
+    INSTANCE_FANOUT,
+    INSTANCE_PROBE_INTERVAL,
+    INSTANCE_FAILURE_THRESHOLD,
+    INSTANCE_OPEN_SECONDS,
+    INVIDIOUS_CACHE_TTL,
+    YTDLP_INFO_CACHE_TTL,
+    YTDLP_WORKERS,
+    YTDLP_CONCURRENT_FRAGMENTS,
+    YTDLP_BUFFER_SIZE,
+    YTDLP_HTTP_CHUNK_SIZE,
+    YTDLP_EXTERNAL_DOWNLOADER,
+    YTDLP_EXTERNAL_DOWNLOADER_ARGS,
+    FFMPEG_WORKERS,
+    FFMPEG_THREADS,
+    FFMPEG_NICE,
+    FFMPEG_TIMEOUT,
+    YT_PREFETCH,
+    YT_PREFETCH_RATE,
+    YT_PREFETCH_MAX_HEIGHT,
+    YT_PREFETCH_MAX_ACTIVE,
+    YT_PREFETCH_MAX_USERS,
+    VIDEO_PRETRANSCODE,
+    PENDING_DB,
 )
+from http_session import HttpSessionManager
+from downloader import (
+    PartialFile, StreamDownload, SegmentedDownload, RangeNotSupported, NON_VIDEO_KINDS,
+    accepts_ranges, file_sha256, probe_url, hedge_mirrors,
+)
+from download_cache import DownloadCache, link_or_copy
+from file_id_index import FileIdIndex
+from single_flight import SingleFlight
+from stream_upload import send_file_stream, buffered_chunks, file_chunks
+from storage import StorageManager, StorageFull
+from scheduler import JobScheduler, SchedulerFull
+from progress_renderer import ProgressRenderer
+from bandwidth import BandwidthShaper
+from disk_writer import DiskWriter
+from instance_health import InstanceHealth
+from ttl_cache import ExpiringCache, signed_url_expiry
+from ytdl_pool import YtdlPool
+from ffmpeg_pool import FfmpegPool
+from pending_store import PendingStore
 try:
     from uploader import upload_to_bridge
 except Exception:
@@ -52,8 +141,23 @@ class TelegramDownloadBot:
             builder = builder.request(req).get_updates_request(req)
             print(f"🔗 Using Local Bot API server: {BOT_API_BASE_URL}")
 
+        # One pooled HTTP session (DNS cache + keep-alive) shared by all downloads and API probes
+        self.http = HttpSessionManager(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            dns_ttl=HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        )
+
         # Define a post_init hook to run after application initialization
         async def _post_init(app):
+            await self.http.start()
+            self.progress.start()
+            self.instances.start(self.http.get_session)
+            self.ytdl_pool.start(asyncio.get_running_loop())
+            self.pending.start(self.on_pending_expired)
+            if app.job_queue and STORAGE_SWEEP_INTERVAL > 0:
+                app.job_queue.run_repeating(self.sweep_storage, interval=STORAGE_SWEEP_INTERVAL, first=STORAGE_SWEEP_INTERVAL)
             try:
                 await app.bot.delete_webhook(drop_pending_updates=True)
                 print("🔧 Webhook removed (if existed); polling enabled.")
@@ -75,7 +179,16 @@ class TelegramDownloadBot:
             except Exception as e:
                 print(f"⚠️ getMe failed: {e}")
 
-        builder = builder.post_init(_post_init)
+        async def _post_shutdown(app):
+            await self.progress.stop()
+            await self.instances.stop()
+            await self.pending.stop()
+            await self.http.close()
+            self.disk_writer.close()
+            self.ytdl_pool.close()
+            await self.ffmpeg.close()
+
+        builder = builder.post_init(_post_init).post_shutdown(_post_shutdown)
         self.app = builder.build()
         # Authorized user IDs
         default_users = {818185073, 6936101187, 7972834913}
@@ -97,10 +210,68 @@ class TelegramDownloadBot:
                 self.yt_cookies_path = YT_COOKIES_FILE
         except Exception as e:
             print(f"⚠️ Error preparing YouTube cookies: {e}")
-        # token -> {file_path, filename, file_size, user_id, user_name, chat_id, progress_msg, update, job}
-        self.pending_videos = {}
-        # token -> {url, user_id, user_name, chat_id, progress_msg, update, job}
-        self.pending_ytdl = {}
+        # Local cache of downloaded files, revalidated against the origin before reuse
+        self.download_cache = None
+        if DOWNLOAD_CACHE_MAX_BYTES > 0:
+            try:
+                self.download_cache = DownloadCache(DOWNLOAD_CACHE_DIR, DOWNLOAD_CACHE_MAX_BYTES)
+            except Exception as e:
+                print(f"⚠️ Download cache disabled: {e}")
+        # Telegram file_ids of everything already delivered, so repeats skip download and upload
+        self.file_ids = None
+        try:
+            self.file_ids = FileIdIndex(FILE_ID_DB, ttl_by_kind={"url": FILE_ID_URL_TTL})
+        except Exception as e:
+            print(f"⚠️ file_id cache disabled: {e}")
+        # Per-job workspaces with a disk quota; whatever a previous run left behind is swept now
+        self.storage = StorageManager(STORAGE_DIR, STORAGE_QUOTA_BYTES, STORAGE_MIN_FREE_BYTES, STORAGE_MAX_JOB_AGE)
+        # Open video-option and YouTube-quality prompts by token, persisted so they survive
+        # restarts; the files they still need are kept out of the sweep
+        self.pending = PendingStore(PENDING_DB)
+        self.restore_pending()
+        removed = self.storage.sweep(PARTIAL_DIR, PARTIAL_MAX_AGE)
+        if removed:
+            print(f"🧹 Removed {removed} leftover job files from {STORAGE_DIR}")
+        # Identical requests running at the same time share one job
+        self.single_flight = SingleFlight()
+        # One task renders all progress messages, so transfers never wait on edit_text
+        self.progress = ProgressRenderer(PROGRESS_INTERVAL, PROGRESS_GROUP_INTERVAL, PROGRESS_GLOBAL_RATE)
+        # Downloads hand their file writes to one writer thread with a pool of reusable buffers
+        self.disk_writer = DiskWriter(DISK_WRITE_BUFFER_SIZE, DISK_WRITE_BUFFERS)
+        # Token buckets for download/upload bandwidth, overall and per user
+        self.shaper = BandwidthShaper(
+            {
+                "download": (DOWNLOAD_RATE_LIMIT, DOWNLOAD_RATE_LIMIT_PER_USER),
+                "upload": (UPLOAD_RATE_LIMIT, UPLOAD_RATE_LIMIT_PER_USER),
+            },
+            free_bytes=RATE_LIMIT_FREE_BYTES,
+        )
+        # Latency/error stats and circuit breakers for the Piped and Invidious instances
+        self.instances = InstanceHealth(
+            {"piped": PIPED_INSTANCES, "invidious": INVIDIOUS_INSTANCES},
+            failure_threshold=INSTANCE_FAILURE_THRESHOLD,
+            open_seconds=INSTANCE_OPEN_SECONDS,
+            probe_interval=INSTANCE_PROBE_INTERVAL,
+        )
+        # Invidious stream maps by video ID, kept until their signed URLs expire
+        self.inv_lookups = ExpiringCache()
+        # Piped stream maps by video ID, likewise
+        self.piped_lookups = ExpiringCache()
+        # yt-dlp info dicts by video ID, shared by every user asking for the same video
+        self.ytdl_infos = ExpiringCache(max_entries=64)
+        # Last YouTube quality each user picked, to guess what to prefetch next time
+        self.quality_choices = ExpiringCache(max_entries=YT_PREFETCH_MAX_USERS)
+        # yt-dlp runs in warm worker processes, away from the event loop's GIL
+        self.ytdl_pool = YtdlPool(YTDLP_WORKERS)
+        # ffmpeg jobs share a bounded pool (sized to the cores) and run niced with capped threads
+        self.ffmpeg = FfmpegPool(FFMPEG_WORKERS, FFMPEG_THREADS, FFMPEG_NICE, FFMPEG_TIMEOUT)
+        # token -> running 16:9 conversion, for its cancel button
+        self.conversions = {}
+        # Limits on concurrent jobs (overall / per user / per host) with a fair, bounded queue
+        self.scheduler = JobScheduler(MAX_CONCURRENT_JOBS, MAX_JOBS_PER_USER, MAX_JOBS_PER_HOST, MAX_QUEUED_JOBS, MAX_QUEUED_JOBS_PER_USER)
+        # token -> live work started for an open prompt (never persisted)
+        self.prefetches = {}
+        self.pretranscodes = {}
         self.setup_handlers()
     
     def setup_handlers(self):
@@ -114,6 +285,7 @@ class TelegramDownloadBot:
         self.app.add_handler(CallbackQueryHandler(self.on_video_option, pattern=r"^videoopt:"))
         # Callback handler for YouTube quality selection
         self.app.add_handler(CallbackQueryHandler(self.on_ytdl_option, pattern=r"^ytdl:"))
+        self.app.add_handler(CallbackQueryHandler(self.on_conversion_cancel, pattern=r"^ffcancel:"))
         self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_link))
         # Centralized error handler (e.g., for 409 Conflict)
         self.app.add_error_handler(self.error_handler)
@@ -215,26 +387,68 @@ https://example.com/image.jpg
         # Send processing message
         print(f"⏳ Starting download process for {user.first_name}")
         processing_msg = await update.message.reply_text("⏳ در حال دانلود فایل...")
+        workspace = None
         
         try:
+            # Non-video files delivered before are re-sent by file_id (videos still get the options prompt)
+            hit = self.file_ids.get("url", url) if self.file_ids else None
+            if hit and hit[1] != "video" and await self.send_cached(update, [("url", url)]):
+                try:
+                    await processing_msg.delete()
+                except:
+                    pass
+                return
             # If it's a YouTube link, normalize and offer quality options first
             if self.is_youtube_url(url):
                 url_norm = self.normalize_youtube_url(url)
                 await self.offer_ytdl_options(update, context, processing_msg, url_norm, user.first_name)
                 return
-            # Download the file with progress
+            # Opt-in: pipe non-video files straight from the download into the upload
+            probe = None
+            if STREAM_UPLOADS:
+                async with self.single_flight.join(
+                    ("stream", self.normalize_url(url)),
+                    lambda progress: self.run_scheduled(
+                        user.id, self.url_host(url), progress,
+                        lambda: self.stream_link_to_chat(update, context, progress, url, user.first_name),
+                    ),
+                    processing_msg,
+                ) as ((streamed, probe), is_leader):
+                    pass
+                if streamed and (is_leader or await self.send_cached(update, [("url", url)])):
+                    try:
+                        await processing_msg.delete()
+                    except:
+                        pass
+                    return
+            # Download the file with progress; identical links requested at the same time share one download
             print(f"📥 Downloading file from: {url}")
-            file_path, filename, file_size = await self.download_file(url, processing_msg, user.first_name)
+            workspace = self.storage.create_workspace()
+            async with self.single_flight.join(
+                ("url", self.normalize_url(url)),
+                lambda progress: self.run_scheduled(
+                    user.id, self.url_host(url), progress,
+                    # The streaming attempt's probe is reused instead of probing the link again
+                    lambda: self.download_file(url, progress, user.first_name, user.id, probe),
+                ),
+                processing_msg,
+                release=lambda shared: self.remove_file(shared[0]),
+            ) as (shared, _):
+                # Every requester gets its own link to the file in its own workspace
+                file_path = self.claim_shared_file(shared[0], shared[1], workspace)
+            _, filename, file_size, sha256 = shared
             print(f"✅ File downloaded successfully: {filename} ({self.format_file_size(file_size)})")
             
             # If it's a video, offer options before upload (valid for 1 hour)
             if self.is_video_file(filename):
-                await self.offer_video_options(update, context, processing_msg, file_path, filename, file_size, user.first_name)
+                await self.offer_video_options(update, context, processing_msg, file_path, filename, file_size, user.first_name, [("sha", sha256)])
                 return
             
             # Otherwise, upload immediately
             print(f"📤 Uploading file to Telegram for {user.first_name}")
-            await self.upload_with_progress(update, context, processing_msg, file_path, filename, file_size, user.first_name)
+            cache_keys = [("url", url), ("sha", sha256)]
+            async with self.scheduler.slot(user.id, None, self.queue_notice(processing_msg), bounded=False):
+                await self.upload_with_progress(update, context, processing_msg, file_path, filename, file_size, user.first_name, cache_keys)
             print(f"✅ File successfully sent to {user.first_name}: {filename}")
             try:
                 await processing_msg.delete()
@@ -244,10 +458,73 @@ https://example.com/image.jpg
             print(f"🗑️ Scheduled file cleanup in 20 seconds: {filename}")
             asyncio.create_task(self.delayed_file_cleanup(file_path, 20))
             
+        except SchedulerFull as e:
+            print(f"🚦 Rejected request from {user.first_name}: queue is full")
+            if workspace:
+                workspace.release()
+            await processing_msg.edit_text(f"🚦 {e}")
         except Exception as e:
             print(f"❌ Error processing request from {user.first_name}: {str(e)}")
+            if workspace:
+                workspace.release()
             await processing_msg.edit_text(f"❌ خطا در دانلود فایل: {str(e)}")
     
+    def url_host(self, url: str) -> str:
+        try:
+            return (urlparse(url).hostname or "").lower()
+        except Exception:
+            return ""
+
+    def queue_notice(self, progress_msg):
+        """Return an async callback(position, eta) that shows the job's place in the queue"""
+        async def notice(position: int, eta: float):
+            if not progress_msg:
+                return
+            minutes = max(1, round(eta / 60))
+            await progress_msg.edit_text(
+                f"⏳ سرور مشغول است و درخواست شما در صف قرار گرفت.\n\n"
+                f"🔢 نوبت شما: {position}\n"
+                f"⏱️ زمان تقریبی شروع: حدود {minutes} دقیقه"
+            )
+        return notice
+
+    async def run_scheduled(self, user_id, host, progress_msg, func, bounded: bool = True):
+        """Run func() once the scheduler grants a job slot; raises SchedulerFull when the queue is full"""
+        async with self.scheduler.slot(user_id, host, self.queue_notice(progress_msg), bounded=bounded):
+            return await func()
+
+    def normalize_url(self, url: str) -> str:
+        """Canonical form of a URL for matching identical requests (case-insensitive host, no fragment)"""
+        parsed = urlparse(url.strip())
+        return parsed._replace(scheme=parsed.scheme.lower(), netloc=parsed.netloc.lower(), fragment="").geturl()
+
+    def claim_shared_file(self, shared_path: str, filename: str, workspace) -> str:
+        """Give a requester its own hard link (or copy) of a file produced by a shared job"""
+        own_path = workspace.file(filename)
+        # Already admitted by the shared download, so account for the space without waiting
+        workspace.reserve_now(os.path.getsize(shared_path))
+        link_or_copy(shared_path, own_path)
+        return own_path
+
+    def remove_file(self, file_path: str):
+        """Delete a job file; files inside a workspace release the whole workspace and its reservation"""
+        try:
+            workspace = self.storage.workspace_of(file_path)
+            if workspace:
+                workspace.release()
+            elif os.path.exists(file_path):
+                os.unlink(file_path)
+        except Exception as e:
+            print(f"Error deleting file {file_path}: {str(e)}")
+
+    async def reserve_space(self, workspace, nbytes: int, progress_msg=None):
+        """Reserve disk space for a job, telling the user while it waits for room"""
+        async def on_wait():
+            print(f"💾 Waiting for {self.format_file_size(nbytes)} of disk space")
+            if progress_msg:
+                await progress_msg.edit_text("💾 فضای دیسک سرور پر است. درخواست شما در صف قرار گرفت و به‌زودی شروع می‌شود…")
+        await workspace.reserve(nbytes, on_wait)
+
     def is_valid_url(self, url: str) -> bool:
         """Check if the provided string is a valid URL"""
         try:
@@ -256,12 +533,152 @@ https://example.com/image.jpg
         except:
             return False
     
-    async def download_file(self, url: str, progress_msg=None, user_name: str = "") -> tuple:
-        """Download file from URL with progress tracking"""
-        # Configure session with no size limits
-        timeout = aiohttp.ClientTimeout(total=None, connect=30)
-        connector = aiohttp.TCPConnector(limit=0, limit_per_host=0)
-        # Browser-like headers help some CDNs (e.g., mediafire) serve the real file instead of an HTML page
+    def make_progress_cb(self, progress_msg, user_name: str = "", action: str = "📥 دانلود"):
+        """Return an async callback(done, total) for progress_msg; the progress renderer does the edits.
+        Await close() on it before editing or deleting progress_msg yourself.
+        """
+        state = {"last_log": 0}
+
+        def render(done: int, total: int, elapsed: float) -> tuple:
+            speed = done / elapsed if elapsed > 0 else 0
+            percentage = (done / total) * 100
+            if user_name and time.time() - state["last_log"] >= 2:
+                state["last_log"] = time.time()
+                print(f"📊 {action} progress for {user_name}: {percentage:.1f}% - {self.format_speed(speed)}")
+            filled = int(10 * percentage / 100)
+            line = (
+                f"{action}: {'█' * filled}{'░' * (10 - filled)} {percentage:.0f}%\n"
+                f"    {self.format_file_size(done)} / {self.format_file_size(total)} • {self.format_speed(speed)}"
+            )
+            return self.create_progress_text(action, percentage, speed, done, total), line
+
+        return self.progress.job(progress_msg, render)
+
+    def make_ffmpeg_progress_cb(self, progress_msg, action: str = "🎞️ تبدیل", reply_markup=None):
+        """Like make_progress_cb for ffmpeg jobs: done/total are milliseconds of media, shown
+        with the estimated time left."""
+        def render(done: int, total: int, elapsed: float) -> tuple:
+            percentage = min(100.0, (done / total) * 100)
+            eta = elapsed * (total - done) / done if done > 0 else 0
+            bar = "█" * int(20 * percentage / 100) + "░" * (20 - int(20 * percentage / 100))
+            text = (
+                f"{action} در حال انجام...\n\n"
+                f"{bar} {percentage:.1f}%\n\n"
+                f"⏱️ {self.format_duration(done / 1000)} / {self.format_duration(total / 1000)}\n"
+                f"⌛ زمان باقی‌مانده: حدود {self.format_duration(eta)}\n\n"
+                f"لطفاً صبر کنید..."
+            )
+            line = f"{action}: {bar[::2]} {percentage:.0f}% • ⌛ {self.format_duration(eta)}"
+            return text, line
+
+        return self.progress.job(progress_msg, render, reply_markup)
+
+    async def run_ffmpeg(self, args: list, progress_msg=None, action: str = "🎞️ تبدیل", reply_markup=None, **kwargs):
+        """Run an ffmpeg job through the pool, showing its progress on progress_msg."""
+        if progress_msg is None:
+            return await self.ffmpeg.run(args, **kwargs)
+        report = self.make_ffmpeg_progress_cb(progress_msg, action, reply_markup)
+
+        async def on_progress(seconds: float, duration: float, speed: float):
+            await report(int(seconds * 1000), int(duration * 1000))
+
+        try:
+            return await self.ffmpeg.run(args, on_progress=on_progress, **kwargs)
+        finally:
+            await report.close()
+
+    def can_segment(self, response, total_size: int) -> bool:
+        """Check whether a response is worth splitting into parallel Range requests"""
+        return SEGMENTED_DOWNLOADS and total_size >= SEGMENT_MIN_SIZE and accepts_ranges(response)
+
+    async def receive_body(self, session, response, url: str, file_path: str, total_size: int, report, headers=None, user_id=None, probe=None, mirrors=(), throttle=None, resumable: bool = True) -> tuple:
+        """Write the response body to file_path and return (bytes_written, sha256).
+        Data lands in a resumable .part file first; parallel Range requests are used when the
+        server supports them, and dropped connections are retried from the first missing byte.
+        With response=None the probe's result is used and the body is fetched with Range requests.
+        mirrors are other URLs serving the same bytes; segmented downloads pull pieces from them too.
+        throttle replaces the user's normal download throttle; with resumable=False a failed or
+        cancelled download deletes its .part file instead of keeping it for a later resume.
+        """
+        source = response if response is not None else probe
+        partial = PartialFile.open(
+            PARTIAL_DIR, url,
+            etag=source.headers.get('ETag'),
+            last_modified=source.headers.get('Last-Modified'),
+            total_size=total_size,
+        )
+        if partial.completed_bytes():
+            print(f"♻️ Resuming download from {self.format_file_size(partial.completed_bytes())}: {url}")
+        # Reuse the final (post-redirect) URL for every follow-up request
+        final_url = str(source.url)
+        if throttle is None:
+            throttle = self.shaper.throttle("download", user_id)
+        # The .part file holds this job's reserved bytes until it is moved into the workspace
+        workspace = self.storage.workspace_of(file_path)
+        if workspace:
+            workspace.track(partial.part_path)
+        try:
+            if response is None or self.can_segment(response, total_size):
+                if response is not None:
+                    response.release()
+                try:
+                    segmented = SegmentedDownload(
+                        session, final_url, partial,
+                        headers=headers,
+                        min_workers=SEGMENT_MIN_WORKERS,
+                        max_workers=SEGMENT_MAX_WORKERS,
+                        piece_size=SEGMENT_PIECE_SIZE,
+                        progress_cb=report,
+                        retries=DOWNLOAD_RETRIES,
+                        backoff=DOWNLOAD_RETRY_BACKOFF,
+                        throttle=throttle,
+                        disk_writer=self.disk_writer,
+                        mirrors=mirrors,
+                    )
+                    downloaded, sha256 = await segmented.run(), None
+                except RangeNotSupported:
+                    print(f"⚠️ Server ignored Range requests, falling back to a single stream: {final_url}")
+                    partial.reset()
+                    downloaded, sha256 = await self.stream_to_file(session, final_url, partial, None, report, headers, throttle)
+            else:
+                downloaded, sha256 = await self.stream_to_file(session, final_url, partial, response, report, headers, throttle)
+        except BaseException:
+            if resumable:
+                # Keep the .part file and manifest so the next attempt can resume
+                partial.save()
+                partial.release()
+            else:
+                partial.discard()
+            raise
+        finally:
+            if workspace:
+                workspace.untrack(partial.part_path)
+        partial.finish(file_path)
+        if not sha256:
+            # Segmented or resumed bodies arrive out of order, so hash them once they are complete
+            loop = asyncio.get_running_loop()
+            sha256 = await loop.run_in_executor(None, file_sha256, file_path)
+        return downloaded, sha256
+
+    async def stream_to_file(self, session, url: str, partial, response, report, headers=None, throttle=None) -> tuple:
+        """Stream a body into a partial file over a single connection, retrying with Range on drops.
+        Returns (bytes_written, sha256 or None if it could not be hashed on the fly).
+        """
+        stream = StreamDownload(
+            session, url, partial,
+            response=response,
+            headers=headers,
+            progress_cb=report,
+            retries=DOWNLOAD_RETRIES,
+            backoff=DOWNLOAD_RETRY_BACKOFF,
+            throttle=throttle,
+            disk_writer=self.disk_writer,
+        )
+        downloaded = await stream.run()
+        return downloaded, stream.sha256
+
+    def direct_link_headers(self, url: str) -> dict:
+        """Browser-like headers help some CDNs (e.g., mediafire) serve the real file instead of an HTML page"""
         parsed = urlparse(url)
         referer = f"{parsed.scheme}://{parsed.netloc}/" if parsed.scheme and parsed.netloc else None
         headers = {
@@ -272,65 +689,161 @@ https://example.com/image.jpg
         }
         if referer:
             headers["Referer"] = referer
+        return headers
+
+    async def stream_link_to_chat(self, update, context, progress_msg, url: str, user_name: str) -> tuple:
+        """Pipe a non-video file from its URL straight into the Telegram upload, without a temp file.
+        Returns (streamed, probe). The decision is taken from the probe, so a link that is not
+        suitable (unknown size, video, over the Bot API limit) costs no extra request and
+        its probe can be handed to download_file for the download-then-upload fallback.
+        """
+        session = await self.http.get_session()
+        headers = self.direct_link_headers(url)
+        probe = await probe_url(session, url, headers)
+        if not probe.ok:
+            return False, probe
+        filename = self.get_filename_from_response(probe, url)
+        total_size = probe.size
+        size_limit = 2000 * 1024 * 1024 if BOT_API_BASE_URL else 50 * 1024 * 1024
+        if not total_size or total_size > size_limit or self.is_video_file(filename):
+            return False, probe
+        async with session.get(probe.url, headers=headers, allow_redirects=True) as response:
+            if response.status != 200 or int(response.headers.get('content-length', 0) or 0) != total_size:
+                return False, probe
+            method, field = self.upload_method_for(filename, total_size)
+            params = {
+                "chat_id": update.effective_chat.id,
+                "caption": f"✅ فایل با موفقیت دانلود شد!\n📁 نام فایل: {filename}\n📊 حجم: {self.format_file_size(total_size)}",
+                "reply_parameters": {"message_id": update.message.message_id, "allow_sending_without_reply": True},
+            }
+            digest = hashlib.sha256()
+            user_id = update.effective_user.id
+            chunks = buffered_chunks(
+                response, max_chunks=STREAM_BUFFER_CHUNKS, on_chunk=digest.update,
+                throttle=self.shaper.throttle("download", user_id),
+            )
+            report = self.make_progress_cb(progress_msg, user_name, "🔁 دانلود و آپلود همزمان")
+            print(f"🔁 Streaming {filename} ({self.format_file_size(total_size)}) directly into the upload")
+            try:
+                result = await send_file_stream(
+                    session, method, field, filename, total_size, chunks, params,
+                    content_type=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+                    progress_cb=report,
+                    throttle=self.shaper.throttle("upload", user_id),
+                )
+            except Exception as e:
+                print(f"⚠️ Streaming upload failed, falling back to download-then-upload: {e}")
+                return False, probe
+            finally:
+                await report.close()
+        self.remember_delivery(Message.de_json(result, context.bot), [("url", url), ("sha", digest.hexdigest())])
+        return True, probe
+
+    async def download_file(self, url: str, progress_msg=None, user_name: str = "", user_id=None, probe=None) -> tuple:
+        """Download file from URL with progress tracking. Returns (file_path, filename, size, sha256).
+        A probe (HEAD + first 4 KB) runs first, so links that are not really files are rejected
+        before the download starts and the single-stream or segmented strategy is picked up front.
+        probe is one taken moments ago for the same URL, used instead of probing again.
+        """
+        headers = self.direct_link_headers(url)
+        cached = self.download_cache.lookup(url) if self.download_cache else None
         
-        async with aiohttp.ClientSession(timeout=timeout, connector=connector, headers=headers) as session:
-            async with session.get(url, allow_redirects=True) as response:
+        workspace = self.storage.create_workspace()
+        try:
+            session = await self.http.get_session()
+            if probe is None:
+                probe = await probe_url(session, url, headers)
+            if not probe.ok:
+                raise Exception(f"HTTP {probe.status}: نمی‌توان فایل را دانلود کرد")
+            filename = self.get_filename_from_response(probe, url)
+            self.check_probe(probe, filename)
+            print(f"🔎 Probe: {filename} type={probe.kind} size={self.format_file_size(probe.size)} ranges={probe.accepts_ranges}")
+            if cached and self.download_cache.is_current(cached, probe.headers):
+                return await self.materialize_cached(cached, workspace, progress_msg)
+
+            if SEGMENTED_DOWNLOADS and probe.accepts_ranges and probe.size >= SEGMENT_MIN_SIZE:
+                # Ranges are known to work: go straight to parallel Range requests
+                return await self.fetch_to_workspace(session, None, probe, url, filename, workspace, progress_msg, user_name, user_id, headers)
+
+            # If we already have this URL cached, ask the origin whether it changed
+            request_headers = dict(headers)
+            if cached:
+                request_headers.update(self.download_cache.conditional_headers(cached))
+            async with session.get(probe.url, headers=request_headers, allow_redirects=True) as response:
+                if response.status == 304 and cached:
+                    return await self.materialize_cached(cached, workspace, progress_msg)
                 if response.status != 200:
                     raise Exception(f"HTTP {response.status}: نمی‌توان فایل را دانلود کرد")
-                
-                # Get filename and total size
-                filename = self.get_filename_from_response(response, url)
-                total_size = int(response.headers.get('content-length', 0) or 0)
-                content_type = (response.headers.get('content-type') or '').lower()
-                is_video_ext = self.is_video_file(filename)
-                is_binary_ct = any(x in content_type for x in ["video/", "audio/", "image/", "application/octet-stream"]) if content_type else False
-                # If server indicates HTML/text and it's supposed to be a video, abort early
-                if is_video_ext and content_type and ("text/html" in content_type or "text/plain" in content_type):
-                    raise Exception("این لینک مستقیم فایل نیست یا به صفحه هدایت می‌شود. لطفاً لینک دانلود مستقیم را ارسال کنید.")
-                # If declared total size is suspiciously small for a video, abort early
-                if is_video_ext and total_size and total_size < 200 * 1024:  # < 200KB
-                    raise Exception("حجم اعلام‌شده بسیار کم است. لینک مستقیم ویدیو معتبر نیست.")
-                
-                # Create temporary file
-                temp_dir = tempfile.gettempdir()
-                file_path = os.path.join(temp_dir, filename)
-                
-                # Download with progress tracking - no size limits
-                downloaded = 0
-                start_time = time.time()
-                last_update = 0
-                
-                with open(file_path, 'wb') as file:
-                    async for chunk in response.content.iter_chunked(1024 * 1024):  # 1MB chunks for large files
-                        file.write(chunk)
-                        downloaded += len(chunk)
-                        
-                        # Update progress every 2 seconds
-                        current_time = time.time()
-                        if current_time - last_update >= 2 and progress_msg and total_size > 0:
-                            elapsed_time = current_time - start_time
-                            speed = downloaded / elapsed_time if elapsed_time > 0 else 0
-                            percentage = (downloaded / total_size) * 100
-                            
-                            progress_text = self.create_progress_text(
-                                "📥 دانلود", percentage, speed, downloaded, total_size
-                            )
-                            
-                            try:
-                                await progress_msg.edit_text(progress_text)
-                                last_update = current_time
-                                print(f"📊 Download progress for {user_name}: {percentage:.1f}% - {self.format_speed(speed)}")
-                            except:
-                                pass  # Ignore edit errors
-                
-                # Final sanity check: if extension says video but downloaded size is too small, treat as invalid
-                if is_video_ext and downloaded < 200 * 1024:
-                    try:
-                        os.unlink(file_path)
-                    except Exception:
-                        pass
-                    raise Exception("فایل دریافتی ویدیو نیست یا ناقص است (حجم بسیار کم). احتمالاً لینک مستقیم نیست.")
-                return file_path, filename, downloaded
+                return await self.fetch_to_workspace(session, response, probe, url, filename, workspace, progress_msg, user_name, user_id, headers)
+        except BaseException:
+            workspace.release()
+            raise
+
+    def check_probe(self, probe, filename: str):
+        """Reject links whose first bytes or declared size show they are not the file they claim to be"""
+        is_video_ext = self.is_video_file(filename)
+        content_type = (probe.headers.get('Content-Type') or '').lower()
+        # An HTML page (login wall, error page, download landing page) instead of the file
+        if probe.kind == "html" and not filename.lower().endswith(('.htm', '.html')):
+            raise Exception("این لینک مستقیم فایل نیست یا به صفحه هدایت می‌شود. لطفاً لینک دانلود مستقیم را ارسال کنید.")
+        if is_video_ext and probe.kind == "unknown" and ("text/html" in content_type or "text/plain" in content_type):
+            raise Exception("این لینک مستقیم فایل نیست یا به صفحه هدایت می‌شود. لطفاً لینک دانلود مستقیم را ارسال کنید.")
+        # A recognised non-video file (archive, document, image, audio) behind a video file name
+        if is_video_ext and probe.kind in NON_VIDEO_KINDS:
+            raise Exception(f"فایل این لینک ویدیو نیست (نوع شناسایی‌شده: {probe.kind}).")
+        # If declared total size is suspiciously small for a video, abort early
+        if is_video_ext and probe.size and probe.size < 200 * 1024:  # < 200KB
+            raise Exception("حجم اعلام‌شده بسیار کم است. لینک مستقیم ویدیو معتبر نیست.")
+
+    async def materialize_cached(self, cached: dict, workspace, progress_msg=None) -> tuple:
+        """Copy (hard link) a still-valid download cache entry into the job's workspace"""
+        await self.reserve_space(workspace, cached["size"], progress_msg)
+        file_path = workspace.file(cached["filename"])
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.download_cache.materialize, cached, file_path)
+        print(f"⚡ Served from download cache (not modified): {cached['filename']}")
+        return file_path, cached["filename"], cached["size"], cached["sha256"]
+
+    async def fetch_to_workspace(self, session, response, probe, url: str, filename: str, workspace, progress_msg, user_name: str, user_id, headers) -> tuple:
+        """Download the body (from response, or with Range requests when it is None) into the workspace"""
+        source = response if response is not None else probe
+        total_size = int(source.headers.get('Content-Length', 0) or 0) if response is not None else probe.size
+        # Reserve the space up front (waits while the volume is full), then write into the job's workspace.
+        # Without a size, reserve an estimate and grow the reservation if the body outgrows it.
+        reserved = total_size or STORAGE_UNKNOWN_SIZE_BYTES
+        await self.reserve_space(workspace, reserved, progress_msg)
+        file_path = workspace.file(filename)
+
+        # Download with progress tracking - no size limits
+        report = self.make_progress_cb(progress_msg, user_name)
+
+        async def on_progress(done: int, total: int):
+            nonlocal reserved
+            if done > reserved:
+                workspace.reserve_now(done - reserved)
+                reserved = done
+            await report(done, total)
+
+        try:
+            downloaded, sha256 = await self.receive_body(
+                session, response, url, file_path, total_size, report if total_size else on_progress, headers, user_id, probe,
+            )
+        finally:
+            await report.close()
+
+        # Final sanity check: if extension says video but downloaded size is too small, treat as invalid
+        if self.is_video_file(filename) and downloaded < 200 * 1024:
+            raise Exception("فایل دریافتی ویدیو نیست یا ناقص است (حجم بسیار کم). احتمالاً لینک مستقیم نیست.")
+        if self.download_cache:
+            try:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(
+                    None, self.download_cache.store, url, file_path, sha256, filename,
+                    source.headers.get('ETag'), source.headers.get('Last-Modified'),
+                )
+            except Exception as e:
+                print(f"⚠️ Could not add file to download cache: {e}")
+        return file_path, filename, downloaded, sha256
     
     def get_filename_from_response(self, response, url: str) -> str:
         """Extract filename from response headers or URL"""
@@ -410,6 +923,13 @@ https://example.com/image.jpg
 
 لطفاً صبر کنید..."""
     
+    def format_duration(self, seconds: float) -> str:
+        """Format seconds as M:SS or H:MM:SS"""
+        seconds = int(max(0, seconds))
+        h, rest = divmod(seconds, 3600)
+        m, sec = divmod(rest, 60)
+        return f"{h}:{m:02d}:{sec:02d}" if h else f"{m}:{sec:02d}"
+
     def format_speed(self, bytes_per_second: float) -> str:
         """Format speed in human readable format"""
         if bytes_per_second == 0:
@@ -424,8 +944,13 @@ https://example.com/image.jpg
         s = round(bytes_per_second / p, 1)
         return f"{s} {speed_names[i]}"
     
-    async def upload_with_progress(self, update, context, progress_msg, file_path: str, filename: str, file_size: int, user_name: str):
-        """Upload file with progress tracking"""
+    async def upload_with_progress(self, update, context, progress_msg, file_path: str, filename: str, file_size: int, user_name: str, cache_keys=()):
+        """Upload file with progress tracking.
+        cache_keys are (kind, key) pairs the delivered file_id is remembered under; if one of them
+        is already known, the file is re-sent by file_id and nothing is uploaded.
+        """
+        if await self.send_cached(update, cache_keys, filename, file_size):
+            return
         start_time = time.time()
         
         # Show initial upload message
@@ -463,68 +988,151 @@ https://example.com/image.jpg
                 )
                 # continue to direct upload fallback
 
-        # Note: To avoid truncated uploads, we stream the real file handle via InputFile
-        # and let HTTPX handle chunking. This prevents calling read(-1) on a wrapper.
-        
-        # Upload the file based on its type with fallback for large files
+        # Upload the file based on its type with fallback for large files.
+        # The body is streamed from a thread-pool reader, so other chats keep being served
+        # and the progress bar follows the bytes actually sent.
         caption = f"✅ فایل با موفقیت دانلود شد!\n📁 نام فایل: {filename}\n📊 حجم: {self.format_file_size(file_size)}"
+        method, field = self.upload_method_for(filename, file_size)
+        params = {
+            "chat_id": update.effective_chat.id,
+            "caption": caption,
+            "reply_parameters": {"message_id": update.message.message_id, "allow_sending_without_reply": True},
+        }
+        if field == "video":
+            params["supports_streaming"] = True
+        session = await self.http.get_session()
+        report = self.make_progress_cb(progress_msg, user_name, "📤 آپلود")
+        result = None
         try:
-            with open(file_path, 'rb') as file:
-                media_file = InputFile(file, filename=filename, read_file_handle=False)
-                if self.is_video_file(filename):
-                    await update.message.reply_video(
-                        video=media_file,
-                        caption=caption,
-                        supports_streaming=True
-                    )
-                elif self.is_audio_file(filename):
-                    await update.message.reply_audio(
-                        audio=media_file,
-                        caption=caption
-                    )
-                elif self.is_photo_file(filename):
-                    await update.message.reply_photo(
-                        photo=media_file,
-                        caption=caption
+            try:
+                result = await self.send_local_file(session, method, field, file_path, filename, file_size, params, report, update.effective_user.id)
+            except Exception as e:
+                # If sending as media fails (413 error), fallback to document
+                if field == "document" or not ("413" in str(e) or "Request Entity Too Large" in str(e)):
+                    raise e
+                print(f"⚠️ Media upload failed due to size limit, falling back to document: {filename}")
+                params.pop("supports_streaming", None)
+                params["caption"] = f"📄 فایل به صورت سند ارسال شد (حجم بزرگ)\n📁 نام فایل: {filename}\n📊 حجم: {self.format_file_size(file_size)}"
+                await report.close()
+                report = self.make_progress_cb(progress_msg, user_name, "📤 آپلود")
+                result = await self.send_local_file(session, "sendDocument", "document", file_path, filename, file_size, params, report, update.effective_user.id)
+        except Exception as e:
+            if "413" in str(e) or "Request Entity Too Large" in str(e):
+                if not BOT_API_BASE_URL:
+                    await update.message.reply_text(
+                        "⚠️ محدودیت 50MB در Bot API ابری. برای ارسال فایل‌های بزرگ (تا 2GB) باید Local Bot API Server را راه‌اندازی کنید و متغیرهای BOT_API_BASE_URL و BOT_API_BASE_FILE_URL را تنظیم کنید."
                     )
                 else:
-                    await update.message.reply_document(
-                        document=media_file,
-                        caption=caption
+                    await update.message.reply_text(
+                        "⚠️ ارسال فایل در حالت Local Bot API هم ناموفق بود. لطفاً پیکربندی سرور Local Bot API را بررسی کنید."
                     )
-        except Exception as e:
-            # If sending as media fails (413 error), fallback to document
-            if "413" in str(e) or "Request Entity Too Large" in str(e):
-                print(f"⚠️ Media upload failed due to size limit, falling back to document: {filename}")
-                try:
-                    with open(file_path, 'rb') as file:
-                        await update.message.reply_document(
-                            document=InputFile(file, filename=filename, read_file_handle=False),
-                            caption=f"📄 فایل به صورت سند ارسال شد (حجم بزرگ)\n📁 نام فایل: {filename}\n📊 حجم: {self.format_file_size(file_size)}"
-                        )
-                except Exception as e2:
-                    if "413" in str(e2) or "Request Entity Too Large" in str(e2):
-                        if not BOT_API_BASE_URL:
-                            await update.message.reply_text(
-                                "⚠️ محدودیت 50MB در Bot API ابری. برای ارسال فایل‌های بزرگ (تا 2GB) باید Local Bot API Server را راه‌اندازی کنید و متغیرهای BOT_API_BASE_URL و BOT_API_BASE_FILE_URL را تنظیم کنید."
-                            )
-                        else:
-                            await update.message.reply_text(
-                                "⚠️ ارسال فایل در حالت Local Bot API هم ناموفق بود. لطفاً پیکربندی سرور Local Bot API را بررسی کنید."
-                            )
-                    else:
-                        raise e2
             else:
                 raise e
+        finally:
+            await report.close()
+        sent = Message.de_json(result, context.bot) if result else None
+        self.remember_delivery(sent, cache_keys)
+
+    def upload_method_for(self, filename: str, file_size: int) -> tuple:
+        """Bot API (method, file field) used to send a file of this name and size"""
+        if self.is_video_file(filename):
+            return "sendVideo", "video"
+        if self.is_audio_file(filename):
+            return "sendAudio", "audio"
+        if self.is_photo_file(filename) and file_size <= 10 * 1024 * 1024:
+            return "sendPhoto", "photo"
+        return "sendDocument", "document"
+
+    async def send_local_file(self, session, method: str, field: str, file_path: str, filename: str, file_size: int, params: dict, report, user_id=None) -> dict:
+        """Upload a file from disk through the Bot API, reading it off the event loop"""
+        return await send_file_stream(
+            session, method, field, filename, file_size, file_chunks(file_path), params,
+            content_type=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+            progress_cb=report,
+            throttle=self.shaper.throttle("upload", user_id),
+        )
+
+    async def send_cached(self, update, cache_keys, filename: str = "", file_size: int = 0) -> bool:
+        """Re-send a file Telegram already has, by file_id. Returns True if it was delivered."""
+        if not self.file_ids or not cache_keys:
+            return False
+        hit = self.file_ids.lookup(cache_keys)
+        if not hit:
+            return False
+        file_id, media_type = hit
+        caption = "✅ فایل ارسال شد (از حافظه ربات)"
+        if filename:
+            caption += f"\n📁 نام فایل: {filename}"
+        if file_size:
+            caption += f"\n📊 حجم: {self.format_file_size(file_size)}"
+        try:
+            if media_type == "video":
+                await update.message.reply_video(video=file_id, caption=caption, supports_streaming=True)
+            elif media_type == "animation":
+                await update.message.reply_animation(animation=file_id, caption=caption)
+            elif media_type == "audio":
+                await update.message.reply_audio(audio=file_id, caption=caption)
+            elif media_type == "photo":
+                await update.message.reply_photo(photo=file_id, caption=caption)
+            else:
+                await update.message.reply_document(document=file_id, caption=caption)
+        except BadRequest as e:
+            if not self.is_file_id_error(e):
+                # Nothing wrong with the file_id (e.g. the message to reply to is gone): keep it
+                print(f"⚠️ Sending cached file_id failed, uploading again: {e}")
+                return False
+            print(f"⚠️ Cached file_id rejected, uploading again: {e}")
+            self.file_ids.forget(file_id)
+            return False
+        print(f"⚡ Sent from file_id cache: {filename or file_id}")
+        # Remember the file under keys that were not known yet (e.g. the URL of a known hash)
+        new_keys = [k for k in cache_keys if not self.file_ids.get(*k)]
+        if new_keys:
+            self.file_ids.put(new_keys, file_id, media_type)
+        return True
+
+    def is_file_id_error(self, error) -> bool:
+        """True if Telegram rejected the file_id itself (unknown, expired or of another type)."""
+        message = str(error).lower()
+        return any(marker in message for marker in (
+            "file identifier", "file_id", "file reference", "file_reference", "type of file mismatch",
+        ))
+
+    def remember_delivery(self, message, cache_keys):
+        """Store the file_id of a sent message under each cache key."""
+        if not self.file_ids or not message or not cache_keys:
+            return
+        if message.video:
+            file_id, media_type = message.video.file_id, "video"
+        elif message.animation:
+            file_id, media_type = message.animation.file_id, "animation"
+        elif message.audio:
+            file_id, media_type = message.audio.file_id, "audio"
+        elif message.photo:
+            file_id, media_type = message.photo[-1].file_id, "photo"
+        elif message.document:
+            file_id, media_type = message.document.file_id, "document"
+        else:
+            return
+        try:
+            self.file_ids.put(cache_keys, file_id, media_type)
+        except Exception as e:
+            print(f"⚠️ Could not record file_id: {e}")
     
 
 
+    async def sweep_storage(self, context: ContextTypes.DEFAULT_TYPE):
+        """Periodic job: drop orphaned workspaces and stale partial downloads"""
+        removed = self.storage.sweep(PARTIAL_DIR, PARTIAL_MAX_AGE)
+        if removed:
+            print(f"🧹 Storage sweep removed {removed} items")
+
     async def delayed_file_cleanup(self, file_path: str, delay_seconds: int):
         """Delete file after specified delay"""
         try:
             await asyncio.sleep(delay_seconds)
             if os.path.exists(file_path):
-                os.unlink(file_path)
+                self.remove_file(file_path)
                 print(f"File deleted after {delay_seconds} seconds: {file_path}")
         except Exception as e:
             print(f"Error deleting file {file_path}: {str(e)}")
@@ -537,7 +1145,7 @@ https://example.com/image.jpg
         self.app.run_polling(drop_pending_updates=True)
 
     # ===================== New: Video post-download options =====================
-    async def offer_video_options(self, update: Update, context: ContextTypes.DEFAULT_TYPE, processing_msg, file_path: str, filename: str, file_size: int, user_name: str):
+    async def offer_video_options(self, update: Update, context: ContextTypes.DEFAULT_TYPE, processing_msg, file_path: str, filename: str, file_size: int, user_name: str, cache_keys=()):
         """Offer user to choose how to send the downloaded video: cancel, original, or 16:9.
         Gives the user up to 60 minutes to choose. If no choice is made, defaults to Original.
         """
@@ -558,24 +1166,20 @@ https://example.com/image.jpg
         except Exception:
             pass
 
-        # Schedule timeout (60 minutes) if JobQueue is available
-        job = None
-        if getattr(context, "job_queue", None):
-            job = context.job_queue.run_once(self.video_choice_timeout, when=60*60, data=token)
-        else:
-            print("⚠️ JobQueue not available. Install python-telegram-bot[job-queue] to enable auto-timeout. Buttons will stay active without timeout.")
-        self.pending_videos[token] = {
-            "file_path": file_path,
-            "filename": filename,
-            "file_size": file_size,
-            "user_id": update.effective_user.id,
-            "user_name": user_name,
-            "chat_id": update.effective_chat.id,
-            "progress_msg": processing_msg,
-            "update": update,
-            "job": job,
-        }
+        # Kept on disk (survives restarts); the pending store's timer handles the 60 minute timeout
+        record = self.pending.add(
+            token, "video", update.effective_chat.id, processing_msg.message_id, update.effective_user.id, file_path,
+            {
+                "filename": filename,
+                "file_size": file_size,
+                "user_name": user_name,
+                "reply_to": update.effective_message.message_id,
+                "cache_keys": [list(k) for k in cache_keys],
+            },
+            ttl=60 * 60,
+        )
         print(f"⏳ Waiting for user choice (up to 60 min): {filename} | token={token}")
+        self.start_pretranscode(record)
 
     async def on_video_option(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle inline button selection for video options."""
@@ -586,8 +1190,8 @@ https://example.com/image.jpg
             _, action, token = data.split(":", 2)
         except ValueError:
             return
-        meta = self.pending_videos.get(token)
-        if not meta:
+        record = self.pending.get(token)
+        if not record:
             # Already handled or expired
             try:
                 await query.edit_message_text("⏱️ مهلت انتخاب به پایان رسید یا قبلاً پردازش شده است.")
@@ -596,37 +1200,42 @@ https://example.com/image.jpg
             return
 
         # Only the original requester can interact
-        if update.effective_user.id != meta["user_id"]:
+        if update.effective_user.id != record.user_id:
             await query.answer("این گزینه مربوط به فایل شما نیست.", show_alert=True)
             return
 
-        # Consume and cancel timeout once a valid user acts
-        self.pending_videos.pop(token, None)
-        try:
-            meta["job"].schedule_removal()
-        except Exception:
-            pass
+        # Consume the prompt (its expiry is dropped with it) once a valid user acts
+        self.pending.pop(token)
 
-        file_path = meta["file_path"]
-        filename = meta["filename"]
-        file_size = meta["file_size"]
-        progress_msg = meta["progress_msg"]
-        orig_update = meta["update"]
-        user_name = meta["user_name"]
+        file_path = record.file_path
+        filename = record.options["filename"]
+        file_size = record.options["file_size"]
+        progress_msg = self.prompt_message(context.bot, record)
+        orig_update = self.prompt_update(context.bot, record)
+        user_name = record.options.get("user_name", "")
+        cache_keys = [tuple(k) for k in record.options.get("cache_keys", ())]
 
         # Remove buttons to avoid double taps
         try:
-            await context.bot.edit_message_reply_markup(chat_id=meta["chat_id"], message_id=progress_msg.message_id, reply_markup=None)
+            await context.bot.edit_message_reply_markup(chat_id=record.chat_id, message_id=record.message_id, reply_markup=None)
         except Exception:
             pass
 
-        if action == "cancel":
-            # Delete file and inform user
+        pretranscode = self.pretranscodes.pop(token, None)
+        if not os.path.exists(file_path):
+            await self.stop_pretranscode(pretranscode)
             try:
-                if os.path.exists(file_path):
-                    os.unlink(file_path)
+                await progress_msg.edit_text("⚠️ فایل دیگر روی سرور موجود نیست. لطفاً دوباره ارسال کنید.")
             except Exception:
                 pass
+            return
+        if action != "169":
+            # Stop the background conversion before its output or the source goes away
+            await self.stop_pretranscode(pretranscode)
+
+        if action == "cancel":
+            # Delete file and inform user
+            self.remove_file(file_path)
             try:
                 await progress_msg.edit_text("❌ عملیات لغو شد و فایل از سرور حذف شد.")
             except Exception:
@@ -634,90 +1243,133 @@ https://example.com/image.jpg
             print(f"🗑️ User canceled and file deleted: {filename}")
             return
 
-        if action == "orig":
-            try:
-                await progress_msg.edit_text("📤 در حال آپلود با سایز اصلی …")
-            except Exception:
-                pass
-            await self.upload_with_progress(orig_update, context, progress_msg, file_path, filename, file_size, user_name)
-            try:
-                await progress_msg.delete()
-            except Exception:
-                pass
-            asyncio.create_task(self.delayed_file_cleanup(file_path, 20))
-            print(f"✅ Original video sent: {filename}")
-            return
+        # Uploading and converting are jobs too: wait for a slot (already admitted, so never rejected)
+        async with self.scheduler.slot(record.user_id, None, self.queue_notice(progress_msg), bounded=False):
+            if action == "orig":
+                try:
+                    await progress_msg.edit_text("📤 در حال آپلود با سایز اصلی …")
+                except Exception:
+                    pass
+                await self.upload_with_progress(orig_update, context, progress_msg, file_path, filename, file_size, user_name, cache_keys)
+                try:
+                    await progress_msg.delete()
+                except Exception:
+                    pass
+                asyncio.create_task(self.delayed_file_cleanup(file_path, 20))
+                print(f"✅ Original video sent: {filename}")
+                return
 
-        if action == "169":
-            try:
-                await progress_msg.edit_text("🎞️ در حال تبدیل ویدیو به نسبت 16:9 … ممکن است چند دقیقه طول بکشد…")
-            except Exception:
-                pass
-            try:
-                out_path, out_name, out_size = await self.ffmpeg_convert_to_16_9(file_path, filename)
-            except Exception as e:
-                print(f"❌ FFmpeg error: {e}")
+            if action == "169":
+                cancel_markup = InlineKeyboardMarkup([[InlineKeyboardButton("❌ لغو تبدیل", callback_data=f"ffcancel:{token}")]])
+                try:
+                    await progress_msg.edit_text("🎞️ در حال تبدیل ویدیو به نسبت 16:9 … ممکن است چند دقیقه طول بکشد…", reply_markup=cancel_markup)
+                except Exception:
+                    pass
+                if pretranscode:
+                    convert = self.adopt_pretranscode(pretranscode, file_path, filename, progress_msg, cancel_markup)
+                else:
+                    convert = self.ffmpeg_convert_to_16_9(file_path, filename, progress_msg, cancel_markup)
+                conversion = {
+                    "user_id": record.user_id,
+                    "cancelled": False,
+                    "task": asyncio.create_task(convert),
+                }
+                self.conversions[token] = conversion
+                try:
+                    out_path, out_name, out_size = await conversion["task"]
+                except asyncio.CancelledError:
+                    if not conversion["cancelled"]:
+                        raise
+                    self.remove_file(file_path)
+                    try:
+                        await progress_msg.edit_text("❌ تبدیل لغو شد و فایل از سرور حذف شد.")
+                    except Exception:
+                        pass
+                    print(f"🗑️ User canceled conversion: {filename}")
+                    return
+                except Exception as e:
+                    print(f"❌ FFmpeg error: {e}")
+                    try:
+                        await progress_msg.edit_text(f"❌ خطا در تبدیل ویدیو: {e}\nارسال نسخه اصلی…")
+                    except Exception:
+                        pass
+                    # Fallback to original
+                    await self.upload_with_progress(orig_update, context, progress_msg, file_path, filename, file_size, user_name, cache_keys)
+                    try:
+                        await progress_msg.delete()
+                    except Exception:
+                        pass
+                    asyncio.create_task(self.delayed_file_cleanup(file_path, 20))
+                    return
+                finally:
+                    self.conversions.pop(token, None)
+
+                # Upload converted
                 try:
-                    await progress_msg.edit_text(f"❌ خطا در تبدیل ویدیو: {e}\nارسال نسخه اصلی…")
+                    await progress_msg.edit_text("📤 در حال آپلود نسخه 16:9 …")
                 except Exception:
                     pass
-                # Fallback to original
-                await self.upload_with_progress(orig_update, context, progress_msg, file_path, filename, file_size, user_name)
+                await self.upload_with_progress(orig_update, context, progress_msg, out_path, out_name, out_size, user_name)
                 try:
                     await progress_msg.delete()
                 except Exception:
                     pass
+                # Schedule cleanup for both files
                 asyncio.create_task(self.delayed_file_cleanup(file_path, 20))
+                asyncio.create_task(self.delayed_file_cleanup(out_path, 20))
+                print(f"✅ 16:9 video sent: {out_name}")
                 return
 
-            # Upload converted
-            try:
-                await progress_msg.edit_text("📤 در حال آپلود نسخه 16:9 …")
-            except Exception:
-                pass
-            await self.upload_with_progress(orig_update, context, progress_msg, out_path, out_name, out_size, user_name)
+    async def video_choice_timeout(self, record, context: ContextTypes.DEFAULT_TYPE):
+        """Called when user didn't choose within 60 minutes: default to Original upload."""
+        await self.stop_pretranscode(self.pretranscodes.pop(record.token, None))
+        file_path = record.file_path
+        filename = record.options["filename"]
+        file_size = record.options["file_size"]
+        progress_msg = self.prompt_message(context.bot, record)
+        orig_update = self.prompt_update(context.bot, record)
+        user_name = record.options.get("user_name", "")
+        if not os.path.exists(file_path):
+            # Deleted while the bot was down
             try:
-                await progress_msg.delete()
+                await progress_msg.edit_text("⌛ مهلت انتخاب به پایان رسید و فایل دیگر روی سرور موجود نیست.")
             except Exception:
                 pass
-            # Schedule cleanup for both files
-            asyncio.create_task(self.delayed_file_cleanup(file_path, 20))
-            asyncio.create_task(self.delayed_file_cleanup(out_path, 20))
-            print(f"✅ 16:9 video sent: {out_name}")
             return
-
-    async def video_choice_timeout(self, context: ContextTypes.DEFAULT_TYPE):
-        """Called when user didn't choose within 60 minutes: default to Original upload."""
-        token = context.job.data
-        meta = self.pending_videos.pop(token, None)
-        if not meta:
-            return
-        file_path = meta["file_path"]
-        filename = meta["filename"]
-        file_size = meta["file_size"]
-        progress_msg = meta["progress_msg"]
-        orig_update = meta["update"]
-        user_name = meta["user_name"]
         try:
             await progress_msg.edit_text("⌛ مهلت انتخاب به پایان رسید. ارسال با سایز اصلی…")
         except Exception:
             pass
-        await self.upload_with_progress(orig_update, context, progress_msg, file_path, filename, file_size, user_name)
+        cache_keys = [tuple(k) for k in record.options.get("cache_keys", ())]
+        async with self.scheduler.slot(record.user_id, None, self.queue_notice(progress_msg), bounded=False):
+            await self.upload_with_progress(orig_update, context, progress_msg, file_path, filename, file_size, user_name, cache_keys)
         try:
             await progress_msg.delete()
         except Exception:
             pass
         asyncio.create_task(self.delayed_file_cleanup(file_path, 20))
 
-    async def ffmpeg_convert_to_16_9(self, src_path: str, filename: str) -> tuple:
-        """Convert video to 16:9 720p by STRETCHING (no black bars). Returns (out_path, out_name, out_size)."""
+    async def ffmpeg_convert_to_16_9(self, src_path: str, filename: str, progress_msg=None, reply_markup=None, **kwargs) -> tuple:
+        """Convert video to 16:9 720p by STRETCHING (no black bars). Returns (out_path, out_name, out_size).
+        kwargs go to FfmpegPool.run; a background=True conversion only starts if there is disk
+        space for it right now (StorageFull otherwise)."""
         base, _ = os.path.splitext(os.path.basename(filename))
         out_name = f"{base}_16x9.mp4"
-        out_path = os.path.join(tempfile.gettempdir(), out_name)
+        # Write next to the source so the output is cleaned up with the job's workspace
+        workspace = self.storage.workspace_of(src_path)
+        reserved = os.path.getsize(src_path)
+        if workspace:
+            if not kwargs.get("background"):
+                workspace.reserve_now(reserved)
+            elif not workspace.try_reserve(reserved):
+                raise StorageFull("no room for a background conversion")
+            out_path = workspace.file(out_name)
+        else:
+            out_path = os.path.join(os.path.dirname(src_path), f"{uuid4().hex[:8]}_{out_name}")
         # Stretch to exactly 1280x720 (no letterbox), set square pixels
         vf = "scale=1280:720,setsar=1"
-        cmd = [
-            "ffmpeg", "-y", "-i", src_path,
+        args = [
+            "-i", src_path,
             "-vf", vf,
             "-c:v", "libx264", "-preset", "veryfast", "-crf", "23",
             "-c:a", "copy",
@@ -725,13 +1377,110 @@ https://example.com/image.jpg
             "-pix_fmt", "yuv420p",
             out_path,
         ]
-        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-        _, err = await proc.communicate()
-        if proc.returncode != 0:
-            raise RuntimeError(err.decode(errors='ignore')[-400:])
+        try:
+            await self.run_ffmpeg(args, progress_msg, "🎞️ تبدیل به 16:9", reply_markup, **kwargs)
+        except BaseException:
+            try:
+                os.remove(out_path)
+            except OSError:
+                pass
+            if workspace:
+                # The output is gone, so is the space it needed (a fallback reserves its own)
+                workspace.unreserve(reserved)
+            raise
         out_size = os.path.getsize(out_path)
         return out_path, out_name, out_size
 
+    def start_pretranscode(self, record):
+        """With VIDEO_PRETRANSCODE, start the 16:9 conversion in the background while the options
+        prompt waits, at the lowest CPU priority, so choosing 16:9 can upload almost at once."""
+        if not VIDEO_PRETRANSCODE:
+            return
+        pretranscode = {"report": None, "proc": None, "src_path": record.file_path, "promoted": asyncio.Event()}
+
+        async def on_progress(seconds: float, duration: float, speed: float):
+            # Silent until adopted; then it drives the progress bar under the prompt
+            if pretranscode["report"]:
+                await pretranscode["report"](int(seconds * 1000), int(duration * 1000))
+
+        def on_start(proc):
+            pretranscode["proc"] = proc
+
+        filename = record.options["filename"]
+        pretranscode["task"] = asyncio.create_task(self.ffmpeg_convert_to_16_9(
+            record.file_path, filename, on_progress=on_progress, background=True, on_start=on_start,
+            promoted=pretranscode["promoted"],
+        ))
+        pretranscode["task"].add_done_callback(lambda t: t.cancelled() or t.exception())
+        self.pretranscodes[record.token] = pretranscode
+        print(f"🎞️ Pre-transcoding to 16:9 in the background: {filename}")
+
+    async def stop_pretranscode(self, pretranscode):
+        """Kill a background conversion nobody wants and wait until its output is deleted."""
+        if not pretranscode:
+            return
+        task = pretranscode["task"]
+        if task.done():
+            if not task.cancelled() and not task.exception():
+                out_path = task.result()[0]
+                try:
+                    os.remove(out_path)
+                except OSError:
+                    pass
+                workspace = self.storage.workspace_of(out_path)
+                if workspace:
+                    try:
+                        workspace.unreserve(os.path.getsize(pretranscode["src_path"]))
+                    except OSError:
+                        pass
+            return
+        task.cancel()
+        try:
+            await task
+        except BaseException:
+            pass
+
+    async def adopt_pretranscode(self, pretranscode, src_path: str, filename: str, progress_msg, reply_markup=None) -> tuple:
+        """The user chose 16:9: finish the background conversion at normal priority (showing its
+        progress) and return its result; if it failed, convert again in the foreground."""
+        task = pretranscode["task"]
+        if not task.done():
+            # Not started yet: it moves to the normal queue and starts at normal priority
+            pretranscode["promoted"].set()
+            if pretranscode["proc"] and not self.ffmpeg.promote(pretranscode["proc"]):
+                print(f"⚠️ Cannot raise the background conversion's priority, converting again: {filename}")
+                await self.stop_pretranscode(pretranscode)
+                return await self.ffmpeg_convert_to_16_9(src_path, filename, progress_msg, reply_markup)
+            pretranscode["report"] = self.make_ffmpeg_progress_cb(progress_msg, "🎞️ تبدیل به 16:9", reply_markup)
+        try:
+            result = await task
+            print(f"🎞️ Background 16:9 conversion reused: {filename}")
+            return result
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        except Exception as e:
+            print(f"⚠️ Background conversion failed, converting again: {e}")
+        finally:
+            if pretranscode["report"]:
+                await pretranscode["report"].close()
+        return await self.ffmpeg_convert_to_16_9(src_path, filename, progress_msg, reply_markup)
+
+    async def on_conversion_cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Cancel button under a running 16:9 conversion: stops ffmpeg."""
+        query = update.callback_query
+        _, token = query.data.split(":", 1)
+        conversion = self.conversions.get(token)
+        if not conversion:
+            await query.answer("این تبدیل دیگر در حال اجرا نیست.")
+            return
+        if update.effective_user.id != conversion["user_id"]:
+            await query.answer("این گزینه مربوط به فایل شما نیست.", show_alert=True)
+            return
+        await query.answer("در حال لغو …")
+        conversion["cancelled"] = True
+        conversion["task"].cancel()
+
     # ===================== New: YouTube handling with yt-dlp =====================
     def is_youtube_url(self, url: str) -> bool:
         """Return True if URL is a YouTube link (youtube.com or youtu.be)."""
@@ -812,20 +1561,9 @@ https://example.com/image.jpg
                 await processing_msg.edit_text("🎬 لینک یوتیوب شناسایی شد. یکی از کیفیت‌ها را انتخاب کنید:", reply_markup=markup)
             except Exception:
                 pass
-            job = None
-            if getattr(context, "job_queue", None):
-                job = context.job_queue.run_once(self.ytdl_choice_timeout, when=60*60, data=token)
-            self.pending_ytdl[token] = {
-                "url": url,
-                "user_id": update.effective_user.id,
-                "user_name": user_name,
-                "chat_id": update.effective_chat.id,
-                "progress_msg": processing_msg,
-                "update": update,
-                "job": job,
-                "agg_map": inv_map,  # height -> direct url
-                "agg_title": inv_title,
-            }
+            # The stream map itself stays in inv_lookups: the prompt only records where it came from
+            record = self.add_ytdl_prompt(token, update, processing_msg, url, user_name, "invidious")
+            self.start_prefetch(record, inv_map)
             return
 
         # 1.5) Fallback to Piped API (separate MP4 video + M4A audio; we'll merge)
@@ -850,26 +1588,14 @@ https://example.com/image.jpg
                 await processing_msg.edit_text("🎬 لینک یوتیوب شناسایی شد. یکی از کیفیت‌ها را انتخاب کنید:", reply_markup=markup)
             except Exception:
                 pass
-            job = None
-            if getattr(context, "job_queue", None):
-                job = context.job_queue.run_once(self.ytdl_choice_timeout, when=60*60, data=token)
-            self.pending_ytdl[token] = {
-                "url": url,
-                "user_id": update.effective_user.id,
-                "user_name": user_name,
-                "chat_id": update.effective_chat.id,
-                "progress_msg": processing_msg,
-                "update": update,
-                "job": job,
-                "agg_map": piped_map,  # height -> {vurl, aurl}
-                "agg_title": piped_title,
-                "agg_type": "piped_v+a",
-            }
+            record = self.add_ytdl_prompt(token, update, processing_msg, url, user_name, "piped")
+            self.start_prefetch(record, piped_map, "piped_v+a")
             return
 
         # 2) Fallback to yt-dlp (may require cookies depending on YouTube safeguards)
         try:
-            heights = await self.ytdl_list_heights(url)
+            info = await self.ytdl_extract_info(url)
+            heights = self.ytdl_heights(info)
         except Exception as e:
             print(f"❌ yt-dlp extract error: {e}")
             msg = "❌ خطا در واکشی کیفیت‌های یوتیوب."
@@ -877,13 +1603,15 @@ https://example.com/image.jpg
                 msg += "\nاین لینک به کوکی نیاز دارد. می‌توانید از دستور /setycb64 برای ست‌کردن کوکی استفاده کنید."
             msg += "\nتلاش برای دانلود بهترین کیفیت …"
             await processing_msg.edit_text(msg)
-            await self.on_ytdl_download_and_send(update, context, processing_msg, url, None)
+            job = lambda progress: self.on_ytdl_download_and_send(update, context, progress, url, None)
+            await self.run_shared_youtube_job(update, processing_msg, url, None, job)
             return
 
         if not heights:
             await processing_msg.edit_text("⚠️ کیفیتی یافت نشد. ارسال نسخه‌ی پیش‌فرض …")
             # Fall back to default best
-            await self.on_ytdl_download_and_send(update, context, processing_msg, url, None)
+            job = lambda progress: self.on_ytdl_download_and_send(update, context, progress, url, None, info)
+            await self.run_shared_youtube_job(update, processing_msg, url, None, job)
             return
 
         # Keep common set and sort descending (e.g., 1080, 720, 480, ...)
@@ -912,18 +1640,34 @@ https://example.com/image.jpg
         except Exception:
             pass
 
-        job = None
-        if getattr(context, "job_queue", None):
-            job = context.job_queue.run_once(self.ytdl_choice_timeout, when=60*60, data=token)
-        self.pending_ytdl[token] = {
-            "url": url,
-            "user_id": update.effective_user.id,
-            "user_name": user_name,
-            "chat_id": update.effective_chat.id,
-            "progress_msg": processing_msg,
-            "update": update,
-            "job": job,
-        }
+        # The download reuses this extraction from ytdl_infos instead of asking YouTube again
+        self.add_ytdl_prompt(token, update, processing_msg, url, user_name, "ytdl")
+
+    def add_ytdl_prompt(self, token: str, update: Update, processing_msg, url: str, user_name: str, source: str):
+        """Record an open quality prompt; source says where its streams come from
+        ("invidious", "piped" or "ytdl") so they can be looked up again when the user picks."""
+        return self.pending.add(
+            token, "ytdl", update.effective_chat.id, processing_msg.message_id, update.effective_user.id, None,
+            {
+                "url": url,
+                "user_name": user_name,
+                "reply_to": update.effective_message.message_id,
+                "source": source,
+            },
+            ttl=60 * 60,
+        )
+
+    async def yt_source_map(self, record) -> tuple[dict, str | None, str | None]:
+        """(stream map, title, agg_type) of a quality prompt's source; usually served from the
+        lookup caches, else fetched again (e.g. after a restart). Empty for yt-dlp prompts."""
+        source = record.options.get("source")
+        if source == "invidious":
+            agg_map, title = await self.yt_inv_fetch_heights_map(record.options["url"])
+            return agg_map, title, None
+        if source == "piped":
+            agg_map, title = await self.yt_piped_fetch_quality_map(record.options["url"])
+            return agg_map, title, "piped_v+a"
+        return {}, None, None
 
     async def on_ytdl_option(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
@@ -932,191 +1676,551 @@ https://example.com/image.jpg
             _, qual, token = query.data.split(":", 2)
         except ValueError:
             return
-        meta = self.pending_ytdl.get(token)
-        if not meta:
+        record = self.pending.get(token)
+        if not record:
             try:
                 await query.edit_message_text("⏱️ مهلت انتخاب به پایان رسیده یا قبلاً پردازش شده است.")
             except Exception:
                 pass
             return
-        if update.effective_user.id != meta["user_id"]:
+        if update.effective_user.id != record.user_id:
             await query.answer("این گزینه مربوط به شما نیست.", show_alert=True)
             return
         # consume
-        self.pending_ytdl.pop(token, None)
-        try:
-            if meta.get("job"):
-                meta["job"].schedule_removal()
-        except Exception:
-            pass
+        self.pending.pop(token)
         # Remove buttons
         try:
-            await context.bot.edit_message_reply_markup(chat_id=meta["chat_id"], message_id=meta["progress_msg"].message_id, reply_markup=None)
+            await context.bot.edit_message_reply_markup(chat_id=record.chat_id, message_id=record.message_id, reply_markup=None)
         except Exception:
             pass
+        progress_msg = self.prompt_message(context.bot, record)
+        orig_update = self.prompt_update(context.bot, record)
+        url = record.options["url"]
+        prefetch = self.prefetches.pop(token, None)
         if qual == "cancel":
+            self.cancel_prefetch(prefetch)
             try:
-                await meta["progress_msg"].edit_text("❌ لغو شد.")
+                await progress_msg.edit_text("❌ لغو شد.")
             except Exception:
                 pass
             return
         # If we have aggregator map (Invidious), download direct URL (no cookies)
-        if meta.get("agg_map"):
+        agg_map, agg_title, agg_type = await self.yt_source_map(record)
+        if agg_map:
             if qual == "best":
-                height = max(meta["agg_map"].keys())
+                height = max(agg_map.keys())
             else:
                 height = int(qual)
-            title = meta.get("agg_title") or "youtube_video"
-            if meta.get("agg_type") == "piped_v+a":
-                entry = meta["agg_map"].get(height)
-                if not entry:
-                    await meta["progress_msg"].edit_text("❌ کیفیت انتخاب‌شده در دسترس نیست.")
-                    return
-                await self.download_piped_and_send(meta["update"], context, meta["progress_msg"], entry["vurl"], entry["aurl"], title, height)
+            self.remember_quality(record.user_id, height)
+            if prefetch and prefetch["height"] != height:
+                self.cancel_prefetch(prefetch)
+                prefetch = None
+            title = agg_title or "youtube_video"
+            cache_keys = self.yt_cache_keys(url, height)
+            if await self.send_cached(orig_update, cache_keys, f"{title} ({height}p)"):
+                self.cancel_prefetch(prefetch)
+                try:
+                    await progress_msg.delete()
+                except Exception:
+                    pass
                 return
-            else:
-                direct_url = meta["agg_map"].get(height)
-                await self.download_direct_and_send(meta["update"], context, meta["progress_msg"], direct_url, title, height)
+            entry = agg_map.get(height)
+            if not entry:
+                self.cancel_prefetch(prefetch)
+                await progress_msg.edit_text("❌ کیفیت انتخاب‌شده در دسترس نیست.")
                 return
+            if agg_type == "piped_v+a":
+                job = lambda progress: self.download_piped_and_send(orig_update, context, progress, entry["vurls"], entry["aurls"], title, height, cache_keys, prefetch)
+            else:
+                job = lambda progress: self.download_direct_and_send(orig_update, context, progress, entry, title, height, cache_keys, prefetch)
+            try:
+                await self.run_shared_youtube_job(orig_update, progress_msg, url, height, job)
+            finally:
+                # Not adopted if the job was rejected or another user's identical job ran instead
+                self.cancel_prefetch(prefetch)
+            return
+        # A yt-dlp prompt, or the instances no longer know the video: use yt-dlp
+        self.cancel_prefetch(prefetch)
+        if qual != "best":
+            self.remember_quality(record.user_id, int(qual))
         # Otherwise use yt-dlp flow
         height = None if qual == "best" else int(qual)
-        await self.on_ytdl_download_and_send(meta["update"], context, meta["progress_msg"], meta["url"], height)
+        job = lambda progress: self.on_ytdl_download_and_send(orig_update, context, progress, url, height)
+        await self.run_shared_youtube_job(orig_update, progress_msg, url, height, job)
 
-    async def ytdl_choice_timeout(self, context: ContextTypes.DEFAULT_TYPE):
-        token = context.job.data
-        meta = self.pending_ytdl.pop(token, None)
-        if not meta:
-            return
+    async def run_shared_youtube_job(self, update, progress_msg, url: str, height: int | None, job):
+        """Run a YouTube download-and-send job once per (video, quality).
+        Users who pick the same video and quality meanwhile attach to the running job and,
+        once the leader has uploaded it, receive the same file by file_id. If the leader's
+        delivery left no reusable file_id (bridge upload, document fallback, no index),
+        the job runs again for the follower.
+        """
+        key = ("yt", self.extract_youtube_id(url) or url, height)
+        user_id = update.effective_user.id
+        scheduled_job = lambda progress: self.run_scheduled(user_id, "youtube.com", progress, lambda: job(progress))
         try:
-            await meta["progress_msg"].edit_text("⌛ مهلت انتخاب تمام شد. دانلود بهترین کیفیت…")
+            async with self.single_flight.join(key, scheduled_job, progress_msg) as (_, is_leader):
+                pass
+            if is_leader:
+                return
+            if await self.send_cached(update, self.yt_cache_keys(url, height)):
+                try:
+                    await progress_msg.delete()
+                except Exception:
+                    pass
+                return
+            print(f"🔁 Shared YouTube job left no file_id; running it again for user {user_id}")
+            await scheduled_job(progress_msg)
+        except SchedulerFull as e:
+            try:
+                await progress_msg.edit_text(f"🚦 {e}")
+            except Exception:
+                pass
+        except Exception as e:
+            print(f"❌ YouTube job error: {e}")
+            try:
+                await progress_msg.edit_text(f"❌ خطا در دانلود از یوتیوب: {e}")
+            except Exception:
+                pass
+
+    async def ytdl_choice_timeout(self, record, context: ContextTypes.DEFAULT_TYPE):
+        self.cancel_prefetch(self.prefetches.pop(record.token, None))
+        progress_msg = self.prompt_message(context.bot, record)
+        try:
+            await progress_msg.edit_text("⌛ مهلت انتخاب تمام شد. دانلود بهترین کیفیت…")
         except Exception:
             pass
-        await self.on_ytdl_download_and_send(meta["update"], context, meta["progress_msg"], meta["url"], None)
+        update = self.prompt_update(context.bot, record)
+        url = record.options["url"]
+        job = lambda progress: self.on_ytdl_download_and_send(update, context, progress, url, None)
+        await self.run_shared_youtube_job(update, progress_msg, url, None, job)
+
+    async def on_pending_expired(self, record):
+        """Pending store timer: a prompt got no answer in time, so apply its default choice."""
+        context = CallbackContext(self.app, chat_id=record.chat_id, user_id=record.user_id)
+        if record.kind == "video":
+            await self.video_choice_timeout(record, context)
+        elif record.kind == "ytdl":
+            await self.ytdl_choice_timeout(record, context)
+
+    def prompt_message(self, bot, record) -> Message:
+        """The prompt message of a pending record, rebuilt from its IDs (enough to edit or delete it)."""
+        message = Message(record.message_id, datetime.now(timezone.utc), self.prompt_chat(record))
+        message.set_bot(bot)
+        return message
+
+    def prompt_update(self, bot, record) -> Update:
+        """Stand-in for the Update that started a pending record: uploads reply to the user's
+        original message and read the chat and sender from it."""
+        user = User(record.user_id, record.options.get("user_name") or "", False)
+        message = Message(
+            record.options.get("reply_to") or record.message_id, datetime.now(timezone.utc), self.prompt_chat(record),
+            from_user=user, text=record.options.get("url"),
+        )
+        message.set_bot(bot)
+        return Update(0, message=message)
+
+    @staticmethod
+    def prompt_chat(record) -> Chat:
+        # Telegram gives users positive IDs and groups/channels negative ones
+        return Chat(record.chat_id, Chat.PRIVATE if record.chat_id > 0 else Chat.GROUP)
+
+    def restore_pending(self):
+        """After a restart: keep the files of prompts that are still open (so the storage sweep
+        does not delete them) and report how many prompts were restored."""
+        for record in self.pending.records("video"):
+            if record.file_path and not self.storage.adopt(os.path.dirname(record.file_path)):
+                print(f"⚠️ File of pending prompt {record.token} is gone: {record.file_path}")
+        if len(self.pending):
+            print(f"♻️ Restored {len(self.pending)} pending prompts")
+
+    def remember_quality(self, user_id, height: int):
+        # Least recently active users are dropped beyond YT_PREFETCH_MAX_USERS
+        self.quality_choices.put(user_id, height, time.time() + 30 * 24 * 60 * 60)
+
+    def predict_height(self, user_id, heights) -> int | None:
+        """The quality a user will most likely pick: their last choice (or the nearest lower
+        one offered), otherwise the highest up to YT_PREFETCH_MAX_HEIGHT."""
+        heights = sorted(heights, reverse=True)
+        if not heights:
+            return None
+        last = self.quality_choices.get(user_id)
+        cap = last if last else YT_PREFETCH_MAX_HEIGHT
+        return next((h for h in heights if h <= cap), heights[-1])
+
+    def start_prefetch(self, record, agg_map: dict, agg_type: str | None = None):
+        """While the quality menu is open, start downloading the likely choice at low priority.
+        on_ytdl_option adopts it when the choice matches and cancels it otherwise. At most
+        YT_PREFETCH_MAX_ACTIVE prefetches run at once; past that, menus get none."""
+        if not YT_PREFETCH or not agg_map:
+            return
+        active = sum(1 for p in self.prefetches.values() if not p["task"].done())
+        if active >= YT_PREFETCH_MAX_ACTIVE:
+            # Speculation never queues: with enough of it running, this menu goes without
+            return
+        user_id, url = record.user_id, record.options["url"]
+        height = self.predict_height(user_id, agg_map.keys())
+        if height is None or (self.file_ids and self.file_ids.lookup(self.yt_cache_keys(url, height))):
+            return
+        workspace = self.storage.create_workspace()
+        throttle = self.shaper.background(YT_PREFETCH_RATE, user_id)
+        prefetch = {"height": height, "workspace": workspace, "throttle": throttle, "report": None, "adopted": False}
+
+        async def report(done: int, total: int):
+            # Silent until adopted; then the adopter's progress bar takes over
+            if prefetch["report"]:
+                await prefetch["report"](done, total)
+
+        async def run():
+            session = await self.http.get_session()
+            entry = agg_map[height]
+            if agg_type == "piped_v+a":
+                return await self.fetch_piped_streams(
+                    session, entry["vurls"], entry["aurls"], workspace, report, user_id,
+                    throttle=throttle, speculative=True,
+                )
+            path = workspace.file("prefetch.mp4")
+            result = await self.download_stream(
+                session, entry, path, workspace, report, self.youtube_media_headers(), user_id,
+                throttle=throttle, speculative=True,
+            )
+            return path, result
+
+        prefetch["task"] = asyncio.create_task(run())
+        # Retrieve a failure here so an unadopted prefetch never logs "exception was never retrieved"
+        prefetch["task"].add_done_callback(lambda t: t.cancelled() or t.exception())
+        self.prefetches[record.token] = prefetch
+        print(f"🔮 Prefetching {height}p for user {user_id}")
+
+    def cancel_prefetch(self, prefetch):
+        """Stop a prefetch that was not adopted and free its disk space."""
+        if not prefetch or prefetch["adopted"]:
+            return
+        prefetch["adopted"] = True
+        prefetch["task"].cancel()
+        # The workspace goes once the download has actually stopped writing into it
+        prefetch["task"].add_done_callback(lambda _: prefetch["workspace"].release())
+
+    async def adopt_prefetch(self, prefetch, progress_msg, user_name: str = ""):
+        """Take over a matching prefetch: lift its bandwidth cap, show its progress and wait for it.
+        Returns (workspace, result) or None when it failed (the caller downloads normally)."""
+        prefetch["adopted"] = True
+        prefetch["throttle"].promote()
+        report = self.make_progress_cb(progress_msg, user_name)
+        prefetch["report"] = report
+        try:
+            result = await prefetch["task"]
+        except asyncio.CancelledError:
+            prefetch["task"].cancel()
+            prefetch["workspace"].release()
+            raise
+        except Exception as e:
+            print(f"⚠️ Prefetch failed, downloading again: {e}")
+            prefetch["workspace"].release()
+            return None
+        finally:
+            await report.close()
+        print(f"🔮 Prefetch of {prefetch['height']}p reused")
+        return prefetch["workspace"], result
+
+    def ytdl_base_opts(self) -> dict:
+        """yt-dlp options shared by extraction and download."""
+        ydl_opts = {
+            'quiet': True,
+            'no_warnings': True,
+            'extractor_args': {'youtube': {'player_client': ['android', 'ios', 'web']}},
+            'noplaylist': True,
+        }
+        if self.yt_cookies_path:
+            ydl_opts['cookiefile'] = self.yt_cookies_path
+        # Optional proxy & headers
+        try:
+            from config import YTDLP_PROXY
+        except Exception:
+            YTDLP_PROXY = None
+        if YTDLP_PROXY:
+            ydl_opts['proxy'] = YTDLP_PROXY
+        ydl_opts['http_headers'] = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36',
+            'Accept-Language': 'en-US,en;q=0.9,fa;q=0.8',
+            'Accept': '*/*',
+            'Referer': 'https://www.youtube.com/',
+        }
+        return ydl_opts
+
+    def ytdl_download_opts(self) -> dict:
+        """Transfer tuning for yt-dlp downloads: parallel DASH/HLS fragments, buffer and
+        chunk sizes, and the optional external downloader."""
+        ydl_opts = {
+            'concurrent_fragment_downloads': max(1, YTDLP_CONCURRENT_FRAGMENTS),
+            'buffersize': YTDLP_BUFFER_SIZE,
+            # Keep the buffer at the configured size instead of letting yt-dlp grow it
+            'noresizebuffer': True,
+        }
+        if YTDLP_HTTP_CHUNK_SIZE > 0:
+            # Ranged requests of this size dodge YouTube's throttling of long single requests
+            ydl_opts['http_chunk_size'] = YTDLP_HTTP_CHUNK_SIZE
+        if YTDLP_EXTERNAL_DOWNLOADER:
+            if shutil.which(YTDLP_EXTERNAL_DOWNLOADER):
+                ydl_opts['external_downloader'] = {'default': YTDLP_EXTERNAL_DOWNLOADER}
+                if YTDLP_EXTERNAL_DOWNLOADER_ARGS:
+                    ydl_opts['external_downloader_args'] = {
+                        YTDLP_EXTERNAL_DOWNLOADER: shlex.split(YTDLP_EXTERNAL_DOWNLOADER_ARGS),
+                    }
+            else:
+                print(f"⚠️ External downloader {YTDLP_EXTERNAL_DOWNLOADER} not found; using yt-dlp's own")
+        return ydl_opts
+
+    async def ytdl_extract_info(self, url: str) -> dict:
+        """Run yt-dlp extraction once per video: the info dict is cached by video ID (for all
+        users) until its format URLs expire, and can later be downloaded without re-extracting."""
+        vid = self.extract_youtube_id(url)
+        info = self.ytdl_infos.get(vid) if vid else None
+        if info is not None:
+            return info
+
+        ydl_opts = self.ytdl_base_opts()
+        ydl_opts['skip_download'] = True
+        info = await self.ytdl_pool.extract(ydl_opts, url)
+        if vid and isinstance(info, dict):
+            urls = [f.get('url') for f in info.get('formats') or [] if f.get('url')]
+            self.ytdl_infos.put(vid, info, signed_url_expiry(urls, default_ttl=YTDLP_INFO_CACHE_TTL, margin=10 * 60))
+        return info
+
+    def ytdl_size_estimate(self, info, height: int | None) -> int:
+        """Bytes a yt-dlp download of info at height (None = best) will write, from the
+        formats' filesize/filesize_approx (else bitrate x duration). Errs on the large side:
+        the largest candidate format counts. 0 when the formats say nothing."""
+        if not isinstance(info, dict):
+            return 0
+        duration = info.get('duration') or 0
+
+        def size(f) -> int:
+            return int(f.get('filesize') or f.get('filesize_approx') or (f.get('tbr') or 0) * 125 * duration)
 
-    async def ytdl_list_heights(self, url: str) -> list:
+        formats = info.get('formats') or []
+        progressive = [f for f in formats if f.get('vcodec') != 'none' and f.get('acodec') != 'none']
+        if not height:
+            return max((size(f) for f in progressive or formats), default=0)
+        videos = [f for f in formats if f.get('vcodec') != 'none' and (f.get('height') or 0) <= height]
+        audios = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') != 'none']
+        if videos and audios:
+            # bestvideo+bestaudio, merged afterwards
+            return max(size(f) for f in videos) + max(size(f) for f in audios)
+        return max((size(f) for f in progressive if (f.get('height') or 0) <= height), default=0)
+
+    def ytdl_heights(self, info: dict) -> list:
         """Return available video heights (e.g., [144, 240, 360, 480, 720, 1080])."""
-        def extract():
-            import yt_dlp
-            ydl_opts = {
-                'quiet': True,
-                'no_warnings': True,
-                'skip_download': True,
-                'extractor_args': {'youtube': {'player_client': ['android', 'ios', 'web']}},
-                'noplaylist': True,
-            }
-            if self.yt_cookies_path:
-                ydl_opts['cookiefile'] = self.yt_cookies_path
-            # Optional proxy & headers
-            try:
-                from config import YTDLP_PROXY
-            except Exception:
-                YTDLP_PROXY = None
-            if YTDLP_PROXY:
-                ydl_opts['proxy'] = YTDLP_PROXY
-            ydl_opts['http_headers'] = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36',
-                'Accept-Language': 'en-US,en;q=0.9,fa;q=0.8',
-                'Accept': '*/*',
-                'Referer': 'https://www.youtube.com/',
-            }
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                heights = []
-                for f in info.get('formats', []) if isinstance(info, dict) else []:
-                    h = f.get('height')
-                    if h and f.get('vcodec') != 'none':
-                        heights.append(int(h))
-                return heights
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, extract)
+        heights = []
+        for f in info.get('formats', []) if isinstance(info, dict) else []:
+            h = f.get('height')
+            if h and f.get('vcodec') != 'none':
+                heights.append(int(h))
+        return heights
 
     async def yt_inv_fetch_heights_map(self, url: str) -> tuple[dict, str | None]:
         """Try Invidious API to get progressive MP4 streams without cookies.
-        Returns (heights_map, title). heights_map: {height:int -> direct_url:str}
+        Returns (heights_map, title). heights_map: {height:int -> [direct_url per instance]}
         """
         vid = self.extract_youtube_id(url)
         if not vid:
             return {}, None
+        cached = self.inv_lookups.get(vid)
+        if cached is not None:
+            return cached
+        headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128 Safari/537.36",
+            "Accept": "application/json",
+        }
+        session = await self.http.get_session()
+        for bases in self.instances.batches("invidious", INSTANCE_FANOUT):
+            tasks = [asyncio.create_task(self.inv_fetch_streams(session, base, vid, headers)) for base in bases]
+            results = await self.first_results(tasks, grace=MIRROR_LOOKUP_GRACE)
+            heights, title = {}, None
+            for result in results:
+                if not result[0]:
+                    continue
+                title = title or result[1]
+                for h, stream_url in result[0].items():
+                    heights.setdefault(h, []).append(stream_url)
+            if heights:
+                urls = [u for stream_urls in heights.values() for u in stream_urls]
+                # Keep a safety margin: the download starts only after the user picks a quality
+                expires_at = signed_url_expiry(urls, default_ttl=INVIDIOUS_CACHE_TTL, margin=10 * 60)
+                self.inv_lookups.put(vid, (heights, title), expires_at)
+                return heights, title
+        return {}, None
+
+    async def inv_fetch_streams(self, session, base: str, vid: str, headers: dict) -> tuple:
+        """Query one Invidious instance; return ({height: progressive mp4 url}, title).
+        local=true makes the instance proxy the streams: googlevideo URLs it signs for
+        itself are bound to its own IP address and would be refused to us."""
+        api = base.rstrip('/') + f"/api/v1/videos/{vid}?local=true"
+        with self.instances.track("invidious", base) as attempt:
+            async with session.get(api, headers=headers, timeout=aiohttp.ClientTimeout(total=15)) as r:
+                if r.status != 200:
+                    attempt.ok = r.status < 500
+                    return {}, None
+                data = await r.json(content_type=None)
+        if not isinstance(data, dict):
+            return {}, None
+        heights = {}
+        for f in data.get("formatStreams") or []:
+            mime = (f.get("type") or "").lower()
+            if "video/mp4" not in mime and (f.get("container") or "").lower() != "mp4":
+                continue
+            m = re.search(r"(\d{3,4})p", str(f.get("resolution") or f.get("qualityLabel") or f.get("quality") or ""))
+            stream_url = f.get("url")
+            if not m or not stream_url:
+                continue
+            if stream_url.startswith("/"):
+                stream_url = base.rstrip('/') + stream_url
+            heights.setdefault(int(m.group(1)), stream_url)
+        return heights, data.get("title")
 
     async def yt_piped_fetch_quality_map(self, url: str) -> tuple[dict, str | None]:
         """Use Piped API to get MP4 video-only URLs and M4A audio URL; return map height->{vurl,aurl}."""
         vid = self.extract_youtube_id(url)
         if not vid:
             return {}, None
+        cached = self.piped_lookups.get(vid)
+        if cached is not None:
+            return cached
         headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128 Safari/537.36",
             "Accept": "application/json",
         }
-        for base in PIPED_INSTANCES:
-            api = base.rstrip('/') + f"/api/v1/streams/{vid}"
-            try:
-                async with aiohttp.ClientSession(headers=headers, timeout=aiohttp.ClientTimeout(total=15)) as s:
-                    async with s.get(api) as r:
-                        if r.status != 200:
-                            continue
-                        data = await r.json(content_type=None)
-                        title = data.get("title") if isinstance(data, dict) else None
-                        videos = data.get("videoStreams") or []
-                        audios = data.get("audioStreams") or []
-                        # pick best M4A audio
-                        a_best = None
-                        best_ab = -1
-                        for a in audios:
-                            mime = (a.get("mimeType") or a.get("type") or "").lower()
-                            if "audio/mp4" in mime or ".m4a" in (a.get("url") or ""):
-                                br = int(a.get("bitrate") or 0)
-                                if br > best_ab:
-                                    best_ab = br
-                                    a_best = a.get("url")
-                        heights = {}
-                        if a_best:
-                            for v in videos:
-                                mime = (v.get("mimeType") or v.get("type") or "").lower()
-                                codec = (v.get("codec") or "").lower()
-                                q = v.get("quality") or v.get("qualityLabel") or ""
-                                m = re.search(r"(\d{3,4})p", str(q))
-                                if not m:
-                                    continue
-                                if "video/mp4" not in mime and "mp4" not in (v.get("container") or "").lower():
-                                    continue
-                                if "avc" not in codec and "h264" not in codec:
-                                    continue
-                                h = int(m.group(1))
-                                heights[h] = {"vurl": v.get("url"), "aurl": a_best}
-                        if heights:
-                            return heights, title
-            except Exception:
-                continue
+        session = await self.http.get_session()
+        # Ask the INSTANCE_FANOUT best-scoring instances at once (the next group only if none of
+        # them knows the video): each answer adds its stream URLs as mirrors for hedging
+        for bases in self.instances.batches("piped", INSTANCE_FANOUT):
+            tasks = [asyncio.create_task(self.piped_fetch_streams(session, base, vid, headers)) for base in bases]
+            results = await self.first_results(tasks, grace=MIRROR_LOOKUP_GRACE)
+            heights, title = {}, None
+            for result in results:
+                if not result[0]:
+                    continue
+                title = title or result[1]
+                for h, entry in result[0].items():
+                    merged = heights.setdefault(h, {"vurls": [], "aurls": []})
+                    merged["vurls"].append(entry["vurl"])
+                    merged["aurls"].append(entry["aurl"])
+            if heights:
+                urls = [u for entry in heights.values() for u in entry["vurls"] + entry["aurls"]]
+                expires_at = signed_url_expiry(urls, default_ttl=INVIDIOUS_CACHE_TTL, margin=10 * 60)
+                self.piped_lookups.put(vid, (heights, title), expires_at)
+                return heights, title
         return {}, None
 
-    async def download_piped_and_send(self, update: Update, context: ContextTypes.DEFAULT_TYPE, progress_msg, vurl: str, aurl: str, title: str, height: int | None):
-        """Download separate MP4 video + M4A audio URLs and mux into MP4 using ffmpeg (copy)."""
+    async def first_results(self, tasks, grace: float) -> list:
+        """Wait for the first task with a useful (truthy first item) result, give the others
+        grace more seconds, cancel the rest and return the successful results in task order."""
+        pending = set(tasks)
+        deadline = None
+        try:
+            while pending:
+                timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                if deadline is None and any(not t.exception() and t.result()[0] for t in done):
+                    deadline = time.monotonic() + grace
+        finally:
+            for task in pending:
+                task.cancel()
+        return [t.result() for t in tasks if t.done() and not t.cancelled() and not t.exception()]
+
+    async def piped_fetch_streams(self, session, base: str, vid: str, headers: dict) -> tuple:
+        """Query one Piped instance; return ({height: {vurl, aurl}}, title)."""
+        api = base.rstrip('/') + f"/api/v1/streams/{vid}"
+        with self.instances.track("piped", base) as attempt:
+            async with session.get(api, headers=headers, timeout=aiohttp.ClientTimeout(total=15)) as r:
+                if r.status != 200:
+                    # 4xx is about the video (private, removed…); 5xx is about the instance
+                    attempt.ok = r.status < 500
+                    return {}, None
+                data = await r.json(content_type=None)
+        title = data.get("title") if isinstance(data, dict) else None
+        videos = data.get("videoStreams") or []
+        audios = data.get("audioStreams") or []
+        # pick best M4A audio
+        a_best = None
+        best_ab = -1
+        for a in audios:
+            mime = (a.get("mimeType") or a.get("type") or "").lower()
+            if "audio/mp4" in mime or ".m4a" in (a.get("url") or ""):
+                br = int(a.get("bitrate") or 0)
+                if br > best_ab:
+                    best_ab = br
+                    a_best = a.get("url")
+        heights = {}
+        if a_best:
+            for v in videos:
+                mime = (v.get("mimeType") or v.get("type") or "").lower()
+                codec = (v.get("codec") or "").lower()
+                q = v.get("quality") or v.get("qualityLabel") or ""
+                m = re.search(r"(\d{3,4})p", str(q))
+                if not m:
+                    continue
+                if "video/mp4" not in mime and "mp4" not in (v.get("container") or "").lower():
+                    continue
+                if "avc" not in codec and "h264" not in codec:
+                    continue
+                h = int(m.group(1))
+                heights[h] = {"vurl": v.get("url"), "aurl": a_best}
+        return heights, title
+
+    async def download_piped_and_send(self, update: Update, context: ContextTypes.DEFAULT_TYPE, progress_msg, vurls: list, aurls: list, title: str, height: int | None, cache_keys=(), prefetch=None):
+        """Download separate MP4 video + M4A audio URLs and mux into MP4 using ffmpeg (copy).
+        vurls/aurls are the same streams from different instances; both streams are downloaded
+        concurrently (segmented, across the mirrors) and then muxed locally. prefetch is a
+        speculative download of these streams started while the user was choosing."""
         safe_title = re.sub(r"[^\w\-\.\u0600-\u06FF ]+", "_", title).strip() or "youtube_video"
         out_name = f"{safe_title}_{height or 'best'}p.mp4"
-        out_path = os.path.join(tempfile.gettempdir(), out_name)
+        user_name = update.effective_user.first_name
+        adopted = await self.adopt_prefetch(prefetch, progress_msg, user_name) if prefetch else None
+        workspace = adopted[0] if adopted else self.storage.create_workspace()
+        out_path = workspace.file(out_name)
         try:
-            try:
-                await progress_msg.edit_text("⏬ در حال دانلود و ادغام (Piped) …")
-            except Exception:
-                pass
-            cmd = [
-                "ffmpeg", "-y",
-                "-i", vurl,
-                "-i", aurl,
+            if adopted:
+                vpath, apath, vsize, asize = adopted[1]
+            else:
+                try:
+                    await progress_msg.edit_text("⏬ در حال دانلود و ادغام (Piped) …")
+                except Exception:
+                    pass
+                session = await self.http.get_session()
+                # Both streams download at once into the workspace; one progress bar shows their sum
+                report = self.make_progress_cb(progress_msg, user_name)
+                try:
+                    vpath, apath, vsize, asize = await self.fetch_piped_streams(
+                        session, vurls, aurls, workspace, report, update.effective_user.id, progress_msg,
+                    )
+                finally:
+                    await report.close()
+            # The mux writes a copy of both streams before they can be deleted
+            await self.reserve_space(workspace, vsize + asize, progress_msg)
+            args = [
+                "-i", vpath,
+                "-i", apath,
+                "-map", "0:v:0", "-map", "1:a:0",
                 "-c", "copy",
                 "-movflags", "+faststart",
                 out_path,
             ]
-            proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-            _, err = await proc.communicate()
-            if proc.returncode != 0:
-                raise RuntimeError(err.decode(errors='ignore')[-400:])
+            # Local stream copy: no encoding, so one thread and normal priority are enough
+            await self.run_ffmpeg(args, progress_msg, "🔀 ادغام صدا و تصویر", nice=0, threads=1)
+            for path in (vpath, apath):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
             size = os.path.getsize(out_path)
             try:
                 await progress_msg.edit_text("📤 در حال آپلود …")
             except Exception:
                 pass
-            await self.upload_with_progress(update, context, progress_msg, out_path, out_name, size, update.effective_user.first_name)
+            await self.upload_with_progress(update, context, progress_msg, out_path, out_name, size, update.effective_user.first_name, cache_keys)
             try:
                 await progress_msg.delete()
             except Exception:
@@ -1124,12 +2228,91 @@ https://example.com/image.jpg
             asyncio.create_task(self.delayed_file_cleanup(out_path, 20))
         except Exception as e:
             print(f"❌ piped download error: {e}")
+            workspace.release()
             try:
                 await progress_msg.edit_text(f"❌ خطا در دانلود از Piped: {e}\nتلاش برای بهترین کیفیت با yt-dlp …")
             except Exception:
                 pass
             await self.on_ytdl_download_and_send(update, context, progress_msg, self.normalize_youtube_url(update.message.text.strip()), None)
 
+    async def download_stream(self, session, urls: list, file_path: str, workspace, report, headers: dict, user_id=None, progress_msg=None, throttle=None, speculative: bool = False) -> tuple:
+        """Download one stream offered by several mirrors into file_path; returns (size, sha256).
+        The fastest mirror is the primary and, when it supports Range requests, pieces are
+        fetched in parallel from it and the other mirrors. A speculative download never waits
+        for disk space (StorageFull instead) and leaves no partial data behind."""
+        ranked = await self.hedge(session, urls, headers)
+        probe = await probe_url(session, ranked[0], headers)
+        if not probe.ok:
+            raise Exception(f"HTTP {probe.status}: دریافت {os.path.basename(file_path)} ممکن نیست")
+
+        async def reserve(nbytes: int):
+            if not speculative:
+                await self.reserve_space(workspace, nbytes, progress_msg)
+            elif not workspace.try_reserve(nbytes):
+                raise StorageFull("no room for a speculative download")
+
+        if probe.accepts_ranges and probe.size:
+            await reserve(probe.size)
+            return await self.receive_body(
+                session, None, ranked[0], file_path, probe.size, report, headers, user_id, probe=probe,
+                mirrors=ranked[1:], throttle=throttle, resumable=not speculative,
+            )
+        async with session.get(probe.url, headers=headers, allow_redirects=True) as response:
+            if response.status != 200:
+                raise Exception(f"HTTP {response.status}: دریافت {os.path.basename(file_path)} ممکن نیست")
+            total_size = int(response.headers.get('Content-Length', 0) or 0)
+            await reserve(total_size)
+            return await self.receive_body(
+                session, response, ranked[0], file_path, total_size, report, headers, user_id,
+                throttle=throttle, resumable=not speculative,
+            )
+
+    async def fetch_piped_streams(self, session, vurls: list, aurls: list, workspace, report, user_id=None, progress_msg=None, throttle=None, speculative: bool = False) -> tuple:
+        """Download the video-only and audio-only streams at once; returns (vpath, apath, vsize, asize).
+        report(done, total) gets the sum of both downloads."""
+        headers = self.youtube_media_headers()
+        parts = {}
+
+        def part_report(name):
+            async def on_progress(done: int, total: int):
+                parts[name] = (done, total)
+                await report(sum(d for d, _ in parts.values()), sum(t for _, t in parts.values()))
+            return on_progress
+
+        vpath, apath = workspace.file("video.mp4"), workspace.file("audio.m4a")
+        tasks = [
+            asyncio.create_task(self.download_stream(session, vurls, vpath, workspace, part_report("v"), headers, user_id, progress_msg, throttle, speculative)),
+            asyncio.create_task(self.download_stream(session, aurls, apath, workspace, part_report("a"), headers, user_id, progress_msg, throttle, speculative)),
+        ]
+        try:
+            (vsize, _), (asize, _) = await asyncio.gather(*tasks)
+        except BaseException:
+            # One stream failed (or we were cancelled): stop the other before the caller
+            # releases the workspace it writes into
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return vpath, apath, vsize, asize
+
+    def youtube_media_headers(self) -> dict:
+        return {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128 Safari/537.36",
+            "Accept": "*/*",
+            "Referer": "https://www.youtube.com/",
+        }
+
+    async def hedge(self, session, urls: list, headers: dict) -> list:
+        """Race the first HEDGE_SAMPLE_BYTES from up to HEDGE_MAX_MIRRORS mirrors; usable URLs, fastest first."""
+        return await hedge_mirrors(session, urls[:HEDGE_MAX_MIRRORS], headers, sample_bytes=HEDGE_SAMPLE_BYTES)
+
+    def yt_cache_keys(self, url: str, height: int | None) -> list:
+        """file_id cache keys for a YouTube video at a given quality (None = best)."""
+        vid = self.extract_youtube_id(url)
+        if not vid:
+            return []
+        return [("yt", f"{vid}:{height or 'best'}")]
+
     def extract_youtube_id(self, url: str) -> str | None:
         try:
             u = self.normalize_youtube_url(url)
@@ -1143,61 +2326,60 @@ https://example.com/image.jpg
         except Exception:
             return None
 
-    async def download_direct_and_send(self, update: Update, context: ContextTypes.DEFAULT_TYPE, progress_msg, direct_url: str, title: str, height: int | None):
-        """Download a direct video URL (e.g., from Invidious) and send to user."""
+    async def download_direct_and_send(self, update: Update, context: ContextTypes.DEFAULT_TYPE, progress_msg, direct_urls, title: str, height: int | None, cache_keys=(), prefetch=None):
+        """Download a direct video URL (e.g., from Invidious) and send to user.
+        direct_urls may list the same stream on several instances: the fastest one is used and
+        segmented downloads take pieces from the others too. prefetch is a speculative download
+        of this stream started while the user was choosing."""
         # Compose a safe filename ending with .mp4
         safe_title = re.sub(r"[^\w\-\.\u0600-\u06FF ]+", "_", title).strip() or "youtube_video"
         if height:
             out_name = f"{safe_title}_{height}p.mp4"
         else:
             out_name = f"{safe_title}.mp4"
-        # Stream download
-        timeout = aiohttp.ClientTimeout(total=None, connect=30)
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128 Safari/537.36",
-            "Accept": "*/*",
-            "Referer": "https://www.youtube.com/",
-        }
-        async with aiohttp.ClientSession(timeout=timeout, headers=headers) as session:
-            async with session.get(direct_url, allow_redirects=True) as response:
-                if response.status != 200:
-                    raise Exception(f"HTTP {response.status}: دریافت ویدیو ممکن نیست")
-                temp_dir = tempfile.gettempdir()
-                out_path = os.path.join(temp_dir, out_name)
-                downloaded = 0
-                total_size = int(response.headers.get('content-length', 0) or 0)
-                start_time = time.time()
-                last_update = 0
-                with open(out_path, 'wb') as f:
-                    async for chunk in response.content.iter_chunked(1024 * 1024):
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        current_time = time.time()
-                        if current_time - last_update >= 2 and progress_msg and total_size > 0:
-                            elapsed_time = current_time - start_time
-                            speed = downloaded / elapsed_time if elapsed_time > 0 else 0
-                            percentage = (downloaded / total_size) * 100
-                            progress_text = self.create_progress_text("📥 دانلود", percentage, speed, downloaded, total_size)
-                            try:
-                                await progress_msg.edit_text(progress_text)
-                                last_update = current_time
-                            except Exception:
-                                pass
+        adopted = await self.adopt_prefetch(prefetch, progress_msg, update.effective_user.first_name) if prefetch else None
+        if adopted:
+            workspace, (path, (_, sha256)) = adopted
+            out_path = workspace.file(out_name)
+            os.replace(path, out_path)
+        else:
+            urls = [direct_urls] if isinstance(direct_urls, str) else direct_urls
+            session = await self.http.get_session()
+            workspace = self.storage.create_workspace()
+            out_path = workspace.file(out_name)
+            report = self.make_progress_cb(progress_msg)
+            try:
+                _, sha256 = await self.download_stream(session, urls, out_path, workspace, report, self.youtube_media_headers(), update.effective_user.id, progress_msg)
+            except BaseException:
+                workspace.release()
+                raise
+            finally:
+                await report.close()
         size = os.path.getsize(out_path)
         try:
             await progress_msg.edit_text("📤 در حال آپلود …")
         except Exception:
             pass
-        await self.upload_with_progress(update, context, progress_msg, out_path, out_name, size, update.effective_user.first_name)
+        cache_keys = list(cache_keys) + [("sha", sha256)]
+        await self.upload_with_progress(update, context, progress_msg, out_path, out_name, size, update.effective_user.first_name, cache_keys)
         try:
             await progress_msg.delete()
         except Exception:
             pass
         asyncio.create_task(self.delayed_file_cleanup(out_path, 20))
 
-    async def on_ytdl_download_and_send(self, update: Update, context: ContextTypes.DEFAULT_TYPE, progress_msg, url: str, height: int | None):
-        """Download YouTube video with selected quality and send to user."""
+    async def on_ytdl_download_and_send(self, update: Update, context: ContextTypes.DEFAULT_TYPE, progress_msg, url: str, height: int | None, info: dict | None = None):
+        """Download YouTube video with selected quality and send to user.
+        info is an earlier yt-dlp extraction of url (else the cached one is used, if any)."""
+        workspace = None
         try:
+            cache_keys = self.yt_cache_keys(url, height)
+            if await self.send_cached(update, cache_keys, f"YouTube ({height or 'best'})"):
+                try:
+                    await progress_msg.delete()
+                except Exception:
+                    pass
+                return
             if height:
                 try:
                     await progress_msg.edit_text(f"⏬ در حال دانلود کیفیت {height}p …")
@@ -1209,63 +2391,58 @@ https://example.com/image.jpg
                 except Exception:
                     pass
 
-            token = uuid4().hex
-            temp_dir = tempfile.gettempdir()
-            prefix = os.path.join(temp_dir, f"ytdl_{token}")
-
-            def download():
-                import yt_dlp
-                fmt = 'best'
-                if height:
-                    # Prefer MP4/M4A when possible; fall back gracefully using <= height
-                    fmt = (
-                        f"bestvideo[height<={height}][ext=mp4]+bestaudio[ext=m4a]/"
-                        f"bestvideo[height<={height}]+bestaudio/"
-                        f"best[height<={height}]"
-                    )
-                ydl_opts = {
-                    'format': fmt,
-                    'merge_output_format': 'mp4',
-                    'outtmpl': prefix + '.%(ext)s',
-                    'quiet': True,
-                    'no_warnings': True,
-                    'extractor_args': {'youtube': {'player_client': ['android', 'ios', 'web']}},
-                    'noplaylist': True,
-                }
-                if self.yt_cookies_path:
-                    ydl_opts['cookiefile'] = self.yt_cookies_path
-                # Optional proxy & headers
+            workspace = self.storage.create_workspace()
+            prefix = os.path.join(workspace.path, "ytdl")
+            vid = self.extract_youtube_id(url)
+            if info is None and vid:
+                info = self.ytdl_infos.get(vid)
+            if info is None:
+                # The sizes in the extraction decide how much disk space to reserve; the
+                # download then reuses it instead of extracting again
                 try:
-                    from config import YTDLP_PROXY
-                except Exception:
-                    YTDLP_PROXY = None
-                if YTDLP_PROXY:
-                    ydl_opts['proxy'] = YTDLP_PROXY
-                ydl_opts['http_headers'] = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36',
-                    'Accept-Language': 'en-US,en;q=0.9,fa;q=0.8',
-                    'Accept': '*/*',
-                    'Referer': 'https://www.youtube.com/',
-                }
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=True)
-                    # Determine output path
-                    # yt-dlp will replace %(ext)s with actual extension
-                    # Try to compute final path
-                    ext = (info.get('ext') or 'mp4') if isinstance(info, dict) else 'mp4'
-                    out_path = prefix + '.' + ext
-                    # Sometimes extension may differ; attempt glob
-                    if not os.path.exists(out_path):
-                        import glob
-                        matches = glob.glob(prefix + '.*')
-                        if matches:
-                            out_path = matches[0]
-                    size = os.path.getsize(out_path)
-                    name = os.path.basename(out_path)
-                    return out_path, name, size
+                    info = await self.ytdl_extract_info(url)
+                except Exception as e:
+                    print(f"⚠️ yt-dlp extract error, downloading without size estimate: {e}")
+            estimate = self.ytdl_size_estimate(info, height) or STORAGE_UNKNOWN_SIZE_BYTES
+            await self.reserve_space(workspace, estimate, progress_msg)
 
-            loop = asyncio.get_running_loop()
-            out_path, out_name, out_size = await loop.run_in_executor(None, download)
+            fmt = 'best'
+            if height:
+                # Prefer MP4/M4A when possible; fall back gracefully using <= height
+                fmt = (
+                    f"bestvideo[height<={height}][ext=mp4]+bestaudio[ext=m4a]/"
+                    f"bestvideo[height<={height}]+bestaudio/"
+                    f"best[height<={height}]"
+                )
+            ydl_opts = self.ytdl_base_opts()
+            ydl_opts.update(self.ytdl_download_opts())
+            ydl_opts.update({
+                'format': fmt,
+                'merge_output_format': 'mp4',
+            })
+            report = self.make_progress_cb(progress_msg, update.effective_user.first_name)
+
+            async def on_progress(status: str, done: int, total: int):
+                if status in ("downloading", "finished") and total:
+                    await report(done, total)
+                elif status == "merging" and not report.closed:
+                    # The merged file is written before the separate streams are deleted
+                    workspace.reserve_now(estimate)
+                    await report.close()
+                    try:
+                        await progress_msg.edit_text("🔧 در حال ادغام صدا و تصویر …")
+                    except Exception:
+                        pass
+
+            try:
+                result = await self.ytdl_pool.download(ydl_opts, url, prefix, info, on_progress)
+            finally:
+                await report.close()
+            if result["reextracted"] and vid:
+                self.ytdl_infos.discard(vid)
+            out_path = result["path"]
+            out_name = os.path.basename(out_path)
+            out_size = os.path.getsize(out_path)
 
             # Upload
             caption = f"✅ ویدیو دانلود شد (YouTube)\n📁 {out_name}\n🎞️ کیفیت: {height or 'best'}\n📊 {self.format_file_size(out_size)}"
@@ -1274,7 +2451,7 @@ https://example.com/image.jpg
             except Exception:
                 pass
             # Build a pseudo-update object for upload_with_progress
-            await self.upload_with_progress(update, context, progress_msg, out_path, out_name, out_size, update.effective_user.first_name)
+            await self.upload_with_progress(update, context, progress_msg, out_path, out_name, out_size, update.effective_user.first_name, cache_keys)
             try:
                 await progress_msg.delete()
             except Exception:
@@ -1283,6 +2460,8 @@ https://example.com/image.jpg
             asyncio.create_task(self.delayed_file_cleanup(out_path, 20))
         except Exception as e:
             print(f"❌ yt-dlp download error: {e}")
+            if workspace:
+                workspace.release()
             try:
                 await progress_msg.edit_text(f"❌ خطا در دانلود از یوتیوب: {e}")
             except Exception:
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -64,3 +65,143 @@ else:
         'https://piped.mha.fi',
         'https://piped.tokhmi.xyz',
     ]
+
+# Segmented downloads: fetch large files over several parallel Range requests
+# when the server advertises Accept-Ranges. Falls back to a single stream otherwise.
+SEGMENTED_DOWNLOADS = os.getenv('SEGMENTED_DOWNLOADS', 'true').lower() in {'1', 'true', 'yes', 'on'}
+SEGMENT_MIN_SIZE = int(os.getenv('SEGMENT_MIN_SIZE', str(16 * 1024 * 1024)))
+SEGMENT_PIECE_SIZE = int(os.getenv('SEGMENT_PIECE_SIZE', str(8 * 1024 * 1024)))
+SEGMENT_MIN_WORKERS = int(os.getenv('SEGMENT_MIN_WORKERS', '2'))
+SEGMENT_MAX_WORKERS = int(os.getenv('SEGMENT_MAX_WORKERS', '8'))
+
+# Job storage: every job gets its own workspace under STORAGE_DIR (can be a tmpfs mount).
+# STORAGE_QUOTA_BYTES caps the space reserved by all jobs together (0 = no fixed cap);
+# jobs wait for space when the quota is used up or less than STORAGE_MIN_FREE_BYTES is free.
+STORAGE_DIR = os.getenv('STORAGE_DIR', os.path.join(tempfile.gettempdir(), 'tgdl'))
+STORAGE_QUOTA_BYTES = int(os.getenv('STORAGE_QUOTA_BYTES', '0'))
+STORAGE_MIN_FREE_BYTES = int(os.getenv('STORAGE_MIN_FREE_BYTES', str(512 * 1024 * 1024)))
+STORAGE_SWEEP_INTERVAL = int(os.getenv('STORAGE_SWEEP_INTERVAL', '600'))
+STORAGE_MAX_JOB_AGE = int(os.getenv('STORAGE_MAX_JOB_AGE', str(3 * 60 * 60)))
+# Space reserved for a download whose size is not known in advance (no Content-Length,
+# no size in the yt-dlp formats); a download that outgrows it reserves more as it goes.
+STORAGE_UNKNOWN_SIZE_BYTES = int(os.getenv('STORAGE_UNKNOWN_SIZE_BYTES', str(512 * 1024 * 1024)))
+
+# Resumable downloads: unfinished files are kept as <hash>.part plus a JSON manifest
+# in PARTIAL_DIR so retries and restarts continue where they stopped.
+# Partial files untouched for PARTIAL_MAX_AGE seconds are swept.
+PARTIAL_DIR = os.getenv('PARTIAL_DIR', os.path.join(STORAGE_DIR, 'partial'))
+PARTIAL_MAX_AGE = int(os.getenv('PARTIAL_MAX_AGE', str(24 * 60 * 60)))
+DOWNLOAD_RETRIES = int(os.getenv('DOWNLOAD_RETRIES', '5'))
+DOWNLOAD_RETRY_BACKOFF = float(os.getenv('DOWNLOAD_RETRY_BACKOFF', '2'))
+
+# Shared HTTP connection pool used for all downloads and Piped/Invidious API calls
+HTTP_POOL_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', '100'))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', '16'))
+HTTP_DNS_CACHE_TTL = int(os.getenv('HTTP_DNS_CACHE_TTL', '300'))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', '60'))
+
+# Content-addressed cache of downloaded files (LRU, capped in bytes; 0 disables it).
+# Cached URLs are revalidated with If-None-Match/If-Modified-Since before reuse.
+DOWNLOAD_CACHE_DIR = os.getenv('DOWNLOAD_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'dlcache'))
+DOWNLOAD_CACHE_MAX_BYTES = int(os.getenv('DOWNLOAD_CACHE_MAX_BYTES', str(2 * 1024 * 1024 * 1024)))
+
+# Index of Telegram file_ids already delivered (by URL, YouTube ID + height, content hash)
+# so repeat requests are answered without downloading or uploading again.
+# URL entries expire after FILE_ID_URL_TTL seconds since the content behind a URL can change.
+FILE_ID_DB = os.getenv('FILE_ID_DB', os.path.join(tempfile.gettempdir(), 'file_ids.sqlite3'))
+FILE_ID_URL_TTL = int(os.getenv('FILE_ID_URL_TTL', str(24 * 60 * 60)))
+
+# Opt-in: pipe non-video files with a known Content-Length straight from the download
+# into the Telegram upload (no temp file; upload overlaps download).
+STREAM_UPLOADS = os.getenv('STREAM_UPLOADS', 'false').lower() in {'1', 'true', 'yes', 'on'}
+STREAM_BUFFER_CHUNKS = int(os.getenv('STREAM_BUFFER_CHUNKS', '16'))
+
+# Job scheduler: limits on jobs running at once (overall, per user, per source host; 0 = no limit)
+# and on jobs waiting in the queue. Free slots go to waiting users in round-robin order.
+MAX_CONCURRENT_JOBS = int(os.getenv('MAX_CONCURRENT_JOBS', '4'))
+MAX_JOBS_PER_USER = int(os.getenv('MAX_JOBS_PER_USER', '2'))
+MAX_JOBS_PER_HOST = int(os.getenv('MAX_JOBS_PER_HOST', '3'))
+MAX_QUEUED_JOBS = int(os.getenv('MAX_QUEUED_JOBS', '50'))
+MAX_QUEUED_JOBS_PER_USER = int(os.getenv('MAX_QUEUED_JOBS_PER_USER', '5'))
+
+# Progress messages: minimum seconds between edits of one chat's status message
+# (groups are limited more strictly by Telegram) and the global edit budget per second.
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', '2'))
+PROGRESS_GROUP_INTERVAL = float(os.getenv('PROGRESS_GROUP_INTERVAL', '3'))
+PROGRESS_GLOBAL_RATE = float(os.getenv('PROGRESS_GLOBAL_RATE', '20'))
+
+# Bandwidth shaping in bytes per second (0 = unlimited), overall and per user.
+# The first RATE_LIMIT_FREE_BYTES of every transfer are not delayed, so small files stay
+# fast; bulk transfers make up for it and share the remaining bandwidth.
+DOWNLOAD_RATE_LIMIT = int(os.getenv('DOWNLOAD_RATE_LIMIT', '0'))
+DOWNLOAD_RATE_LIMIT_PER_USER = int(os.getenv('DOWNLOAD_RATE_LIMIT_PER_USER', '0'))
+UPLOAD_RATE_LIMIT = int(os.getenv('UPLOAD_RATE_LIMIT', '0'))
+UPLOAD_RATE_LIMIT_PER_USER = int(os.getenv('UPLOAD_RATE_LIMIT_PER_USER', '0'))
+RATE_LIMIT_FREE_BYTES = int(os.getenv('RATE_LIMIT_FREE_BYTES', str(4 * 1024 * 1024)))
+
+# Download writes go through one background writer thread. DISK_WRITE_BUFFERS buffers of
+# DISK_WRITE_BUFFER_SIZE bytes are reused; when all are waiting for the disk, downloads pause.
+DISK_WRITE_BUFFER_SIZE = int(os.getenv('DISK_WRITE_BUFFER_SIZE', str(1024 * 1024)))
+DISK_WRITE_BUFFERS = int(os.getenv('DISK_WRITE_BUFFERS', '32'))
+
+# Hedged YouTube media fetches: after the first Piped/Invidious instance answers a lookup,
+# others get MIRROR_LOOKUP_GRACE more seconds to add their URLs as mirrors. The first
+# HEDGE_SAMPLE_BYTES are then raced across up to HEDGE_MAX_MIRRORS of them and the fastest wins.
+MIRROR_LOOKUP_GRACE = float(os.getenv('MIRROR_LOOKUP_GRACE', '2'))
+HEDGE_MAX_MIRRORS = int(os.getenv('HEDGE_MAX_MIRRORS', '3'))
+HEDGE_SAMPLE_BYTES = int(os.getenv('HEDGE_SAMPLE_BYTES', str(1024 * 1024)))
+
+# Piped/Invidious instance health: lookups go to the INSTANCE_FANOUT best-scoring instances
+# at once. Every instance is probed in the background every INSTANCE_PROBE_INTERVAL seconds
+# (0 = off); after INSTANCE_FAILURE_THRESHOLD failures in a row it is skipped for
+# INSTANCE_OPEN_SECONDS, doubling each time its trial request fails again.
+INSTANCE_FANOUT = int(os.getenv('INSTANCE_FANOUT', '3'))
+INSTANCE_PROBE_INTERVAL = float(os.getenv('INSTANCE_PROBE_INTERVAL', '120'))
+INSTANCE_FAILURE_THRESHOLD = int(os.getenv('INSTANCE_FAILURE_THRESHOLD', '3'))
+INSTANCE_OPEN_SECONDS = float(os.getenv('INSTANCE_OPEN_SECONDS', '300'))
+
+# Invidious lookups are cached per video until the signed stream URLs expire; streams
+# proxied through the instance carry no expiry and are kept for INVIDIOUS_CACHE_TTL seconds.
+INVIDIOUS_CACHE_TTL = int(os.getenv('INVIDIOUS_CACHE_TTL', str(60 * 60)))
+
+# yt-dlp extractions are cached per video and reused for the download. Entries live until the
+# format URLs expire, or YTDLP_INFO_CACHE_TTL seconds when the URLs carry no expiry.
+YTDLP_INFO_CACHE_TTL = int(os.getenv('YTDLP_INFO_CACHE_TTL', str(30 * 60)))
+
+# Number of worker processes for yt-dlp extraction and downloads
+YTDLP_WORKERS = int(os.getenv('YTDLP_WORKERS', '2'))
+
+# yt-dlp transfer tuning: DASH/HLS fragments fetched in parallel, download buffer size,
+# ranged request size for plain HTTP formats (0 = one request), and an optional external
+# downloader (e.g. aria2c) with extra arguments. An external downloader that is not
+# installed is ignored.
+YTDLP_CONCURRENT_FRAGMENTS = int(os.getenv('YTDLP_CONCURRENT_FRAGMENTS', '8'))
+YTDLP_BUFFER_SIZE = int(os.getenv('YTDLP_BUFFER_SIZE', str(1024 * 1024)))
+YTDLP_HTTP_CHUNK_SIZE = int(os.getenv('YTDLP_HTTP_CHUNK_SIZE', str(10 * 1024 * 1024)))
+YTDLP_EXTERNAL_DOWNLOADER = os.getenv('YTDLP_EXTERNAL_DOWNLOADER', '').strip()
+YTDLP_EXTERNAL_DOWNLOADER_ARGS = os.getenv('YTDLP_EXTERNAL_DOWNLOADER_ARGS', '-x 8 -s 8 -k 1M')
+
+# ffmpeg jobs: how many run at once (0 = half the CPU cores), threads per job (0 = cores
+# divided by workers), nice level of encodes, and seconds before a job is stopped.
+FFMPEG_WORKERS = int(os.getenv('FFMPEG_WORKERS', '0'))
+FFMPEG_THREADS = int(os.getenv('FFMPEG_THREADS', '0'))
+FFMPEG_NICE = int(os.getenv('FFMPEG_NICE', '10'))
+FFMPEG_TIMEOUT = float(os.getenv('FFMPEG_TIMEOUT', '3600'))
+
+# Opt-in: while the YouTube quality menu is open, start downloading the quality the user
+# will most likely pick (their last choice, else the highest up to YT_PREFETCH_MAX_HEIGHT)
+# at YT_PREFETCH_RATE bytes per second. It is reused if the choice matches, else deleted.
+YT_PREFETCH = os.getenv('YT_PREFETCH', 'false').lower() in {'1', 'true', 'yes', 'on'}
+YT_PREFETCH_RATE = int(os.getenv('YT_PREFETCH_RATE', str(1024 * 1024)))
+YT_PREFETCH_MAX_HEIGHT = int(os.getenv('YT_PREFETCH_MAX_HEIGHT', '720'))
+# Prefetches running at once (across all open menus), and users whose last choice is remembered
+YT_PREFETCH_MAX_ACTIVE = int(os.getenv('YT_PREFETCH_MAX_ACTIVE', '3'))
+YT_PREFETCH_MAX_USERS = int(os.getenv('YT_PREFETCH_MAX_USERS', '1000'))
+
+# Opt-in: while the "original / 16:9" prompt waits, convert to 16:9 in the background at the
+# lowest CPU priority (idle cores only). Picking 16:9 reuses it; cancel or original kills it.
+VIDEO_PRETRANSCODE = os.getenv('VIDEO_PRETRANSCODE', 'false').lower() in {'1', 'true', 'yes', 'on'}
+
+# Open prompts (video options, YouTube quality) are kept in this SQLite file, so their
+# buttons keep working and their timeouts still fire after a restart.
+PENDING_DB = os.getenv('PENDING_DB', os.path.join(tempfile.gettempdir(), 'pending_prompts.sqlite3'))
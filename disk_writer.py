@@ -0,0 +1,174 @@
+"""
+Off-event-loop disk writer for downloads.
+Incoming chunks are packed into a bounded pool of reusable bytearray buffers
+and written with os.pwrite by one dedicated thread, so slow disks never stall
+the asyncio loop. Running out of free buffers is the backpressure signal.
+"""
+
+import asyncio
+import os
+import queue
+import threading
+
+
+def fadvise(fd: int, advice_name: str, offset: int = 0, length: int = 0):
+    """posix_fadvise hint by name (e.g. 'POSIX_FADV_SEQUENTIAL'); ignored where unsupported."""
+    advice = getattr(os, advice_name, None)
+    if advice is None:
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except (AttributeError, OSError):
+        pass
+
+
+class DiskWriter:
+    """One writer thread fed through a bounded queue, plus the shared buffer pool."""
+
+    def __init__(self, buffer_size: int = 1024 * 1024, buffers: int = 32):
+        self.buffer_size = buffer_size
+        self.buffers = max(2, buffers)
+        self._queue = queue.Queue(maxsize=self.buffers)
+        self._free = None
+        self._thread = None
+
+    def _ensure_started(self):
+        if self._free is None:
+            # Created lazily so it binds to the running event loop
+            self._free = asyncio.Queue()
+            for _ in range(self.buffers):
+                self._free.put_nowait(bytearray(self.buffer_size))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, name="disk-writer", daemon=True)
+            self._thread.start()
+
+    async def acquire(self) -> bytearray:
+        self._ensure_started()
+        return await self._free.get()
+
+    def recycle(self, buf: bytearray):
+        self._free.put_nowait(buf)
+
+    def submit(self, fd: int, buf: bytearray, length: int, offset: int, hasher=None) -> asyncio.Future:
+        """Queue buf[:length] to be written at offset; the buffer goes back to the pool afterwards."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # Never blocks: every queued item holds one of the pool's buffers
+        self._queue.put_nowait((loop, future, fd, buf, length, offset, hasher))
+        return future
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            loop, future, fd, buf, length, offset, hasher = item
+            error = None
+            try:
+                view = memoryview(buf)[:length]
+                if hasher is not None:
+                    hasher.update(view)
+                written = 0
+                while written < length:
+                    written += os.pwrite(fd, view[written:], offset + written)
+                view.release()
+            except Exception as e:
+                error = e
+            loop.call_soon_threadsafe(self._done, future, buf, error)
+
+    def _done(self, future, buf, error):
+        self.recycle(buf)
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(None)
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+class ChunkSink:
+    """Writes one sequential run of a file (from offset onwards) through a DiskWriter.
+
+    on_written(start, length) is called on the event loop once bytes are on disk,
+    which is when they may be recorded as done in a resume manifest. With no
+    writer, chunks are written inline (the old behaviour).
+    """
+
+    def __init__(self, writer, fd: int, offset: int, on_written=None, hasher=None):
+        self.writer = writer
+        self.fd = fd
+        self.offset = offset
+        self.on_written = on_written
+        self.hasher = hasher
+        self._buf = None
+        self._filled = 0
+        self._pending = set()
+        self._error = None
+
+    async def write(self, chunk):
+        self._raise_error()
+        if self.writer is None:
+            if self.hasher is not None:
+                self.hasher.update(chunk)
+            os.pwrite(self.fd, chunk, self.offset)
+            if self.on_written:
+                self.on_written(self.offset, len(chunk))
+            self.offset += len(chunk)
+            return
+        data = memoryview(chunk)
+        while data:
+            if self._buf is None:
+                self._buf = await self.writer.acquire()
+                self._filled = 0
+            n = min(len(data), len(self._buf) - self._filled)
+            self._buf[self._filled:self._filled + n] = data[:n]
+            self._filled += n
+            data = data[n:]
+            if self._filled == len(self._buf):
+                self._submit()
+
+    def _submit(self):
+        if self._buf is None:
+            return
+        if not self._filled:
+            self.writer.recycle(self._buf)
+            self._buf = None
+            return
+        start, length = self.offset, self._filled
+        future = self.writer.submit(self.fd, self._buf, length, start, self.hasher)
+        self._pending.add(future)
+        future.add_done_callback(lambda f: self._written(f, start, length))
+        self.offset += length
+        self._buf = None
+        self._filled = 0
+
+    def _written(self, future, start: int, length: int):
+        self._pending.discard(future)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self._error = self._error or future.exception()
+        elif self.on_written:
+            self.on_written(start, length)
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    async def drain(self, raise_errors: bool = True):
+        """Write out the partly filled buffer and wait until everything is on disk.
+        Use raise_errors=False while another exception is already being handled.
+        """
+        if self.writer is None:
+            return
+        self._submit()
+        if self._pending:
+            await asyncio.wait(list(self._pending))
+        if raise_errors:
+            self._raise_error()
@@ -0,0 +1,138 @@
+"""
+Content-addressed on-disk cache for downloaded files.
+Blobs are stored by SHA-256 and indexed by source URL in SQLite, with an
+overall size cap enforced by least-recently-used eviction.
+"""
+
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+
+def link_or_copy(src: str, dest: str):
+    """Hard-link src to dest (cheap, independent unlink), copying across filesystems."""
+    if os.path.exists(dest):
+        os.unlink(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+class DownloadCache:
+    """Maps URLs to cached file contents plus the validators needed to revalidate them."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, 'objects')
+        self.max_bytes = max_bytes
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, 'index.sqlite3'), check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS objects ("
+                " sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS urls ("
+                " url TEXT PRIMARY KEY, sha256 TEXT NOT NULL, filename TEXT NOT NULL,"
+                " etag TEXT, last_modified TEXT)"
+            )
+
+    def _object_path(self, sha256: str) -> str:
+        return os.path.join(self.objects_dir, sha256)
+
+    def lookup(self, url: str):
+        """Return the cache entry for url as a dict, or None if it is not cached."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT u.sha256, u.filename, u.etag, u.last_modified, o.size"
+                " FROM urls u JOIN objects o ON o.sha256 = u.sha256 WHERE u.url = ?",
+                (url,),
+            ).fetchone()
+        if not row:
+            return None
+        sha256, filename, etag, last_modified, size = row
+        path = self._object_path(sha256)
+        if not os.path.exists(path):
+            self._forget(sha256)
+            return None
+        return {
+            'sha256': sha256,
+            'path': path,
+            'filename': filename,
+            'size': size,
+            'etag': etag,
+            'last_modified': last_modified,
+        }
+
+    def conditional_headers(self, entry) -> dict:
+        """Headers that let the server answer 304 Not Modified for a cached entry."""
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def is_current(self, entry, headers) -> bool:
+        """True if response headers (e.g. from a HEAD probe) carry the same validators as the entry."""
+        if entry.get('etag') and headers.get('ETag'):
+            return headers.get('ETag') == entry['etag']
+        if entry.get('last_modified') and headers.get('Last-Modified'):
+            return headers.get('Last-Modified') == entry['last_modified']
+        return False
+
+    def materialize(self, entry, dest_path: str):
+        """Place a cached blob at dest_path and mark it as recently used."""
+        link_or_copy(entry['path'], dest_path)
+        with self._lock, self._db:
+            self._db.execute("UPDATE objects SET last_access = ? WHERE sha256 = ?", (time.time(), entry['sha256']))
+
+    def store(self, url: str, src_path: str, sha256: str, filename: str, etag=None, last_modified=None):
+        """Add a downloaded file to the cache (blocking: run it in an executor)."""
+        size = os.path.getsize(src_path)
+        if self.max_bytes <= 0 or size > self.max_bytes:
+            return
+        path = self._object_path(sha256)
+        if not os.path.exists(path):
+            tmp_path = path + '.tmp'
+            link_or_copy(src_path, tmp_path)
+            os.replace(tmp_path, path)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO objects (sha256, size, last_access) VALUES (?, ?, ?)",
+                (sha256, size, time.time()),
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO urls (url, sha256, filename, etag, last_modified) VALUES (?, ?, ?, ?, ?)",
+                (url, sha256, filename, etag, last_modified),
+            )
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            victims = []
+            for sha256, size in self._db.execute("SELECT sha256, size FROM objects ORDER BY last_access"):
+                if total <= self.max_bytes:
+                    break
+                victims.append(sha256)
+                total -= size
+        for sha256 in victims:
+            self._forget(sha256)
+            print(f"🧹 Evicted cached file {sha256[:12]} (cache over {self.max_bytes} bytes)")
+
+    def _forget(self, sha256: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM urls WHERE sha256 = ?", (sha256,))
+            self._db.execute("DELETE FROM objects WHERE sha256 = ?", (sha256,))
+        try:
+            os.unlink(self._object_path(sha256))
+        except OSError:
+            pass
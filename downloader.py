@@ -0,0 +1,658 @@
+"""
+HTTP downloader for large direct links.
+Splits a file into byte ranges and fetches them over several connections at once,
+and keeps interrupted downloads as resumable .part files.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import deque
+
+import aiohttp
+
+from disk_writer import ChunkSink, fadvise
+
+# Errors worth retrying with a Range request instead of failing the whole download
+RETRYABLE_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError)
+
+
+class RangeNotSupported(Exception):
+    """Raised when the server ignores a Range request (answers 200 instead of 206)."""
+
+
+class MirrorMismatch(Exception):
+    """Raised when a mirror serves a different file (size) or ignores Range requests."""
+
+
+def accepts_ranges(response) -> bool:
+    """Return True if the response advertises byte-range support."""
+    return (response.headers.get('Accept-Ranges') or '').lower() == 'bytes'
+
+
+def split_ranges(total_size: int, piece_size: int) -> list:
+    """Split [0, total_size) into inclusive (start, end) byte ranges of at most piece_size."""
+    return [(start, min(start + piece_size, total_size) - 1) for start in range(0, total_size, piece_size)]
+
+
+def file_sha256(path: str) -> str:
+    """Hash a file on disk (blocking: run it in an executor)."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def merge_ranges(ranges) -> list:
+    """Merge overlapping or adjacent inclusive (start, end) ranges."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+# Leading bytes that identify common containers, checked in order
+MAGIC_NUMBERS = (
+    ('matroska', 0, b'\x1a\x45\xdf\xa3'),  # MKV and WebM
+    ('mp4', 4, b'ftyp'),
+    ('zip', 0, b'PK\x03\x04'),
+    ('zip', 0, b'PK\x05\x06'),
+    ('rar', 0, b'Rar!\x1a\x07'),
+    ('7z', 0, b'7z\xbc\xaf\x27\x1c'),
+    ('pdf', 0, b'%PDF-'),
+    ('png', 0, b'\x89PNG\r\n\x1a\n'),
+    ('jpeg', 0, b'\xff\xd8\xff'),
+    ('gif', 0, b'GIF8'),
+    ('mp3', 0, b'ID3'),
+    ('ogg', 0, b'OggS'),
+)
+# Kinds that can never hold a video (Ogg, MP4 and Matroska can, as can unrecognised data)
+NON_VIDEO_KINDS = {'zip', 'rar', '7z', 'pdf', 'png', 'jpeg', 'gif', 'mp3'}
+
+
+def sniff_kind(data: bytes) -> str:
+    """Guess the file type from its first bytes ('mp4', 'matroska', 'zip', 'html', ... or 'unknown')."""
+    for kind, offset, magic in MAGIC_NUMBERS:
+        if data[offset:offset + len(magic)] == magic:
+            return kind
+    text = data[:1024].lstrip(b'\xef\xbb\xbf \t\r\n').lower()
+    if text.startswith((b'<!doctype html', b'<html', b'<head', b'<body')) or b'<html' in text:
+        return 'html'
+    return 'unknown'
+
+
+class ProbeResult:
+    """What a pre-flight probe learned about a URL before downloading it."""
+
+    def __init__(self, url: str):
+        self.url = url          # final URL after redirects
+        self.status = 0
+        self.headers = {}
+        self.size = 0
+        self.accepts_ranges = False
+        self.head = b''
+        self.kind = 'unknown'
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status < 300
+
+
+def _content_range_total(value) -> int:
+    # "bytes 0-4095/123456" -> 123456 ("*" when unknown)
+    try:
+        return int((value or '').rsplit('/', 1)[1])
+    except (IndexError, ValueError):
+        return 0
+
+
+async def probe_url(session, url: str, headers=None, sniff_bytes: int = 4096, timeout: float = 15) -> ProbeResult:
+    """HEAD the URL, then GET its first sniff_bytes with a Range request.
+
+    Records the final redirect target, size, whether byte ranges really work
+    (a 206 answer, not just the Accept-Ranges header) and the sniffed file type.
+    """
+    result = ProbeResult(url)
+    request_timeout = aiohttp.ClientTimeout(total=timeout)
+    try:
+        async with session.head(url, headers=headers, allow_redirects=True, timeout=request_timeout) as response:
+            if response.status < 400:
+                result.status = response.status
+                result.url = str(response.url)
+                result.headers = response.headers
+                result.size = int(response.headers.get('Content-Length', 0) or 0)
+                result.accepts_ranges = accepts_ranges(response)
+    except RETRYABLE_ERRORS:
+        pass
+    range_headers = dict(headers or {})
+    range_headers['Range'] = f'bytes=0-{sniff_bytes - 1}'
+    async with session.get(result.url, headers=range_headers, allow_redirects=True, timeout=request_timeout) as response:
+        if response.status not in (200, 206):
+            if not result.ok:
+                result.status = response.status
+            return result
+        result.url = str(response.url)
+        if not result.headers:
+            result.headers = response.headers
+        if response.status == 206:
+            result.accepts_ranges = True
+            result.size = _content_range_total(response.headers.get('Content-Range')) or result.size
+        else:
+            # Range ignored: the server would send the whole body on every request
+            result.accepts_ranges = False
+            result.size = int(response.headers.get('Content-Length', 0) or 0) or result.size
+        result.status = 200
+        head = b''
+        while len(head) < sniff_bytes:
+            chunk = await response.content.read(sniff_bytes - len(head))
+            if not chunk:
+                break
+            head += chunk
+        result.head = head
+        result.kind = sniff_kind(head)
+    return result
+
+
+class PartialFile:
+    """A .part file plus a JSON sidecar manifest recording which byte ranges are on disk.
+
+    The manifest keeps the source URL and its ETag/Last-Modified validators so a later
+    attempt (even after a restart) only resumes when the remote file is unchanged.
+    """
+
+    # .part paths currently being written by this process
+    _active = set()
+
+    def __init__(self, part_path: str, url: str, etag=None, last_modified=None, total_size: int = 0, ranges=None):
+        self.part_path = part_path
+        self.manifest_path = os.path.splitext(part_path)[0] + '.json'
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.total_size = total_size
+        self.ranges = merge_ranges(ranges or [])
+
+    @classmethod
+    def open(cls, directory: str, url: str, etag=None, last_modified=None, total_size: int = 0):
+        """Return the partial download for url, resuming a previous one if its validators still match."""
+        os.makedirs(directory, exist_ok=True)
+        name = hashlib.sha1(url.encode()).hexdigest()[:24]
+        part_path = os.path.join(directory, name + '.part')
+        if part_path in cls._active:
+            # Same URL already downloading in this process: use a private, non-resumable file
+            part_path = os.path.join(directory, f"{name}_{os.urandom(4).hex()}.part")
+        partial = cls(part_path, url, etag, last_modified, total_size)
+        previous = cls._load(part_path)
+        if previous and partial._same_remote(previous) and os.path.exists(part_path):
+            partial.ranges = previous.ranges
+        elif os.path.exists(part_path):
+            os.unlink(part_path)
+        cls._active.add(part_path)
+        return partial
+
+    @classmethod
+    def _load(cls, part_path: str):
+        manifest_path = os.path.splitext(part_path)[0] + '.json'
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return cls(part_path, data['url'], data.get('etag'), data.get('last_modified'),
+                       int(data.get('total_size') or 0), data.get('ranges'))
+        except Exception:
+            return None
+
+    def _same_remote(self, other) -> bool:
+        # Without any validator we cannot tell whether the file changed, so never resume
+        if not (self.etag or self.last_modified):
+            return False
+        return (other.url == self.url and other.total_size == self.total_size
+                and other.etag == self.etag and other.last_modified == self.last_modified)
+
+    @property
+    def if_range(self):
+        """Value for the If-Range header, so a changed file is sent whole instead of spliced."""
+        return self.etag or self.last_modified
+
+    def completed_bytes(self) -> int:
+        return sum(end - start + 1 for start, end in self.ranges)
+
+    def contiguous_end(self) -> int:
+        """Number of bytes available without gaps from the start of the file."""
+        if self.ranges and self.ranges[0][0] == 0:
+            return self.ranges[0][1] + 1
+        return 0
+
+    def missing(self) -> list:
+        """Return the inclusive byte ranges still to be downloaded."""
+        gaps = []
+        position = 0
+        for start, end in self.ranges:
+            if start > position:
+                gaps.append((position, start - 1))
+            position = max(position, end + 1)
+        if position < self.total_size:
+            gaps.append((position, self.total_size - 1))
+        return gaps
+
+    def add_range(self, start: int, end: int):
+        if end >= start:
+            self.ranges = merge_ranges(self.ranges + [[start, end]])
+
+    def reset(self):
+        """Forget everything downloaded so far (remote file changed)."""
+        self.ranges = []
+
+    def save(self):
+        data = {
+            'url': self.url,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'total_size': self.total_size,
+            'ranges': self.ranges,
+        }
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def finish(self, dest_path: str):
+        """Move the completed .part file into place and drop its manifest."""
+        os.replace(self.part_path, dest_path)
+        self._remove_manifest()
+        self.release()
+
+    def discard(self):
+        """Delete the partial data and manifest (e.g. the download turned out to be invalid)."""
+        try:
+            os.unlink(self.part_path)
+        except OSError:
+            pass
+        self._remove_manifest()
+        self.release()
+
+    def release(self):
+        """Stop tracking this file as in use; the data stays on disk for a later resume."""
+        PartialFile._active.discard(self.part_path)
+
+    def _remove_manifest(self):
+        try:
+            os.unlink(self.manifest_path)
+        except OSError:
+            pass
+
+
+def _preallocate(fd: int, total_size: int):
+    if total_size and os.fstat(fd).st_size < total_size:
+        try:
+            os.posix_fallocate(fd, 0, total_size)
+        except (AttributeError, OSError):
+            # Not supported on this platform/filesystem: a sparse file is fine too
+            os.ftruncate(fd, total_size)
+
+
+def _open_for_write(path: str, total_size: int) -> int:
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    _preallocate(fd, total_size)
+    return fd
+
+
+class StreamDownload:
+    """Fetch a file over a single connection into a PartialFile.
+
+    Dropped connections are retried with a Range request starting at the first
+    missing byte, so only the unfinished tail is downloaded again. When the body is
+    received in order from byte 0 its SHA-256 is computed on the fly.
+    """
+
+    def __init__(self, session, url: str, partial: PartialFile, response=None, headers=None,
+                 progress_cb=None, retries: int = 5, backoff: float = 2.0, throttle=None, disk_writer=None):
+        self.session = session
+        self.url = url
+        self.partial = partial
+        self.response = response
+        self.headers = dict(headers or {})
+        self.progress_cb = progress_cb
+        # Optional async callback(nbytes) that paces the transfer (bandwidth shaping)
+        self.throttle = throttle
+        # Optional DiskWriter that takes file writes off the event loop
+        self.disk_writer = disk_writer
+        self.retries = retries
+        self.backoff = backoff
+        self.downloaded = 0
+        self._hasher = None
+        self._hashed = 0
+
+    @property
+    def sha256(self):
+        """Hex digest of the file, or None if it was not received in one ordered pass."""
+        if self._hasher is None or self._hashed != self.downloaded:
+            return None
+        return self._hasher.hexdigest()
+
+    async def run(self) -> int:
+        """Download the rest of the file and return its total size on disk."""
+        fd = _open_for_write(self.partial.part_path, self.partial.total_size)
+        fadvise(fd, 'POSIX_FADV_SEQUENTIAL')
+        attempt = 0
+        try:
+            while True:
+                try:
+                    await self._receive(fd)
+                    break
+                except RETRYABLE_ERRORS as e:
+                    attempt += 1
+                    self.partial.save()
+                    if attempt > self.retries:
+                        raise
+                    delay = self.backoff * (2 ** (attempt - 1))
+                    print(f"⚠️ Download interrupted at {self.partial.contiguous_end()} bytes ({e}); retry {attempt}/{self.retries} in {delay:.0f}s")
+                    await asyncio.sleep(delay)
+        finally:
+            os.close(fd)
+        total = self.partial.contiguous_end()
+        os.truncate(self.partial.part_path, total)
+        return total
+
+    async def _receive(self, fd: int):
+        offset = self.partial.contiguous_end()
+        response, owned = self.response, False
+        self.response = None
+        if response is not None and offset > 0:
+            # The caller's response starts at byte 0 but we already have a prefix on disk
+            response.release()
+            response = None
+        if response is None:
+            headers = dict(self.headers)
+            if offset > 0:
+                headers['Range'] = f'bytes={offset}-'
+                if self.partial.if_range:
+                    headers['If-Range'] = self.partial.if_range
+            response = await self.session.get(self.url, headers=headers, allow_redirects=True)
+            owned = True
+        try:
+            if response.status == 200 and offset > 0:
+                # Range ignored or file changed: start over from the beginning
+                self.partial.reset()
+                offset = 0
+            elif response.status not in (200, 206):
+                raise Exception(f"HTTP {response.status}: نمی‌توان فایل را دانلود کرد")
+            if offset == 0:
+                os.ftruncate(fd, 0)
+                _preallocate(fd, self.partial.total_size)
+                self._hasher, self._hashed = hashlib.sha256(), 0
+            elif self._hashed != offset:
+                # Resumed from a prefix written by an earlier attempt: hash it afterwards instead
+                self._hasher = None
+            self.downloaded = offset
+            last_save = time.monotonic()
+            # Ranges are recorded in the manifest only once the writer has them on disk
+            sink = ChunkSink(
+                self.disk_writer, fd, offset,
+                on_written=lambda start, length: self.partial.add_range(start, start + length - 1),
+                hasher=self._hasher,
+            )
+            try:
+                async for chunk in response.content.iter_chunked(1024 * 1024):  # 1MB chunks for large files
+                    await sink.write(chunk)
+                    if self._hasher is not None:
+                        self._hashed += len(chunk)
+                    offset += len(chunk)
+                    self.downloaded = offset
+                    if time.monotonic() - last_save >= 2:
+                        self.partial.save()
+                        last_save = time.monotonic()
+                    if self.progress_cb:
+                        await self.progress_cb(self.downloaded, self.partial.total_size)
+                    if self.throttle:
+                        await self.throttle(len(chunk))
+            except BaseException:
+                # Keep what already arrived: the retry resumes after it
+                await sink.drain(raise_errors=False)
+                raise
+            await sink.drain()
+            if self.partial.total_size and offset < self.partial.total_size:
+                raise aiohttp.ClientPayloadError(f"connection closed at {offset}/{self.partial.total_size} bytes")
+        finally:
+            if owned:
+                response.release()
+
+
+class SegmentedDownload:
+    """Fetch a file over concurrent Range requests into a preallocated PartialFile.
+
+    The missing part of the file is cut into fixed-size pieces that workers pull from
+    a shared queue. It starts with min_workers connections and adds one more every
+    adapt_interval seconds for as long as the measured throughput keeps improving.
+    A piece that fails mid-way is put back (minus what already arrived) and retried.
+    Pieces can also come from mirrors (other URLs serving the same bytes, e.g. the
+    same stream through several Piped/Invidious proxies); a mirror that fails
+    repeatedly or serves a different file is dropped.
+    """
+
+    def __init__(self, session, url: str, partial: PartialFile, headers=None,
+                 min_workers: int = 2, max_workers: int = 8, piece_size: int = 8 * 1024 * 1024,
+                 progress_cb=None, adapt_interval: float = 2.0, retries: int = 5, backoff: float = 2.0,
+                 throttle=None, disk_writer=None, mirrors=()):
+        self.session = session
+        self.url = url
+        self.urls = [url] + [m for m in mirrors if m and m != url]
+        self._mirrored = len(self.urls) > 1
+        self._next_url = 0
+        self._strikes = {}
+        self.partial = partial
+        self.total_size = partial.total_size
+        self.headers = dict(headers or {})
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.piece_size = piece_size
+        self.progress_cb = progress_cb
+        # Shared by all workers, so the limit applies to the whole file, not per connection
+        self.throttle = throttle
+        self.disk_writer = disk_writer
+        self.adapt_interval = adapt_interval
+        self.retries = retries
+        self.backoff = backoff
+        self.downloaded = 0
+        self._pending = deque()
+        self._tasks = set()
+        self._fd = None
+
+    async def run(self) -> int:
+        """Download all missing ranges and return the file size."""
+        self._fd = _open_for_write(self.partial.part_path, self.total_size)
+        self.downloaded = self.partial.completed_bytes()
+        for start, end in self.partial.missing():
+            for piece in split_ranges(end - start + 1, self.piece_size):
+                self._pending.append((start + piece[0], start + piece[1], 0))
+        try:
+            for _ in range(min(self.min_workers, len(self._pending))):
+                self._spawn()
+            await self._supervise()
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            os.close(self._fd)
+            self.partial.save()
+        return self.downloaded
+
+    def _spawn(self):
+        self._tasks.add(asyncio.create_task(self._worker()))
+
+    async def _supervise(self):
+        last_time = time.monotonic()
+        last_bytes = self.downloaded
+        rate_before_grow = None
+        growing = True
+        while self._tasks:
+            done, _ = await asyncio.wait(self._tasks, timeout=self.adapt_interval, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                self._tasks.discard(task)
+                if task.exception():
+                    raise task.exception()
+            if self._pending and not self._tasks:
+                # Every worker exited while a retried piece was waiting in its backoff
+                self._spawn()
+            now = time.monotonic()
+            if now - last_time < self.adapt_interval:
+                continue
+            rate = (self.downloaded - last_bytes) / (now - last_time)
+            last_time, last_bytes = now, self.downloaded
+            self.partial.save()
+            if self.progress_cb:
+                await self.progress_cb(self.downloaded, self.total_size)
+            # Add a connection while each extra one still buys at least 10% more throughput
+            if growing and self._pending and len(self._tasks) < self.max_workers:
+                if rate_before_grow is None or rate > rate_before_grow * 1.1:
+                    rate_before_grow = rate
+                    self._spawn()
+                else:
+                    growing = False
+
+    def _pick_url(self) -> str:
+        url = self.urls[self._next_url % len(self.urls)]
+        self._next_url += 1
+        return url
+
+    def _drop_mirror(self, url: str, reason):
+        if url in self.urls and len(self.urls) > 1:
+            self.urls.remove(url)
+            print(f"⚠️ Dropping mirror {url[:60]}… ({reason}); {len(self.urls)} source(s) left")
+
+    async def _worker(self):
+        while self._pending:
+            start, end, attempt = self._pending.popleft()
+            offset = start
+            url = self._pick_url()
+            try:
+                offset = await self._fetch_range(url, start, end)
+            except MirrorMismatch as e:
+                if url in self.urls and len(self.urls) == 1:
+                    raise RangeNotSupported(str(e))
+                self._drop_mirror(url, e)
+                self._pending.appendleft((start, end, attempt))
+            except RETRYABLE_ERRORS as e:
+                offset = getattr(e, 'offset', start)
+                self._strikes[url] = self._strikes.get(url, 0) + 1
+                if url not in self.urls or (self._strikes[url] >= 2 and len(self.urls) > 1):
+                    # Another source is available: retry there right away
+                    self._drop_mirror(url, e)
+                    self._pending.appendleft((offset, end, attempt))
+                    continue
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * (2 ** attempt)
+                print(f"⚠️ Range {offset}-{end} failed ({e}); retry {attempt + 1}/{self.retries} in {delay:.0f}s")
+                await asyncio.sleep(delay)
+                self._pending.append((offset, end, attempt + 1))
+
+    async def _fetch_range(self, url: str, start: int, end: int) -> int:
+        headers = dict(self.headers)
+        headers['Range'] = f'bytes={start}-{end}'
+        # Validators belong to the primary URL; mirrors are checked by size instead
+        if self.partial.if_range and url == self.url:
+            headers['If-Range'] = self.partial.if_range
+        offset = start
+        try:
+            async with self.session.get(url, headers=headers, allow_redirects=True) as response:
+                if response.status == 200:
+                    if url == self.url:
+                        raise RangeNotSupported(f"Server ignored Range request for {url}")
+                    raise MirrorMismatch("Range request ignored")
+                if response.status != 206:
+                    if self._mirrored:
+                        raise MirrorMismatch(f"HTTP {response.status}")
+                    raise Exception(f"HTTP {response.status}: دریافت بخش {start}-{end} ممکن نیست")
+                total = _content_range_total(response.headers.get('Content-Range'))
+                if url != self.url and total and self.total_size and total != self.total_size:
+                    raise MirrorMismatch(f"size {total} != {self.total_size}")
+                sink = ChunkSink(
+                    self.disk_writer, self._fd, offset,
+                    on_written=lambda first, length: self.partial.add_range(first, first + length - 1),
+                )
+                try:
+                    async for chunk in response.content.iter_chunked(1024 * 1024):
+                        n = min(len(chunk), end + 1 - offset)
+                        await sink.write(memoryview(chunk)[:n] if n < len(chunk) else chunk)
+                        offset += n
+                        self.downloaded += n
+                        if offset > end:
+                            break
+                        if self.throttle:
+                            await self.throttle(n)
+                except BaseException:
+                    await sink.drain(raise_errors=False)
+                    raise
+                await sink.drain()
+                if offset <= end:
+                    raise aiohttp.ClientPayloadError(f"range {start}-{end} closed at byte {offset}")
+        except RETRYABLE_ERRORS as e:
+            e.offset = offset
+            raise
+        return offset
+
+
+async def _sample_mirror(session, url: str, headers, sample_bytes: int) -> tuple:
+    """Fetch the first sample_bytes of url; return (url, seconds, total_size)."""
+    range_headers = dict(headers or {})
+    range_headers['Range'] = f'bytes=0-{sample_bytes - 1}'
+    started = time.monotonic()
+    async with session.get(url, headers=range_headers, allow_redirects=True) as response:
+        if response.status not in (200, 206):
+            raise aiohttp.ClientResponseError(response.request_info, (), status=response.status)
+        total = _content_range_total(response.headers.get('Content-Range')) if response.status == 206 \
+            else int(response.headers.get('Content-Length', 0) or 0)
+        received = 0
+        while received < sample_bytes:
+            chunk = await response.content.read(sample_bytes - received)
+            if not chunk:
+                break
+            received += len(chunk)
+    return url, time.monotonic() - started, total
+
+
+async def hedge_mirrors(session, urls, headers=None, sample_bytes: int = 1024 * 1024,
+                        grace: float = 1.0, min_grace: float = 0.5, timeout: float = 20) -> list:
+    """Race the first sample_bytes from every mirror and return the usable URLs, fastest first.
+
+    The first mirror to deliver its sample wins. Mirrors that finish within another
+    grace * (winner's time), but at least min_grace seconds, are kept as extra sources
+    for segmented downloads; the rest are cancelled. If mirrors disagree on the file
+    size, the size most of them report wins. With a single URL nothing is fetched.
+    """
+    urls = list(dict.fromkeys(u for u in urls if u))
+    if len(urls) <= 1:
+        return urls
+    tasks = {asyncio.create_task(_sample_mirror(session, u, headers, sample_bytes)): u for u in urls}
+    finished = []
+    deadline = time.monotonic() + timeout
+    try:
+        pending = set(tasks)
+        while pending:
+            if finished:
+                deadline = min(deadline, finished[0][2] + max(finished[0][1] * grace, min_grace))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    url, seconds, total = task.result()
+                    finished.append((url, seconds, time.monotonic(), total))
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    if not finished:
+        return urls
+    totals = [total for _, _, _, total in finished if total]
+    winner_total = max(totals, key=totals.count) if totals else 0
+    ranked = [url for url, _, _, total in finished if not winner_total or not total or total == winner_total]
+    print(f"🏁 Fastest mirror delivered the first {sample_bytes // 1024} KB in {finished[0][1]:.2f}s; using {len(ranked)} of {len(urls)}")
+    return ranked
@@ -0,0 +1,236 @@
+"""
+Bounded pool for ffmpeg jobs.
+At most `workers` ffmpeg processes run at once, each with a thread cap and a
+nice level, so a few conversions cannot take every core from the bot.
+Progress comes from `-progress pipe:1`, only the tail of stderr is kept for
+error messages, and a job that is cancelled or runs past its timeout has its
+process terminated (then killed) instead of being left running.
+Background jobs (speculative work nobody is waiting for yet) run beside the
+worker slots in the idle scheduling class, so they only use CPU time that
+nothing else wants, and can be promoted once someone does wait for them.
+"""
+
+import asyncio
+import os
+import re
+from collections import deque
+
+
+class FfmpegError(RuntimeError):
+    """ffmpeg exited with an error or ran past its timeout."""
+
+
+_DURATION_RE = re.compile(rb"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+
+def default_workers() -> int:
+    return max(1, (os.cpu_count() or 2) // 2)
+
+
+class FfmpegPool:
+    """Runs ffmpeg commands; see the module docstring."""
+
+    def __init__(self, workers: int = 0, threads: int = 0, nice: int = 10,
+                 timeout: float = 3600, stderr_limit: int = 16 * 1024):
+        self.workers = workers if workers > 0 else default_workers()
+        # Split the cores between the jobs that may run at once
+        self.threads = threads if threads > 0 else max(1, (os.cpu_count() or 2) // self.workers)
+        self.nice = nice
+        self.timeout = timeout
+        self.stderr_limit = stderr_limit
+        self._slots = asyncio.Semaphore(self.workers)
+        self._background = asyncio.Semaphore(self.workers)
+        self.running = set()
+
+    def _command(self, args: list, threads: int) -> list:
+        # args is ffmpeg's argument list without the program name, ending with the output path
+        return [
+            "ffmpeg", "-hide_banner", "-nostdin", "-y",
+            "-nostats", "-progress", "pipe:1",
+            "-filter_threads", str(threads),
+            *args[:-1],
+            "-threads", str(threads),
+            args[-1],
+        ]
+
+    async def run(self, args: list, on_progress=None, duration: float | None = None,
+                  nice: int | None = None, threads: int | None = None, timeout: float | None = None,
+                  background: bool = False, on_start=None, promoted: asyncio.Event | None = None):
+        """Run one ffmpeg job once a slot is free.
+
+        on_progress(seconds_done, duration_seconds, speed) is awaited as ffmpeg reports
+        progress; without duration it is taken from the input's "Duration:" line.
+        Cancelling the caller stops ffmpeg, whether it is running or still waiting for a slot.
+        background jobs wait for a background slot instead and run at the lowest priority;
+        on_start(proc) is called once the process exists (e.g. to promote() it later).
+        Setting promoted turns a background job that has not started yet into a normal one:
+        it moves to the normal queue and starts at normal priority.
+        """
+        slot = await self._acquire(background, promoted)
+        try:
+            return await self._run(
+                args, on_progress, duration,
+                self.nice if nice is None else nice,
+                threads or self.threads,
+                self.timeout if timeout is None else timeout,
+                background, on_start, promoted,
+            )
+        finally:
+            slot.release()
+
+    async def _acquire(self, background: bool, promoted) -> asyncio.Semaphore:
+        """Wait for a slot and return the semaphore it was taken from."""
+        if background and not (promoted and promoted.is_set()):
+            if promoted is None:
+                await self._background.acquire()
+                return self._background
+            acquire = asyncio.ensure_future(self._background.acquire())
+            wakeup = asyncio.ensure_future(promoted.wait())
+            try:
+                await asyncio.wait((acquire, wakeup), return_when=asyncio.FIRST_COMPLETED)
+            except BaseException:
+                wakeup.cancel()
+                if acquire.done() and not acquire.cancelled():
+                    self._background.release()
+                else:
+                    acquire.cancel()
+                raise
+            wakeup.cancel()
+            if acquire.done():
+                return self._background
+            # Promoted while waiting: someone wants the result now, queue like any other job
+            acquire.cancel()
+        await self._slots.acquire()
+        return self._slots
+
+    async def _run(self, args, on_progress, duration, nice, threads, timeout, background, on_start, promoted):
+        proc = await asyncio.create_subprocess_exec(
+            *self._command(args, threads),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        self.running.add(proc)
+        if background and not (promoted and promoted.is_set()):
+            self.idle(proc)
+        elif nice:
+            self.renice(proc, nice)
+        if on_start:
+            on_start(proc)
+        stderr_tail = deque()
+        state = {"duration": duration, "stderr_bytes": 0}
+
+        async def read_stderr():
+            async for line in proc.stderr:
+                if not state["duration"]:
+                    m = _DURATION_RE.search(line)
+                    if m:
+                        h, mnt, sec = m.groups()
+                        state["duration"] = int(h) * 3600 + int(mnt) * 60 + float(sec)
+                stderr_tail.append(line)
+                state["stderr_bytes"] += len(line)
+                while state["stderr_bytes"] > self.stderr_limit and len(stderr_tail) > 1:
+                    state["stderr_bytes"] -= len(stderr_tail.popleft())
+
+        async def read_progress():
+            fields = {}
+            async for raw in proc.stdout:
+                key, _, value = raw.decode(errors="ignore").strip().partition("=")
+                fields[key] = value
+                if key != "progress":
+                    continue
+                # One block of key=value lines ends with progress=continue|end
+                micros = fields.get("out_time_us") or fields.get("out_time_ms") or ""
+                speed = fields.get("speed", "").rstrip("x").strip()
+                if on_progress and micros.isdigit():
+                    try:
+                        await on_progress(int(micros) / 1_000_000, state["duration"] or 0,
+                                          float(speed) if speed and speed != "N/A" else 0.0)
+                    except Exception:
+                        pass
+                fields = {}
+
+        readers = asyncio.gather(read_stderr(), read_progress())
+        try:
+            await asyncio.wait_for(asyncio.shield(readers), timeout=timeout or None)
+            returncode = await proc.wait()
+        except asyncio.TimeoutError:
+            await self._stop(proc)
+            raise FfmpegError(f"ffmpeg ran longer than {timeout:g}s and was stopped")
+        except BaseException:
+            await self._stop(proc)
+            raise
+        finally:
+            readers.cancel()
+            try:
+                await readers
+            except BaseException:
+                pass
+            self.running.discard(proc)
+        if returncode != 0:
+            tail = b"".join(stderr_tail).decode(errors="ignore")
+            raise FfmpegError(tail[-400:] or f"ffmpeg exited with code {returncode}")
+        return returncode
+
+    @staticmethod
+    def _threads(proc) -> list:
+        # Priorities are per thread on Linux: cover the encoder threads ffmpeg already started
+        try:
+            return [int(tid) for tid in os.listdir(f"/proc/{proc.pid}/task")]
+        except OSError:
+            return [proc.pid]
+
+    @classmethod
+    def renice(cls, proc, nice: int) -> bool:
+        """Set the nice level of every thread; False if any of them refused."""
+        ok = True
+        for tid in cls._threads(proc):
+            try:
+                os.setpriority(os.PRIO_PROCESS, tid, nice)
+            except AttributeError:
+                pass
+            except OSError:
+                ok = False
+        return ok
+
+    @classmethod
+    def idle(cls, proc):
+        """Lowest priority: nice 19 and, where supported, the SCHED_IDLE class."""
+        cls.renice(proc, 19)
+        for tid in cls._threads(proc):
+            try:
+                os.sched_setscheduler(tid, os.SCHED_IDLE, os.sched_param(0))
+            except (AttributeError, OSError):
+                pass
+
+    def promote(self, proc) -> bool:
+        """Give a running background job the normal job priority. Raising priority back needs
+        privileges (RLIMIT_NICE / CAP_SYS_NICE), which containers usually lack: returns False
+        when it was refused, and the job is still running at idle priority."""
+        if proc.returncode is not None:
+            return True
+        ok = True
+        for tid in self._threads(proc):
+            try:
+                os.sched_setscheduler(tid, os.SCHED_OTHER, os.sched_param(0))
+            except AttributeError:
+                pass
+            except OSError:
+                ok = False
+        return self.renice(proc, self.nice) and ok
+
+    async def _stop(self, proc):
+        if proc.returncode is not None:
+            return
+        try:
+            proc.terminate()
+            await asyncio.wait_for(proc.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+        except ProcessLookupError:
+            pass
+
+    async def close(self):
+        """Stop every running job (bot shutdown)."""
+        await asyncio.gather(*(self._stop(proc) for proc in list(self.running)), return_exceptions=True)
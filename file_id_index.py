@@ -0,0 +1,64 @@
+"""
+Persistent index of files already delivered to Telegram.
+Maps a source (URL, YouTube ID + height, or content SHA-256) to the Telegram
+file_id returned by the upload, so repeat requests can be answered by
+re-sending that file_id instead of downloading and uploading again.
+"""
+
+import sqlite3
+import threading
+import time
+
+
+class FileIdIndex:
+    """SQLite-backed (kind, key) -> (file_id, media_type) map."""
+
+    def __init__(self, db_path: str, ttl_by_kind=None):
+        # Optional max age per key kind, e.g. {'url': 86400} since a URL's content may change
+        self.ttl_by_kind = dict(ttl_by_kind or {})
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS deliveries ("
+                " kind TEXT NOT NULL, key TEXT NOT NULL, file_id TEXT NOT NULL,"
+                " media_type TEXT NOT NULL, created REAL NOT NULL,"
+                " PRIMARY KEY (kind, key))"
+            )
+
+    def get(self, kind: str, key: str):
+        """Return (file_id, media_type) for a source, or None if unknown or expired."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT file_id, media_type, created FROM deliveries WHERE kind = ? AND key = ?",
+                (kind, key),
+            ).fetchone()
+        if not row:
+            return None
+        file_id, media_type, created = row
+        ttl = self.ttl_by_kind.get(kind)
+        if ttl and time.time() - created > ttl:
+            return None
+        return file_id, media_type
+
+    def lookup(self, keys):
+        """Return the first (file_id, media_type) found for any of the (kind, key) pairs."""
+        for kind, key in keys:
+            hit = self.get(kind, key)
+            if hit:
+                return hit
+        return None
+
+    def put(self, keys, file_id: str, media_type: str):
+        """Record a delivered file_id under every (kind, key) pair."""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO deliveries (kind, key, file_id, media_type, created) VALUES (?, ?, ?, ?, ?)",
+                [(kind, key, file_id, media_type, now) for kind, key in keys],
+            )
+
+    def forget(self, file_id: str):
+        """Drop a file_id that Telegram no longer accepts."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM deliveries WHERE file_id = ?", (file_id,))
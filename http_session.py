@@ -0,0 +1,45 @@
+"""
+Application-wide aiohttp session shared by every outbound HTTP request.
+Keeps connections alive and caches DNS so repeated requests to the same
+CDN or Piped/Invidious instance skip DNS, TCP and TLS setup.
+"""
+
+import aiohttp
+
+
+class HttpSessionManager:
+    """Owns the single long-lived aiohttp.ClientSession and its connection pool."""
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 16, dns_ttl: int = 300,
+                 keepalive_timeout: float = 60, connect_timeout: float = 30):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.connect_timeout = connect_timeout
+        self._session = None
+
+    async def start(self):
+        """Create the pooled session (called once the event loop is running)."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+                enable_cleanup_closed=True,
+            )
+            # No overall timeout: downloads can take hours. Callers pass tighter per-request timeouts.
+            timeout = aiohttp.ClientTimeout(total=None, connect=self.connect_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Return the shared session, creating it lazily if start() has not run yet."""
+        return await self.start()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
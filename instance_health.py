@@ -0,0 +1,180 @@
+"""
+Health tracking for Piped/Invidious instances.
+Every lookup and a periodic background probe record latency and success per
+instance. Instances are ranked by a score built from their recent latency and
+error rate; one that keeps failing has its circuit opened and is skipped until
+a cool-down passes, after which a single trial decides whether it comes back.
+"""
+
+import asyncio
+import contextlib
+import time
+from collections import deque
+
+import aiohttp
+
+
+# Cheap endpoints used by the background probe
+PROBE_PATHS = {
+    "piped": "/healthcheck",
+    "invidious": "/api/v1/stats",
+}
+
+
+class InstanceStats:
+    """Rolling stats and circuit breaker state of one instance."""
+
+    def __init__(self, base: str, order: int, window: int):
+        self.base = base
+        # Position in the config list; breaks ties between instances with equal scores
+        self.order = order
+        self.latency = None
+        self.outcomes = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.cooldown = 0.0
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def score(self, default_latency: float) -> float:
+        """Lower is better: smoothed latency, inflated by the recent error rate."""
+        latency = self.latency if self.latency is not None else default_latency
+        return latency * (1 + 4 * self.error_rate)
+
+    def is_open(self, now: float) -> bool:
+        return now < self.open_until
+
+
+class _Attempt:
+    def __init__(self):
+        # Set to False when the instance answered, but badly (e.g. HTTP 5xx)
+        self.ok = True
+
+
+class InstanceHealth:
+    """Scores, circuit breakers and the background probe for each kind of instance."""
+
+    def __init__(self, instances: dict, window: int = 20, failure_threshold: int = 3,
+                 open_seconds: float = 300, max_open_seconds: float = 3600,
+                 probe_interval: float = 120, probe_timeout: float = 10, default_latency: float = 2.0):
+        # instances: {"piped": [base, ...], "invidious": [...]}
+        self.stats = {
+            kind: {base: InstanceStats(base, i, window) for i, base in enumerate(bases)}
+            for kind, bases in instances.items()
+        }
+        self.window = window
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max(open_seconds, max_open_seconds)
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.default_latency = default_latency
+        self._task = None
+
+    def _get(self, kind: str, base: str) -> InstanceStats:
+        instances = self.stats.setdefault(kind, {})
+        if base not in instances:
+            instances[base] = InstanceStats(base, len(instances), self.window)
+        return instances[base]
+
+    def record(self, kind: str, base: str, ok: bool, latency: float | None = None):
+        """Record the outcome of one request to an instance."""
+        stats = self._get(kind, base)
+        stats.outcomes.append(ok)
+        if ok:
+            if latency is not None:
+                stats.latency = latency if stats.latency is None else 0.7 * stats.latency + 0.3 * latency
+            if stats.open_until:
+                print(f"✅ {kind} instance {base} is healthy again")
+            stats.consecutive_failures = 0
+            stats.open_until = 0.0
+            stats.cooldown = 0.0
+            return
+        stats.consecutive_failures += 1
+        now = time.monotonic()
+        if stats.open_until and not stats.is_open(now):
+            # The trial after a cool-down failed: back off for twice as long
+            stats.cooldown = min(self.max_open_seconds, stats.cooldown * 2)
+        elif stats.consecutive_failures >= self.failure_threshold and not stats.open_until:
+            stats.cooldown = self.open_seconds
+        else:
+            return
+        stats.open_until = now + stats.cooldown
+        print(f"🔌 Circuit open for {kind} instance {base} ({stats.cooldown:.0f}s)")
+
+    @contextlib.contextmanager
+    def track(self, kind: str, base: str):
+        """Time the block and record it; an exception or attempt.ok = False counts as a failure."""
+        attempt = _Attempt()
+        started = time.monotonic()
+        try:
+            yield attempt
+        except asyncio.CancelledError:
+            # Cancelled because another instance answered first: says nothing about this one
+            raise
+        except Exception:
+            self.record(kind, base, False)
+            raise
+        self.record(kind, base, attempt.ok, time.monotonic() - started if attempt.ok else None)
+
+    def ranked(self, kind: str) -> list:
+        """Instances to try, best score first. Open circuits are left out; if every circuit is
+        open, all instances are returned with the soonest to close first so lookups still run."""
+        now = time.monotonic()
+        instances = list(self.stats.get(kind, {}).values())
+        usable = [s for s in instances if not s.is_open(now)]
+        if not usable:
+            return [s.base for s in sorted(instances, key=lambda s: s.open_until)]
+        usable.sort(key=lambda s: (s.score(self.default_latency), s.order))
+        return [s.base for s in usable]
+
+    def batches(self, kind: str, size: int) -> list:
+        """ranked() cut into groups of size, for trying the top K at once, then the next K."""
+        bases = self.ranked(kind)
+        size = max(1, size)
+        return [bases[i:i + size] for i in range(0, len(bases), size)]
+
+    def start(self, get_session):
+        if self._task is None and self.probe_interval > 0:
+            self._task = asyncio.create_task(self._run(get_session))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, get_session):
+        while True:
+            try:
+                await self.probe_all(await get_session())
+            except Exception as e:
+                print(f"⚠️ Instance probe error: {e}")
+            await asyncio.sleep(self.probe_interval)
+
+    async def probe_all(self, session):
+        """Probe every instance concurrently. Open circuits are only probed once their
+        cool-down is over, which makes the probe their trial request."""
+        now = time.monotonic()
+        probes = [
+            self._probe(session, kind, stats.base)
+            for kind, instances in self.stats.items()
+            for stats in instances.values()
+            if not stats.is_open(now)
+        ]
+        await asyncio.gather(*probes, return_exceptions=True)
+
+    async def _probe(self, session, kind: str, base: str):
+        url = base.rstrip('/') + PROBE_PATHS.get(kind, "/")
+        timeout = aiohttp.ClientTimeout(total=self.probe_timeout)
+        with self.track(kind, base) as attempt:
+            async with session.get(url, timeout=timeout, allow_redirects=True) as r:
+                # Any non-5xx answer means the instance is up and reachable
+                attempt.ok = r.status < 500
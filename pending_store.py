@@ -0,0 +1,146 @@
+"""
+Persistent store for prompts waiting on a user's choice (video options, YouTube quality).
+Each open prompt is a small __slots__ record holding only IDs, a file path and the
+options needed to act on it later, never Telegram objects. Records are written to
+SQLite so open prompts survive a restart, and a single heap-driven timer expires
+them in deadline order instead of scheduling one job per prompt.
+"""
+
+import asyncio
+import heapq
+import json
+import sqlite3
+import threading
+import time
+
+
+class PendingRecord:
+    """One open prompt: who asked, which message shows the buttons, and what to act on."""
+
+    __slots__ = ("token", "kind", "chat_id", "message_id", "user_id", "file_path", "options", "expires_at")
+
+    def __init__(self, token: str, kind: str, chat_id: int, message_id: int, user_id: int,
+                 file_path: str | None = None, options: dict | None = None, expires_at: float = 0.0):
+        self.token = token
+        self.kind = kind
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.user_id = user_id
+        self.file_path = file_path
+        # JSON-serializable details of the prompt (file name, URL, user name, ...)
+        self.options = options or {}
+        self.expires_at = expires_at
+
+
+class PendingStore:
+    """token -> PendingRecord, mirrored to SQLite, with one timer for every expiry.
+
+    Writes are small single-row commits done on the event loop, like FileIdIndex: one
+    per prompt shown or answered, which is cheap at a bot's rate of prompts.
+    """
+
+    def __init__(self, db_path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS pending ("
+                " token TEXT PRIMARY KEY, kind TEXT NOT NULL, chat_id INTEGER NOT NULL,"
+                " message_id INTEGER NOT NULL, user_id INTEGER NOT NULL, file_path TEXT,"
+                " options TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            rows = self._db.execute(
+                "SELECT token, kind, chat_id, message_id, user_id, file_path, options, expires_at FROM pending"
+            ).fetchall()
+        self._records = {}
+        # (expires_at, token); entries of records answered meanwhile are skipped when popped
+        self._heap = []
+        for token, kind, chat_id, message_id, user_id, file_path, options, expires_at in rows:
+            try:
+                options = json.loads(options)
+            except ValueError:
+                options = {}
+            self._records[token] = PendingRecord(token, kind, chat_id, message_id, user_id, file_path, options, expires_at)
+            self._heap.append((expires_at, token))
+        heapq.heapify(self._heap)
+        self._on_expire = None
+        self._wakeup = None
+        self._task = None
+        # Running on_expire calls: the record is already deleted, so they must not be lost
+        self._expiring = set()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def records(self, kind: str | None = None) -> list:
+        return [r for r in self._records.values() if kind is None or r.kind == kind]
+
+    def add(self, token: str, kind: str, chat_id: int, message_id: int, user_id: int,
+            file_path: str | None = None, options: dict | None = None, ttl: float = 60 * 60) -> PendingRecord:
+        """Store a new prompt that expires ttl seconds from now."""
+        record = PendingRecord(token, kind, chat_id, message_id, user_id, file_path, options, time.time() + ttl)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pending (token, kind, chat_id, message_id, user_id, file_path, options, expires_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (token, kind, chat_id, message_id, user_id, file_path, json.dumps(record.options), record.expires_at),
+            )
+        self._records[token] = record
+        wake = not self._heap or record.expires_at < self._heap[0][0]
+        heapq.heappush(self._heap, (record.expires_at, token))
+        if wake and self._wakeup is not None:
+            self._wakeup.set()
+        return record
+
+    def get(self, token: str):
+        return self._records.get(token)
+
+    def pop(self, token: str):
+        """Remove and return a prompt (answered or expired), or None if it is already gone."""
+        record = self._records.pop(token, None)
+        if record is not None:
+            with self._lock, self._db:
+                self._db.execute("DELETE FROM pending WHERE token = ?", (token,))
+        return record
+
+    def start(self, on_expire):
+        """Run the expiry timer: await on_expire(record) for each prompt that runs out.
+        Prompts that expired while the bot was down fire right away."""
+        self._on_expire = on_expire
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                expires_at, token = heapq.heappop(self._heap)
+                record = self._records.get(token)
+                if record is None or record.expires_at != expires_at:
+                    continue
+                self.pop(token)
+                task = asyncio.create_task(self._expire(record))
+                self._expiring.add(task)
+                task.add_done_callback(self._expiring.discard)
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _expire(self, record: PendingRecord):
+        try:
+            await self._on_expire(record)
+        except Exception as e:
+            print(f"⚠️ Expiring pending {record.kind} prompt {record.token} failed: {e}")
@@ -0,0 +1,201 @@
+"""
+Central renderer for progress messages.
+Transfers only record their latest state here; a single background task turns
+that state into edit_text calls: one status message per chat, unchanged text
+skipped, paced to Telegram's per-chat and global edit limits.
+"""
+
+import asyncio
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+
+POINTER_TEXT = "📊 پیشرفت این درخواست در پیام وضعیت بالاتر نمایش داده می‌شود."
+
+
+class ProgressJob:
+    """Handle a transfer reports to. Calling it is cheap and never waits on Telegram."""
+
+    def __init__(self, renderer, progress_msg, format_fn, reply_markup=None):
+        self.renderer = renderer
+        self.progress_msg = progress_msg
+        # format_fn(done, total, elapsed) -> (full_text, one_line_summary)
+        self.format_fn = format_fn
+        # Buttons kept under the job's message (edits without them would remove them)
+        self.reply_markup = reply_markup
+        self.started = time.monotonic()
+        self.text = None
+        self.line = None
+        self.closed = False
+
+    async def __call__(self, done: int, total: int):
+        if self.closed or total <= 0:
+            return
+        self.text, self.line = self.format_fn(done, total, time.monotonic() - self.started)
+
+    async def close(self):
+        """Stop rendering this job; await before the owner edits or deletes its message.
+        Returns once an edit already on its way to Telegram has landed, so it cannot
+        overwrite what the owner sends next."""
+        if not self.closed:
+            self.closed = True
+            self.renderer.remove(self)
+        await self.renderer.settle(self)
+
+    def targets(self) -> list:
+        # A ProgressFanout mirrors one shared job to several requesters' messages
+        messages = getattr(self.progress_msg, "messages", None)
+        if messages is None:
+            messages = [self.progress_msg]
+        return [m for m in messages if m is not None]
+
+
+class _ChatState:
+    def __init__(self):
+        self.next_at = 0.0
+        self.backoff = 1.0
+        self.last_text = {}
+
+
+class ProgressRenderer:
+    """Owns every progress edit; see the module docstring."""
+
+    def __init__(self, interval: float = 2.0, group_interval: float = 3.0, global_rate: float = 20.0, tick: float = 0.5):
+        self.interval = interval
+        self.group_interval = group_interval
+        self.global_rate = global_rate
+        self.tick = tick
+        self.jobs = []
+        self.chats = {}
+        # Drops after every RetryAfter and recovers on successful edits
+        self.global_factor = 1.0
+        self._dead = set()
+        # (chat_id, message_id) -> the edit task currently sending to that message
+        self._inflight = {}
+        self._task = None
+
+    def job(self, progress_msg, format_fn, reply_markup=None) -> ProgressJob:
+        job = ProgressJob(self, progress_msg, format_fn, reply_markup)
+        self.jobs.append(job)
+        return job
+
+    def remove(self, job: ProgressJob):
+        if job in self.jobs:
+            self.jobs.remove(job)
+
+    async def settle(self, job: ProgressJob):
+        """Wait for in-flight edits to any of job's messages."""
+        tasks = [
+            self._inflight[key] for key in {(m.chat_id, m.message_id) for m in job.targets()}
+            if key in self._inflight
+        ]
+        if tasks:
+            await asyncio.gather(*(asyncio.shield(t) for t in tasks), return_exceptions=True)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.render_once()
+            except Exception as e:
+                print(f"⚠️ Progress renderer error: {e}")
+
+    def _plan(self) -> dict:
+        """Group active jobs by chat: chat_id -> [(job, message), ...] in start order."""
+        by_chat = {}
+        for job in self.jobs:
+            if job.text is None:
+                continue
+            for message in job.targets():
+                if (message.chat_id, message.message_id) in self._dead:
+                    continue
+                by_chat.setdefault(message.chat_id, []).append((job, message))
+        return by_chat
+
+    def _compose(self, entries: list) -> dict:
+        """Return {message: (text, reply_markup)}: the oldest job's message shows every job
+        in the chat. Each message keeps its own job's buttons."""
+        status = entries[0][1]
+        if len(entries) == 1:
+            return {status: (entries[0][0].text, entries[0][0].reply_markup)}
+        lines = [f"{i}) {job.line}" for i, (job, _) in enumerate(entries, 1)]
+        texts = {status: (f"📊 {len(entries)} کار فعال در این گفتگو:\n\n" + "\n\n".join(lines), entries[0][0].reply_markup)}
+        for job, message in entries[1:]:
+            texts.setdefault(message, (POINTER_TEXT, job.reply_markup))
+        return texts
+
+    async def render_once(self):
+        now = time.monotonic()
+        by_chat = self._plan()
+        # Forget state of chats and messages that have no active job any more
+        self.chats = {cid: st for cid, st in self.chats.items() if cid in by_chat or st.next_at > now}
+        live = {(m.chat_id, m.message_id) for entries in by_chat.values() for _, m in entries}
+        self._dead &= live
+
+        rate = max(0.5, self.global_rate * self.global_factor)
+        # Stay under the global edit rate even when many chats are active at once
+        spread = len(by_chat) / rate
+        budget = max(1, int(rate * self.tick))
+        edits = []
+        for chat_id in sorted(by_chat, key=lambda cid: self.chats[cid].next_at if cid in self.chats else 0):
+            state = self.chats.setdefault(chat_id, _ChatState())
+            ids = {m.message_id for _, m in by_chat[chat_id]}
+            state.last_text = {mid: text for mid, text in state.last_text.items() if mid in ids}
+            if now < state.next_at:
+                continue
+            pending = [
+                (message, text, markup) for message, (text, markup) in self._compose(by_chat[chat_id]).items()
+                if state.last_text.get(message.message_id) != text
+            ]
+            if not pending:
+                continue
+            if len(edits) + len(pending) > budget and edits:
+                break
+            base = self.group_interval if chat_id < 0 else self.interval
+            state.next_at = now + max(base, spread) * state.backoff
+            edits.extend((state, message, text, markup) for message, text, markup in pending)
+        if edits:
+            tasks = []
+            for edit in edits:
+                key = (edit[1].chat_id, edit[1].message_id)
+                task = asyncio.ensure_future(self._edit(*edit))
+                self._inflight[key] = task
+                task.add_done_callback(lambda t, key=key: self._inflight.get(key) is t and self._inflight.pop(key))
+                tasks.append(task)
+            await asyncio.gather(*tasks)
+
+    async def _edit(self, state: _ChatState, message, text: str, reply_markup=None):
+        try:
+            await message.edit_text(text, reply_markup=reply_markup)
+            state.last_text[message.message_id] = text
+            state.backoff = max(1.0, state.backoff * 0.9)
+            self.global_factor = min(1.0, self.global_factor * 1.05)
+        except RetryAfter as e:
+            delay = e.retry_after
+            delay = delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+            state.next_at = time.monotonic() + delay
+            state.backoff = min(8.0, state.backoff * 2)
+            self.global_factor = max(0.25, self.global_factor / 2)
+            print(f"🐢 Progress edits rate-limited for {delay:.0f}s in chat {message.chat_id}")
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                state.last_text[message.message_id] = text
+            else:
+                # Deleted or no longer editable: stop trying
+                self._dead.add((message.chat_id, message.message_id))
+        except Exception:
+            pass
@@ -0,0 +1,165 @@
+"""
+Global job scheduler.
+Caps how many jobs run at once overall, per user and per host, hands free
+slots to waiting users in round-robin order so one heavy user cannot starve
+the others, and keeps a bounded queue that rejects new jobs when it is full.
+"""
+
+import asyncio
+import collections
+import contextlib
+import time
+
+
+class SchedulerFull(Exception):
+    """Raised when the queue has no room for a new job."""
+
+
+class _Ticket:
+    def __init__(self, user_id, host):
+        self.user_id = user_id
+        self.host = host
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class JobScheduler:
+    """Concurrency limits plus a fair, bounded wait queue."""
+
+    def __init__(self, max_jobs: int, max_per_user: int, max_per_host: int, max_queue: int, max_queue_per_user: int):
+        self.max_jobs = max(1, max_jobs)
+        self.max_per_user = max_per_user
+        self.max_per_host = max_per_host
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.running = 0
+        self._user_running = collections.Counter()
+        self._host_running = collections.Counter()
+        # user_id -> deque of waiting tickets; order is the round-robin rotation
+        self._queues = collections.OrderedDict()
+        # Moving average of job duration in seconds, used for the ETA
+        self.avg_duration = 60.0
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def _can_run(self, user_id, host) -> bool:
+        if self.running >= self.max_jobs:
+            return False
+        if self.max_per_user > 0 and self._user_running[user_id] >= self.max_per_user:
+            return False
+        if host and self.max_per_host > 0 and self._host_running[host] >= self.max_per_host:
+            return False
+        return True
+
+    def _start(self, user_id, host):
+        self.running += 1
+        self._user_running[user_id] += 1
+        if host:
+            self._host_running[host] += 1
+
+    def _finish(self, user_id, host, duration: float):
+        self.running -= 1
+        self._user_running[user_id] -= 1
+        if self._user_running[user_id] <= 0:
+            del self._user_running[user_id]
+        if host:
+            self._host_running[host] -= 1
+            if self._host_running[host] <= 0:
+                del self._host_running[host]
+        self.avg_duration = 0.8 * self.avg_duration + 0.2 * duration
+        self._dispatch()
+
+    def _dispatch(self):
+        """Hand free slots to waiting jobs, one user at a time in rotation."""
+        progress = True
+        while progress and self._queues and self.running < self.max_jobs:
+            progress = False
+            for user_id in list(self._queues):
+                queue = self._queues[user_id]
+                ticket = queue[0]
+                if not self._can_run(ticket.user_id, ticket.host):
+                    continue
+                queue.popleft()
+                if queue:
+                    self._queues.move_to_end(user_id)
+                else:
+                    del self._queues[user_id]
+                self._start(ticket.user_id, ticket.host)
+                ticket.future.set_result(None)
+                progress = True
+                break
+
+    def position(self, ticket) -> int:
+        """1-based place in line, counting the round-robin turns of the other users."""
+        queue = self._queues.get(ticket.user_id)
+        if not queue or ticket not in queue:
+            return 0
+        index = queue.index(ticket)
+        ahead = index
+        before = True
+        for user_id, other in self._queues.items():
+            if user_id == ticket.user_id:
+                before = False
+                continue
+            ahead += min(len(other), index + 1 if before else index)
+        return ahead + 1
+
+    def eta(self, position: int) -> float:
+        """Rough seconds until a job at this position starts."""
+        return -(-position // self.max_jobs) * self.avg_duration
+
+    def _remove(self, ticket):
+        queue = self._queues.get(ticket.user_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.user_id]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id, host=None, on_queued=None, bounded: bool = True):
+        """Hold one job slot for the duration of the block.
+
+        While the job waits, on_queued(position, eta_seconds) is awaited whenever its
+        place in line changes. bounded=False is for follow-up work of a job that was
+        already admitted: it may wait but is never rejected.
+        """
+        if not (self._can_run(user_id, host) and user_id not in self._queues):
+            if bounded:
+                if self.max_queue > 0 and self.queued >= self.max_queue:
+                    raise SchedulerFull("سرور در حال حاضر بسیار شلوغ است. لطفاً چند دقیقه دیگر دوباره تلاش کنید.")
+                own = self._queues.get(user_id)
+                if self.max_queue_per_user > 0 and own and len(own) >= self.max_queue_per_user:
+                    raise SchedulerFull("شما چند درخواست در صف دارید. لطفاً تا پایان آن‌ها صبر کنید.")
+            ticket = _Ticket(user_id, host)
+            self._queues.setdefault(user_id, collections.deque()).append(ticket)
+            self._dispatch()
+            last_position = None
+            try:
+                while not ticket.future.done():
+                    position = self.position(ticket)
+                    if on_queued and position != last_position:
+                        last_position = position
+                        try:
+                            await on_queued(position, self.eta(position))
+                        except Exception:
+                            pass
+                    try:
+                        await asyncio.wait_for(asyncio.shield(ticket.future), timeout=10)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                if ticket.future.done():
+                    # The slot was granted just as we were cancelled: hand it on
+                    self._finish(user_id, host, self.avg_duration)
+                else:
+                    self._remove(ticket)
+                    ticket.future.cancel()
+                raise
+        else:
+            self._start(user_id, host)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._finish(user_id, host, time.monotonic() - started)
@@ -0,0 +1,88 @@
+"""
+Coalesce identical in-flight jobs.
+When several users request the same thing at once, only the first request
+does the work; later ones attach to it, see its progress and share its result.
+"""
+
+import asyncio
+import contextlib
+
+
+class ProgressFanout:
+    """Message-like object that mirrors progress edits to every attached message.
+
+    It is handed to the shared job in place of a single progress message. Only the
+    first (leader's) message is deleted by delete(); the others belong to their
+    requesters, who finish them off once the shared job is done.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def add(self, message):
+        self.messages.append(message)
+
+    async def edit_text(self, text, **kwargs):
+        results = await asyncio.gather(
+            *(m.edit_text(text, **kwargs) for m in self.messages), return_exceptions=True
+        )
+        if results and all(isinstance(r, Exception) for r in results):
+            raise results[0]
+
+    async def delete(self):
+        if self.messages:
+            await self.messages[0].delete()
+
+
+class _Flight:
+    def __init__(self):
+        self.task = None
+        self.fanout = ProgressFanout()
+        self.participants = 0
+
+
+class SingleFlight:
+    """Registry of running jobs keyed by what they produce (normalized URL, video ID + quality...)."""
+
+    def __init__(self):
+        self._flights = {}
+
+    @contextlib.asynccontextmanager
+    async def join(self, key, func, progress_msg=None, release=None):
+        """Run func(progress) once per key and yield (result, is_leader) to every caller.
+
+        progress is a ProgressFanout the job should report to. The job keeps running
+        even if the caller that started it goes away. When the last caller leaves
+        the block, release(result) is called so shared resources (such as the
+        downloaded file every caller linked from) can be cleaned up.
+        """
+        flight = self._flights.get(key)
+        is_leader = flight is None
+        if is_leader:
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._run(key, flight, func))
+        else:
+            print(f"🔗 Joined in-flight job: {key}")
+        if progress_msg is not None:
+            flight.fanout.add(progress_msg)
+        flight.participants += 1
+        try:
+            result = await asyncio.shield(flight.task)
+            yield result, is_leader
+        finally:
+            flight.participants -= 1
+            if flight.participants == 0 and release and flight.task.done() and not flight.task.cancelled() \
+                    and flight.task.exception() is None:
+                try:
+                    release(flight.task.result())
+                except Exception as e:
+                    print(f"⚠️ Error releasing shared job result {key}: {e}")
+
+    async def _run(self, key, flight, func):
+        try:
+            return await func(flight.fanout)
+        finally:
+            # New requests after this point start a fresh job
+            if self._flights.get(key) is flight:
+                del self._flights[key]
@@ -0,0 +1,256 @@
+"""
+Temp storage manager for download jobs.
+Every job gets its own workspace directory under STORAGE_DIR. Disk space is
+reserved up front against a global byte quota, jobs wait (admission control)
+while the volume is full, and a sweeper removes whatever a crash left behind.
+"""
+
+import asyncio
+import os
+import shutil
+import time
+from uuid import uuid4
+
+
+class StorageFull(Exception):
+    """Raised when a job needs more space than the whole quota (or the whole disk) allows."""
+
+
+def _allocated(st) -> int:
+    """Bytes a file really takes on disk (a sparse file takes less than its size)."""
+    blocks = getattr(st, "st_blocks", None)
+    return blocks * 512 if blocks is not None else st.st_size
+
+
+class Workspace:
+    """A job's private directory plus the bytes it has reserved."""
+
+    def __init__(self, manager, job_id: str, path: str):
+        self.manager = manager
+        self.job_id = job_id
+        self.path = path
+        self.reserved = 0
+        self.created = time.time()
+        # Last time the job reserved space or asked for a file path
+        self.last_active = self.created
+        self.released = False
+        # Files outside the directory being written for this job (.part files in PARTIAL_DIR)
+        self.external = set()
+
+    def file(self, filename: str) -> str:
+        """Path for filename inside this workspace."""
+        self.last_active = time.time()
+        return os.path.join(self.path, os.path.basename(filename) or "file")
+
+    def track(self, path: str):
+        """Count path (written outside the workspace, e.g. a .part file) as this job's data."""
+        self.external.add(path)
+
+    def untrack(self, path: str):
+        self.external.discard(path)
+
+    def written(self) -> int:
+        """Bytes this job already occupies on disk: its directory plus tracked outside files.
+        Preallocated space counts, since it is already gone from the disk's free space."""
+        size = 0
+        try:
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    try:
+                        size += _allocated(entry.stat())
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        for path in list(self.external):
+            try:
+                size += _allocated(os.stat(path))
+            except OSError:
+                pass
+        return size
+
+    def unwritten(self) -> int:
+        """Reserved bytes not written yet: the job will still fill them (it is active)."""
+        return max(0, self.reserved - self.written())
+
+    async def reserve(self, nbytes: int, on_wait=None):
+        """Reserve space before writing; waits while the disk is full (admission control)."""
+        await self.manager.reserve(nbytes, on_wait)
+        self.reserved += nbytes
+        self.last_active = time.time()
+
+    def try_reserve(self, nbytes: int) -> bool:
+        """Reserve space only if there is room right now (for optional, speculative work)."""
+        if not self.manager.try_reserve(nbytes):
+            return False
+        self.reserved += nbytes
+        self.last_active = time.time()
+        return True
+
+    def reserve_now(self, nbytes: int):
+        """Reserve space without waiting, for jobs that were already admitted."""
+        self.manager.force_reserve(nbytes)
+        self.reserved += nbytes
+        self.last_active = time.time()
+
+    def unreserve(self, nbytes: int):
+        """Give back part of the reservation, e.g. for an output file that was deleted."""
+        nbytes = min(nbytes, self.reserved)
+        self.reserved -= nbytes
+        self.manager.unreserve(nbytes)
+
+    def release(self):
+        """Delete the workspace and give its reservation back. Safe to call more than once."""
+        self.manager.release(self)
+
+
+class StorageManager:
+    """Owns STORAGE_DIR/jobs and the global byte quota shared by all workspaces."""
+
+    def __init__(self, root: str, quota_bytes: int, min_free_bytes: int = 0, max_job_age: float = 3 * 60 * 60):
+        self.root = root
+        self.jobs_dir = os.path.join(root, 'jobs')
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self.max_job_age = max_job_age
+        self.used = 0
+        self._workspaces = {}
+        self._cond = None
+        os.makedirs(self.jobs_dir, exist_ok=True)
+
+    def _condition(self):
+        # Created lazily so it binds to the running event loop
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    def create_workspace(self) -> Workspace:
+        job_id = uuid4().hex[:12]
+        path = os.path.join(self.jobs_dir, job_id)
+        workspace = Workspace(self, job_id, path)
+        self._workspaces[path] = workspace
+        os.makedirs(path, exist_ok=True)
+        return workspace
+
+    def adopt(self, path: str):
+        """Re-register a job directory left by a previous run (e.g. a file whose prompt is
+        still open) so the sweep keeps it. Its current size counts against the quota."""
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.jobs_dir) or not os.path.isdir(path):
+            return None
+        path = os.path.join(self.jobs_dir, os.path.basename(os.path.abspath(path)))
+        if path in self._workspaces:
+            return self._workspaces[path]
+        workspace = Workspace(self, os.path.basename(path), path)
+        self._workspaces[path] = workspace
+        size = 0
+        for name in os.listdir(path):
+            try:
+                size += os.path.getsize(os.path.join(path, name))
+            except OSError:
+                pass
+        workspace.reserve_now(size)
+        return workspace
+
+    def workspace_of(self, file_path: str):
+        """Return the active workspace containing file_path, or None."""
+        return self._workspaces.get(os.path.dirname(os.path.abspath(file_path)))
+
+    def _has_room(self, nbytes: int) -> bool:
+        if self.quota_bytes > 0 and self.used + nbytes > self.quota_bytes:
+            return False
+        try:
+            free = shutil.disk_usage(self.jobs_dir).free
+        except OSError:
+            return True
+        # Space promised to running jobs and not allocated by them yet is still free on
+        # disk but not available (what they did allocate is already missing from free)
+        promised = sum(w.unwritten() for w in self._workspaces.values())
+        return free - promised - nbytes >= self.min_free_bytes
+
+    async def reserve(self, nbytes: int, on_wait=None):
+        if self.quota_bytes > 0 and nbytes > self.quota_bytes:
+            raise StorageFull(f"فایل ({nbytes} بایت) از سهمیه فضای ذخیره‌سازی بزرگ‌تر است")
+        try:
+            capacity = shutil.disk_usage(self.jobs_dir).total - self.min_free_bytes
+        except OSError:
+            capacity = 0
+        if capacity > 0 and nbytes > capacity:
+            # Waiting would never help: the whole disk is too small
+            raise StorageFull(f"فایل ({nbytes} بایت) از فضای دیسک سرور بزرگ‌تر است")
+        cond = self._condition()
+        async with cond:
+            notified = False
+            while not self._has_room(nbytes):
+                if on_wait and not notified:
+                    notified = True
+                    try:
+                        await on_wait()
+                    except Exception:
+                        pass
+                try:
+                    # Re-check periodically too: free space also changes outside our control
+                    await asyncio.wait_for(cond.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    pass
+            self.used += nbytes
+
+    def try_reserve(self, nbytes: int) -> bool:
+        if not self._has_room(nbytes):
+            return False
+        self.used += nbytes
+        return True
+
+    def force_reserve(self, nbytes: int):
+        self.used += nbytes
+
+    def unreserve(self, nbytes: int):
+        self.used = max(0, self.used - nbytes)
+        if self._cond is not None:
+            asyncio.ensure_future(self._notify())
+
+    def release(self, workspace: Workspace):
+        if workspace.released:
+            return
+        workspace.released = True
+        self._workspaces.pop(workspace.path, None)
+        shutil.rmtree(workspace.path, ignore_errors=True)
+        self.used = max(0, self.used - workspace.reserved)
+        workspace.reserved = 0
+        if self._cond is not None:
+            asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        cond = self._condition()
+        async with cond:
+            cond.notify_all()
+
+    def sweep(self, partial_dir=None, partial_max_age: float = 24 * 60 * 60) -> int:
+        """Delete orphaned job directories and stale partial downloads. Returns the number removed.
+
+        A job directory is orphaned when no live workspace owns it (left by a crash or
+        restart). Live workspaces idle for max_job_age are released as well, so a
+        forgotten job cannot pin disk space forever; one whose reservation is not fully
+        written yet belongs to a job that is still running and is left alone.
+        """
+        removed = 0
+        now = time.time()
+        for workspace in list(self._workspaces.values()):
+            if now - workspace.last_active > self.max_job_age and not workspace.unwritten():
+                print(f"🧹 Releasing expired workspace {workspace.job_id}")
+                workspace.release()
+                removed += 1
+        for name in os.listdir(self.jobs_dir):
+            path = os.path.join(self.jobs_dir, name)
+            if path not in self._workspaces:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        if partial_dir and os.path.isdir(partial_dir):
+            for name in os.listdir(partial_dir):
+                path = os.path.join(partial_dir, name)
+                try:
+                    if now - os.path.getmtime(path) > partial_max_age:
+                        os.unlink(path)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
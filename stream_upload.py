@@ -0,0 +1,145 @@
+"""
+Stream a file into a Telegram Bot API upload.
+Builds the multipart/form-data body by hand so its total length is known
+up front and the file part can be fed from an async source: a download that
+is still arriving, or a local file read on the thread pool.
+"""
+
+import asyncio
+import json
+from uuid import uuid4
+
+from config import BOT_TOKEN, BOT_API_BASE_URL
+from disk_writer import fadvise
+
+
+class BotApiError(Exception):
+    """Raised when the Bot API answers ok=false (message includes the error code, e.g. 413)."""
+
+
+def bot_api_url(method: str) -> str:
+    base = BOT_API_BASE_URL or 'https://api.telegram.org/bot'
+    return f"{base}{BOT_TOKEN}/{method}"
+
+
+def _quote(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+
+
+def _multipart_envelope(boundary: str, params: dict, field: str, filename: str, content_type: str) -> tuple:
+    """Return (head, tail) bytes that surround the raw file bytes in the request body."""
+    head = bytearray()
+    for name, value in params.items():
+        if value is None:
+            continue
+        if not isinstance(value, str):
+            value = json.dumps(value)
+        head += f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode()
+        head += value.encode() + b'\r\n'
+    head += (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{_quote(filename)}"\r\n'
+        f'Content-Type: {content_type}\r\n\r\n'
+    ).encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    return bytes(head), tail
+
+
+async def send_file_stream(session, method: str, field: str, filename: str, size: int, chunks,
+                           params: dict, content_type: str = 'application/octet-stream', progress_cb=None,
+                           throttle=None) -> dict:
+    """Upload exactly `size` bytes produced by the async iterable `chunks` and return the sent Message as a dict.
+    throttle(nbytes), if given, is awaited for every chunk to pace the upload.
+    """
+    boundary = uuid4().hex
+    head, tail = _multipart_envelope(boundary, params, field, filename, content_type)
+
+    async def body():
+        yield head
+        sent = 0
+        async for chunk in chunks:
+            sent += len(chunk)
+            if sent > size:
+                raise ValueError(f"source produced more than the announced {size} bytes")
+            yield chunk
+            if progress_cb:
+                await progress_cb(sent, size)
+            if throttle:
+                await throttle(len(chunk))
+        if sent != size:
+            raise ValueError(f"source ended after {sent} of {size} bytes")
+        yield tail
+
+    headers = {
+        'Content-Type': f'multipart/form-data; boundary={boundary}',
+        'Content-Length': str(len(head) + size + len(tail)),
+    }
+    async with session.post(bot_api_url(method), data=body(), headers=headers) as response:
+        try:
+            data = await response.json(content_type=None)
+        except ValueError:
+            # Not the Bot API answering, e.g. an HTML 413 page from a reverse proxy in front of it
+            text = (await response.text(errors="replace"))[:200]
+            raise BotApiError(f"{response.status}: {text.strip() or response.reason}") from None
+    if not isinstance(data, dict):
+        raise BotApiError(f"{response.status}: unexpected response from the Bot API")
+    if not data.get('ok'):
+        raise BotApiError(f"{data.get('error_code') or response.status}: {data.get('description')}")
+    return data['result']
+
+
+async def buffered_chunks(response, chunk_size: int = 256 * 1024, max_chunks: int = 16, on_chunk=None, throttle=None):
+    """Read a response body in a background task through a bounded queue.
+
+    The download keeps running while the upload is briefly slower, but never gets
+    more than max_chunks * chunk_size bytes ahead of it. on_chunk(chunk) sees every
+    chunk in order (e.g. for hashing). throttle(nbytes) paces the download side.
+    """
+    queue = asyncio.Queue(maxsize=max_chunks)
+    done = object()
+
+    async def produce():
+        try:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                await queue.put(chunk)
+                if throttle:
+                    await throttle(len(chunk))
+            await queue.put(done)
+        except Exception as e:
+            await queue.put(e)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if on_chunk:
+                on_chunk(item)
+            yield item
+    finally:
+        producer.cancel()
+
+
+async def file_chunks(path: str, chunk_size: int = 1024 * 1024):
+    """Read a local file on the thread pool, one chunk ahead, so uploads never block the event loop."""
+    loop = asyncio.get_running_loop()
+    f = await loop.run_in_executor(None, open, path, 'rb')
+    fadvise(f.fileno(), 'POSIX_FADV_SEQUENTIAL')
+    pending = None
+    try:
+        pending = loop.run_in_executor(None, f.read, chunk_size)
+        while True:
+            chunk = await pending
+            pending = None
+            if not chunk:
+                break
+            pending = loop.run_in_executor(None, f.read, chunk_size)
+            yield chunk
+    finally:
+        if pending is not None and not pending.done():
+            # A read is still running on the pool: close the file once it is done
+            pending.add_done_callback(lambda _: f.close())
+        else:
+            f.close()
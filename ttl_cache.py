@@ -0,0 +1,57 @@
+"""
+Small in-memory cache whose entries carry their own expiry time.
+Used for lookups that go stale on a known schedule, such as stream maps built
+from signed YouTube URLs (valid until their expire= timestamp).
+"""
+
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlparse
+
+
+def signed_url_expiry(urls, default_ttl: float, margin: float = 0) -> float:
+    """Unix time at which the earliest of urls stops working, minus margin.
+
+    Reads the expire= query parameter of signed googlevideo URLs. URLs without one
+    (e.g. proxied through an instance) are assumed valid for default_ttl seconds.
+    """
+    expires = []
+    for url in urls:
+        try:
+            value = parse_qs(urlparse(url).query).get("expire", [None])[0]
+            if value:
+                expires.append(float(value))
+        except (TypeError, ValueError):
+            continue
+    expiry = min(expires) if expires else time.time() + default_ttl
+    return expiry - margin
+
+
+class ExpiringCache:
+    """Least recently used entries are dropped beyond max_entries; expired ones on access."""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if time.time() >= expires_at:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, expires_at: float):
+        if expires_at <= time.time():
+            return
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
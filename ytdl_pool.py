@@ -0,0 +1,249 @@
+"""
+Warm process pool for yt-dlp.
+Extraction (JSON parsing, signature solving) and downloads run in worker
+processes that import yt-dlp once and keep their extraction YoutubeDL
+instances, so the bot's event loop never competes with them for the GIL.
+Jobs go to the workers through the executor's call queue; download progress
+comes back over one shared event queue that a thread relays to the loop.
+A download whose caller is cancelled is aborted from its progress hook (it
+stops at the next progress event, so an ffmpeg merge already running finishes
+first). If a worker dies, the pool is rebuilt and the job is retried once.
+"""
+
+import asyncio
+import glob
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class YtdlError(Exception):
+    """A yt-dlp failure carried back from a worker (its own exceptions may not pickle)."""
+
+
+# ---- worker side -------------------------------------------------------------
+
+_events = None
+_cancelled = None
+_instances = {}
+
+
+def _init_worker(events, cancelled):
+    global _events, _cancelled
+    _events = events
+    _cancelled = cancelled
+    import yt_dlp  # noqa: F401  (imported once per worker: that is the point of the pool)
+
+
+def _warm(seconds: float):
+    # Keeps one worker busy for a moment so the executor starts the next one too
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def _ydl(opts: dict):
+    """A YoutubeDL for opts, built once per worker and reused by later jobs with the same opts."""
+    import yt_dlp
+    key = json.dumps(opts, sort_keys=True, default=str)
+    cookiefile = opts.get('cookiefile')
+    if cookiefile and os.path.exists(cookiefile):
+        # Cookies are read when the instance is built: a replaced cookie file needs a new one
+        key += str(os.path.getmtime(cookiefile))
+    ydl = _instances.get(key)
+    if ydl is None:
+        if len(_instances) >= 8:
+            _instances.pop(next(iter(_instances))).close()
+        ydl = _instances[key] = yt_dlp.YoutubeDL(opts)
+    return ydl
+
+
+def _extract(opts: dict, url: str) -> dict:
+    try:
+        ydl = _ydl(opts)
+        # Sanitized the same way as --load-info-json, so process_ie_result accepts it later
+        return ydl.sanitize_info(ydl.extract_info(url, download=False))
+    except Exception as e:
+        raise YtdlError(str(e)) from None
+
+
+def _progress_hooks(job_id, min_interval: float):
+    """progress_hooks and postprocessor_hooks reporting one job's progress as a whole.
+
+    A format like bestvideo+bestaudio downloads two files one after the other, and
+    fragmented (DASH/HLS) downloads only estimate their size, so events carry the sum
+    over every file seen so far: (job_id, status, downloaded_bytes, total_bytes).
+    """
+    files = {}
+    state = {"last": 0.0}
+
+    def emit(status: str):
+        done = sum(f[0] for f in files.values())
+        total = sum(f[1] for f in files.values())
+        _events.put((job_id, status, done, total))
+
+    def progress_hook(d):
+        if _cancelled is not None and job_id in _cancelled[:]:
+            # yt-dlp lets exceptions from hooks abort the download
+            raise YtdlError("download cancelled")
+        status = d.get("status")
+        name = d.get("filename") or d.get("tmpfilename") or ""
+        downloaded = int(d.get("downloaded_bytes") or 0)
+        total = int(d.get("total_bytes") or d.get("total_bytes_estimate") or 0)
+        if status == "finished":
+            total = total or downloaded
+            downloaded = total
+        files[name] = (downloaded, max(total, downloaded))
+        now = time.monotonic()
+        if status == "downloading" and now - state["last"] < min_interval:
+            return
+        state["last"] = now
+        emit(status)
+
+    def postprocessor_hook(d):
+        if d.get("status") == "started" and d.get("postprocessor") in ("Merger", "FFmpegMerger"):
+            emit("merging")
+
+    return [progress_hook], [postprocessor_hook]
+
+
+def _download(opts: dict, url: str, info, out_prefix: str, job_id, progress_interval: float) -> dict:
+    """Download url (from info when given, without extracting again) to out_prefix.<ext>.
+    Returns {"path", "reextracted"}; reextracted means info was stale and had to be refreshed."""
+    import yt_dlp
+    progress_hooks, postprocessor_hooks = _progress_hooks(job_id, progress_interval)
+    opts = dict(opts, outtmpl=out_prefix + '.%(ext)s', progress_hooks=progress_hooks,
+                postprocessor_hooks=postprocessor_hooks)
+    reextracted = False
+    try:
+        # Format and output template differ per job, so download instances are not kept
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            result = None
+            if info is not None:
+                try:
+                    result = ydl.process_ie_result(info, download=True)
+                except yt_dlp.utils.DownloadError as e:
+                    # Most likely the format URLs went stale: extract afresh below
+                    print(f"⚠️ Reusing yt-dlp info failed ({e}); extracting again")
+                    reextracted = True
+            if result is None:
+                result = ydl.extract_info(url, download=True)
+    except Exception as e:
+        raise YtdlError(str(e)) from None
+    # yt-dlp replaces %(ext)s with the actual extension, which may differ after merging
+    ext = (result.get('ext') or 'mp4') if isinstance(result, dict) else 'mp4'
+    path = out_prefix + '.' + ext
+    if not os.path.exists(path):
+        matches = [m for m in glob.glob(out_prefix + '.*') if not m.endswith(('.part', '.ytdl'))]
+        if not matches:
+            raise YtdlError("yt-dlp finished without producing a file")
+        path = matches[0]
+    return {"path": path, "reextracted": reextracted}
+
+
+# ---- bot side ----------------------------------------------------------------
+
+class YtdlPool:
+    """Process pool running yt-dlp jobs; see the module docstring."""
+
+    def __init__(self, workers: int = 2, progress_interval: float = 0.5):
+        self.workers = max(1, workers)
+        self.progress_interval = progress_interval
+        # spawn: forking a process that runs threads and an event loop is not safe
+        self._ctx = multiprocessing.get_context("spawn")
+        self._events = None
+        # Ring of recently cancelled job IDs, shared with the workers
+        self._cancelled = None
+        self._cancel_slot = 0
+        self._executor = None
+        self._pump = None
+        self._listeners = {}
+        self._next_job = 0
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """Start the workers (each imports yt-dlp right away) and the progress relay."""
+        if self._executor is not None:
+            return
+        self._loop = loop
+        self._events = self._ctx.Queue()
+        self._cancelled = self._ctx.Array('q', 64)
+        self._new_executor()
+        self._pump = threading.Thread(target=self._relay, name="ytdl-progress", daemon=True)
+        self._pump.start()
+
+    def _new_executor(self):
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=self._ctx,
+            initializer=_init_worker, initargs=(self._events, self._cancelled),
+        )
+        for _ in range(self.workers):
+            self._executor.submit(_warm, 0.5)
+
+    def _relay(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            job_id = event[0]
+            callback = self._listeners.get(job_id)
+            if callback is not None:
+                self._loop.call_soon_threadsafe(self._deliver, job_id, event[1:])
+
+    def _deliver(self, job_id, event):
+        callback = self._listeners.get(job_id)
+        if callback is not None:
+            task = asyncio.ensure_future(callback(*event))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def _run(self, func, *args):
+        if self._executor is None:
+            self.start(asyncio.get_running_loop())
+        for attempt in range(2):
+            executor = self._executor
+            try:
+                return await asyncio.wrap_future(executor.submit(func, *args))
+            except BrokenProcessPool:
+                # A worker died (OOM kill, crash in a merger): the executor is unusable from now on
+                if self._executor is executor:
+                    print("⚠️ yt-dlp worker died; restarting the pool")
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self._new_executor()
+                if attempt:
+                    raise YtdlError("yt-dlp worker process died") from None
+
+    def _cancel(self, job_id: int):
+        self._cancelled[self._cancel_slot] = job_id
+        self._cancel_slot = (self._cancel_slot + 1) % len(self._cancelled)
+
+    async def extract(self, opts: dict, url: str) -> dict:
+        """yt-dlp info dict for url (sanitized, safe to cache and pass to download())."""
+        return await self._run(_extract, opts, url)
+
+    async def download(self, opts: dict, url: str, out_prefix: str, info=None, on_progress=None) -> dict:
+        """Download url to out_prefix.<ext>; on_progress(status, downloaded, total) is awaited
+        on the event loop for yt-dlp's progress events. See _download for the result."""
+        self._next_job += 1
+        job_id = self._next_job
+        if on_progress is not None:
+            self._listeners[job_id] = on_progress
+        try:
+            return await self._run(_download, opts, url, info, out_prefix, job_id, self.progress_interval)
+        except asyncio.CancelledError:
+            # The worker keeps going otherwise: tell its progress hook to abort
+            if self._cancelled is not None:
+                self._cancel(job_id)
+            raise
+        finally:
+            self._listeners.pop(job_id, None)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._events is not None:
+            self._events.put(None)
+            self._pump.join(timeout=5)
+            self._events = None